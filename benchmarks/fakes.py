@@ -0,0 +1,122 @@
+import asyncio
+import itertools
+
+message_ids = itertools.count(1)
+
+
+class FakeUser:
+    """
+    Stand-in for discord.User / discord.Member.
+    """
+    def __init__(self, name="bench_user", user_id=1000, administrator=False):
+        self.name = name
+        self.id = user_id
+        self.bot = False
+        self.guild_permissions = FakePermissions(administrator)
+
+
+class FakePermissions:
+    """
+    Stand-in for discord.Permissions.
+    """
+    def __init__(self, administrator):
+        self.administrator = administrator
+
+
+class FakeGuild:
+    """
+    Stand-in for discord.Guild.
+    """
+    def __init__(self, guild_id=1, name="bench_guild"):
+        self.id = guild_id
+        self.name = name
+
+
+class FakeTyping:
+    """
+    Stand-in for context manager returned by discord.abc.Messageable.typing().
+    """
+    def __init__(self, channel):
+        self.channel = channel
+
+    async def __aenter__(self):
+        self.channel.typing_count += 1
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        return False
+
+
+class FakeChannel:
+    """
+    Stand-in for discord.TextChannel. Records every send instead of calling Discord API.
+    """
+    def __init__(self, channel_id=100, name="bench_channel", guild=None, send_delay=0.0):
+        """
+        :param channel_id: id of the channel.
+        :param name: name of the channel.
+        :param guild: FakeGuild instance.
+        :param send_delay: seconds each send takes, to imitate REST latency.
+        """
+        self.id = channel_id
+        self.name = name
+        self.guild = guild if guild is not None else FakeGuild()
+        self.send_delay = send_delay
+        self.sent = []
+        self.typing_count = 0
+
+    async def send(self, content=None, *, embed=None, file=None, **kwargs):
+        if self.send_delay > 0:
+            await asyncio.sleep(self.send_delay)
+        self.sent.append({"content": content, "embed": embed, "file": file})
+        return FakeMessage(content or "", self, FakeUser("bench_bot", 1))
+
+    def typing(self):
+        return FakeTyping(self)
+
+
+class FakeMessage:
+    """
+    Stand-in for discord.Message.
+    """
+    def __init__(self, content, channel, author=None):
+        self.id = next(message_ids)
+        self.content = content
+        self.channel = channel
+        self.guild = channel.guild
+        self.author = author if author is not None else FakeUser()
+
+
+class FakeClientUser:
+    """
+    Stand-in for discord.ClientUser.
+    """
+    def __init__(self):
+        self.name = "bench_bot"
+        self.id = 1
+
+
+class FakeClient:
+    """
+    Stand-in for discord.Client. Knows channels created by benchmarks and supports old send_message API used by
+    deprecated modules.
+    """
+    def __init__(self, channels=()):
+        self.user = FakeClientUser()
+        self.channels = {channel.id: channel for channel in channels}
+        self.loop = None
+
+    def get_channel(self, channel_id):
+        return self.channels.get(channel_id)
+
+    async def send_message(self, channel, content=None, embed=None):
+        return await channel.send(content, embed=embed)
+
+    async def send_typing(self, channel):
+        channel.typing_count += 1
+
+    async def change_presence(self, **kwargs):
+        pass
+
+    async def logout(self):
+        pass
@@ -0,0 +1,93 @@
+import asyncio
+import os
+from aiohttp import web
+
+FIXTURE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "fixtures")
+
+
+def read_fixture(name):
+    """
+    Reads fixture file.
+    :param name: file name in fixtures directory.
+    :return: content in bytes.
+    """
+    with open(os.path.join(FIXTURE_PATH, name), "rb") as fixture_file:
+        return fixture_file.read()
+
+
+class FixtureServer:
+    """
+    Local stand-in for psnprofiles.com, best.gg and WolframAlpha which replays saved responses. Modules are pointed
+    at it by overriding their base urls.
+    """
+    def __init__(self, host="127.0.0.1", port=0, delay=0.0):
+        """
+        :param host: address to bind.
+        :param port: port to bind; 0 picks a free port.
+        :param delay: seconds added to every response, to imitate upstream latency.
+        """
+        self.host = host
+        self.port = port
+        self.delay = delay
+        self.runner = None
+        self.request_count = 0
+        self.fixtures = {
+            "psn_profile": read_fixture("psn_profile.html"),
+            "psn_log": read_fixture("psn_log.html"),
+            "bestgg_player": read_fixture("bestgg_player.html"),
+            "wolfram_result": read_fixture("wolfram_result.txt"),
+            "wolfram_simple": read_fixture("wolfram_simple.png")
+        }
+
+    @property
+    def base_url(self):
+        return "http://" + self.host + ":" + str(self.port) + "/"
+
+    async def start(self):
+        """
+        Starts server and resolves port if it was picked automatically.
+        :return: no return value.
+        """
+        app = web.Application()
+        app.router.add_get("/psn/{user}", self.psn_profile)
+        app.router.add_get("/psn/{user}/log", self.psn_log)
+        app.router.add_get("/psn/", self.psn_search)
+        app.router.add_get("/bestgg/player/{player}", self.bestgg_player)
+        app.router.add_get("/wolfram/v1/result", self.wolfram_result)
+        app.router.add_get("/wolfram/v1/simple", self.wolfram_simple)
+        self.runner = web.AppRunner(app, access_log=None)
+        await self.runner.setup()
+        site = web.TCPSite(self.runner, self.host, self.port)
+        await site.start()
+        self.port = site._server.sockets[0].getsockname()[1]
+
+    async def stop(self):
+        await self.runner.cleanup()
+
+    async def respond(self, body, content_type):
+        self.request_count += 1
+        if self.delay > 0:
+            await asyncio.sleep(self.delay)
+        return web.Response(body=body, content_type=content_type)
+
+    async def psn_profile(self, request):
+        if request.match_info["user"] == "missing":
+            raise web.HTTPFound("/psn/?psnId=missing")
+        return await self.respond(self.fixtures["psn_profile"], "text/html")
+
+    async def psn_log(self, request):
+        if request.match_info["user"] == "missing":
+            raise web.HTTPFound("/psn/?psnId=missing")
+        return await self.respond(self.fixtures["psn_log"], "text/html")
+
+    async def psn_search(self, request):
+        return await self.respond(b"<html><body><p>No results</p></body></html>", "text/html")
+
+    async def bestgg_player(self, request):
+        return await self.respond(self.fixtures["bestgg_player"], "text/html")
+
+    async def wolfram_result(self, request):
+        return await self.respond(self.fixtures["wolfram_result"], "text/plain")
+
+    async def wolfram_simple(self, request):
+        return await self.respond(self.fixtures["wolfram_simple"], "image/png")
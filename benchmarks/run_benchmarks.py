@@ -0,0 +1,416 @@
+"""
+Offline benchmark suite. Replays recorded upstream responses from a local fixture server and drives main_bot.on_message,
+modules and scraping parsers with fake Discord objects. Reports throughput, p50/p99 latency and peak allocation per
+command, and stores results so runs can be compared across changes. Audio scenarios time one 20 ms frame of music
+playback, so their ops/s divided by 50 is the number of voice streams one core can keep up with.
+
+Usage (from repository root):
+    python -m benchmarks.run_benchmarks [--iterations N] [--only name,...] [--compare results/old.json]
+"""
+import argparse
+import asyncio
+import json
+import logging
+import os
+import subprocess
+import tempfile
+import time
+import tracemalloc
+from datetime import datetime, timedelta
+import discord
+from configobj import ConfigObj
+from benchmarks.fakes import FakeChannel, FakeClient, FakeGuild, FakeMessage, FakeUser
+from benchmarks.fixture_server import FixtureServer, read_fixture
+from modular_bot import main_bot
+from modular_bot.Module import BaseModule
+from modular_bot.audio_effects import FRAME_BYTES, EffectsSource
+from modular_bot.http_client import HttpResponse
+from modular_bot.event_store import ReminderEvent
+from modular_bot.module_registry import ModuleRegistry
+from modular_bot.modules.basic_commands_module import BasicCommands
+from modular_bot.modules.event_reminder_module import EventReminderModule
+from modular_bot.modules.lol_module import LOLEsportsModule, parse_player_page
+from modular_bot.modules.psn_module import PSNModule, parse_profile_page, parse_trophy_log
+from modular_bot.modules.wolfram_module import WolframModule
+
+RESULTS_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "results")
+CHANNEL_ID = 100
+
+
+def percentile(samples, fraction):
+    """
+    Returns percentile of samples using nearest-rank method.
+    :param samples: sorted list of numbers.
+    :param fraction: percentile between 0 and 1.
+    :return: value at given percentile.
+    """
+    if not samples:
+        return 0.0
+    rank = max(int(round(fraction * len(samples) + 0.5)) - 1, 0)
+    return samples[min(rank, len(samples) - 1)]
+
+
+def git_revision():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], stderr=subprocess.DEVNULL,
+                                       cwd=os.path.dirname(RESULTS_PATH)).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+class BenchmarkBot:
+    """
+    Wires modules into main_bot the same way main() does, but with fake client and channel.
+    """
+    def __init__(self, server, database_path):
+        self.server = server
+        self.guild = FakeGuild()
+        self.channel = FakeChannel(CHANNEL_ID, guild=self.guild)
+        self.client = FakeClient([self.channel])
+        self.author = FakeUser(administrator=True)
+        self.reminder = EventReminderModule("!", {"database": database_path})
+        self.psn = PSNModule("!")
+        data_path = os.path.dirname(database_path)
+        self.wolfram = WolframModule("!", {"answer_database": os.path.join(data_path, "answers.db"),
+                                           "answer_blob_path": os.path.join(data_path, "answers")})
+        self.lol = LOLEsportsModule("!")
+        self.psn.base_url = server.base_url + "psn/"
+        self.lol.base_url = server.base_url + "bestgg/player/"
+        self.wolfram.api_url = server.base_url + "wolfram/v1/"
+        modules = [BasicCommands("!"), self.psn, self.wolfram, self.lol, self.reminder]
+        # fake channel has no rate limit; pacing would only measure configured limit
+        BaseModule.outbound.configure({"rate": 1000000})
+        main_bot.registry = ModuleRegistry("!", ConfigObj(), main_bot.dispatcher)
+        main_bot.registry.routes_changed = main_bot.set_routes
+        for module in modules:
+            main_bot.registry.add(type(module).__module__ + "." + type(module).__name__, True).instance = module
+        main_bot.client = self.client
+        main_bot.command_char = "!"
+        main_bot.listening_channels = [str(CHANNEL_ID)]
+        main_bot.modules_list[:] = main_bot.registry.specs
+        main_bot.load_commands()
+
+    async def start(self):
+        await self.reminder.on_ready(self.client)
+
+    def set_caching(self, enabled):
+        """
+        Turns response caching of scraping modules on or off and empties caches.
+        :param enabled: True to use cache_ttl of each module class, False to disable caching.
+        :return: no return value.
+        """
+        for module in (self.psn, self.wolfram, self.lol):
+            module.cache_ttl = type(module).cache_ttl if enabled else 0
+        self.wolfram.answer_ttl = WolframModule.answer_ttl if enabled else 0
+        BaseModule.response_cache.clear()
+        BaseModule.parsed_cache.clear()
+
+    async def send(self, content):
+        """
+        Delivers message to on_message and waits until command task spawned by dispatcher finishes.
+        :param content: message content.
+        :return: no return value.
+        """
+        before = set(main_bot.dispatcher.tasks)
+        await main_bot.on_message(FakeMessage(content, self.channel, self.author))
+        spawned = set(main_bot.dispatcher.tasks) - before
+        if spawned:
+            await asyncio.gather(*spawned)
+
+
+async def measure(operation, iterations, alloc_iterations):
+    """
+    Runs operation repeatedly. Latency is measured without tracing, then a shorter traced run records peak allocation.
+    :param operation: coroutine function taking iteration number.
+    :param iterations: number of timed runs.
+    :param alloc_iterations: number of traced runs.
+    :return: dictionary of measurements.
+    """
+    await operation(-1)  # warm up connections, caches and lazy imports
+    latencies = []
+    started = time.perf_counter()
+    for i in range(iterations):
+        begin = time.perf_counter()
+        await operation(i)
+        latencies.append(time.perf_counter() - begin)
+    elapsed = time.perf_counter() - started
+    peaks = []
+    tracemalloc.start()
+    for i in range(alloc_iterations):
+        tracemalloc.reset_peak()
+        baseline = tracemalloc.get_traced_memory()[0]
+        await operation(iterations + i)
+        peaks.append(tracemalloc.get_traced_memory()[1] - baseline)
+    tracemalloc.stop()
+    latencies.sort()
+    peaks.sort()
+    return {
+        "iterations": iterations,
+        "ops_per_sec": iterations / elapsed if elapsed > 0 else 0.0,
+        "p50_ms": percentile(latencies, 0.50) * 1000,
+        "p99_ms": percentile(latencies, 0.99) * 1000,
+        "peak_alloc_kib": percentile(peaks, 0.50) / 1024
+    }
+
+
+def command_scenario(bot, content, cached=None):
+    async def operation(i):
+        await bot.send(content)
+    return operation, cached
+
+
+def parse_scenario(parser, url, fixture, encoding="utf-8"):
+    response = HttpResponse(url, 200, read_fixture(fixture), encoding)
+
+    async def operation(i):
+        parser(response)
+    return operation, None
+
+
+def reminder_add_scenario(bot):
+    start = datetime.now() + timedelta(days=30)
+
+    async def operation(i):
+        event_time = (start + timedelta(minutes=i + 2)).strftime("%Y-%m-%d %H:%M")
+        await bot.send("!addevent bench" + str(i) + " " + event_time)
+    return operation, None
+
+
+def reminder_list_scenario(bot):
+    async def operation(i):
+        await bot.send("!listevent")
+    return operation, None
+
+
+class ToneSource(discord.AudioSource):
+    """
+    PCM source repeating one non-silent frame, like a song decoded by ffmpeg.
+    """
+    FRAME = bytes(range(256)) * (FRAME_BYTES // 256)
+
+    def __init__(self, frames=None):
+        """
+        :param frames: number of frames before end of stream, or None for endless stream.
+        """
+        self.remaining = frames
+
+    def read(self):
+        if self.remaining is not None:
+            if self.remaining <= 0:
+                return b""
+            self.remaining -= 1
+        return self.FRAME
+
+
+def volume_scenario():
+    # what discord.py itself offers: audioop multiplication of PCMVolumeTransformer
+    source = discord.PCMVolumeTransformer(ToneSource(), volume=0.5)
+
+    async def operation(i):
+        source.read()
+    return operation, None
+
+
+def effects_scenario(volume=1.0, ramp=False, ducked=False):
+    source = EffectsSource(ToneSource(), volume=volume, ducking=0.3 if ducked else 1.0, ramp_frames=25)
+
+    async def operation(i):
+        if ramp and i % 25 == 0:
+            source.volume = 0.2 if source.volume > 0.5 else 0.8  # always moving between two volumes
+        source.read()
+    return operation, None
+
+
+def crossfade_scenario(length=50):
+    sources = []
+
+    async def operation(i):
+        if not sources or sources[0].incoming is None or sources[0].fade_position >= sources[0].fade_length:
+            # song whose last frames are read ahead, handed over to next song
+            outgoing = EffectsSource(ToneSource(length), volume=0.5, tail_frames=length)
+            while not outgoing.exhausted:
+                outgoing.fill()
+            outgoing.hand_over(EffectsSource(ToneSource(), volume=0.5), None)
+            sources[:] = [outgoing]
+        sources[0].read()
+    return operation, None
+
+
+def build_scenarios(bot):
+    """
+    Builds benchmark scenarios in order they run. Each scenario is (operation, caching) where caching is None for
+    scenarios which do not fetch.
+    :param bot: BenchmarkBot instance.
+    :return: list of (name, scenario) tuples.
+    """
+    return [
+        ("dispatch_echo", command_scenario(bot, "!echo hello world")),
+        ("dispatch_invalid", command_scenario(bot, "!nosuchcommand")),
+        ("parse_psn_profile", parse_scenario(parse_profile_page, bot.psn.base_url + "bench", "psn_profile.html")),
+        ("parse_psn_log", parse_scenario(parse_trophy_log, bot.psn.base_url + "bench/log", "psn_log.html")),
+        ("parse_bestgg_player", parse_scenario(parse_player_page, bot.lol.base_url + "bench", "bestgg_player.html")),
+        ("psn_user", command_scenario(bot, "!psn_user bench", False)),
+        ("psn_user_cached", command_scenario(bot, "!psn_user bench", True)),
+        ("psn_recent", command_scenario(bot, "!psn_recent bench", False)),
+        ("psn_recent_cached", command_scenario(bot, "!psn_recent bench", True)),
+        ("psn_trophies", command_scenario(bot, "!psn_trophies bench", False)),
+        ("psn_trophies_cached", command_scenario(bot, "!psn_trophies bench", True)),
+        ("psn_user_missing", command_scenario(bot, "!psn_user missing", False)),
+        ("wolfram", command_scenario(bot, "!wolfram distance to moon", False)),
+        ("wolfram_detail", command_scenario(bot, "!wolfram_detail distance to moon", False)),
+        ("wolfram_stored", command_scenario(bot, "!wolfram distance to moon", True)),
+        ("wolfram_detail_stored", command_scenario(bot, "!wolfram_detail distance to moon", True)),
+        ("lol_player", command_scenario(bot, "!lol_player bench", False)),
+        ("lol_player_cached", command_scenario(bot, "!lol_player bench", True)),
+        ("reminder_add", reminder_add_scenario(bot)),
+        ("reminder_list", reminder_list_scenario(bot)),
+        ("frame_pcm_volume", volume_scenario()),
+        ("frame_effects_unity", effects_scenario()),
+        ("frame_effects_volume", effects_scenario(volume=0.5)),
+        ("frame_effects_ramp", effects_scenario(volume=0.5, ramp=True)),
+        ("frame_effects_duck", effects_scenario(volume=0.5, ducked=True)),
+        ("frame_crossfade", crossfade_scenario()),
+    ]
+
+
+async def reminder_fire(bot, count):
+    """
+    Schedules events which are all due at once and measures how fast reminders are delivered.
+    :param bot: BenchmarkBot instance.
+    :param count: number of events.
+    :return: dictionary of measurements.
+    """
+    module = bot.reminder
+    channel = FakeChannel(CHANNEL_ID + 1, guild=bot.guild)
+    bot.client.channels[channel.id] = channel
+    due = datetime.now() + timedelta(seconds=0.2)
+    events = [ReminderEvent(next(module.event_ids), "fire" + str(i), due, channel.id, bot.guild.id)
+              for i in range(count)]
+    module.scheduler.schedule_many([(event.id, event.time, event) for event in events])
+    for event in events:
+        module.index.add(event)
+    # time is counted from the moment events become due
+    started = time.perf_counter() + (due - datetime.now()).total_seconds()
+    while len(channel.sent) < count:
+        await asyncio.sleep(0.001)
+    elapsed = time.perf_counter() - started
+    return {"iterations": count, "ops_per_sec": count / elapsed if elapsed > 0 else 0.0,
+            "p50_ms": 0.0, "p99_ms": elapsed * 1000, "peak_alloc_kib": 0.0}
+
+
+async def burst(bot, content, concurrency):
+    """
+    Sends many messages at once and measures time until all commands finish, including rejected ones.
+    :param bot: BenchmarkBot instance.
+    :param content: message content, or function taking index of the message and returning its content.
+    :param concurrency: number of messages.
+    :return: dictionary of measurements.
+    """
+    if isinstance(content, str):
+        content = lambda i, text=content: text
+    started = time.perf_counter()
+    await asyncio.gather(*[bot.send(content(i)) for i in range(concurrency)])
+    elapsed = time.perf_counter() - started
+    return {"iterations": concurrency, "ops_per_sec": concurrency / elapsed if elapsed > 0 else 0.0,
+            "p50_ms": 0.0, "p99_ms": elapsed * 1000, "peak_alloc_kib": 0.0}
+
+
+async def run(args):
+    server = FixtureServer(delay=args.delay)
+    await server.start()
+    BaseModule.parse_pool.configure({"processes": args.parse_processes})
+    BaseModule.parse_pool.start()
+    with tempfile.TemporaryDirectory() as temp_dir:
+        bot = BenchmarkBot(server, os.path.join(temp_dir, "events.db"))
+        await bot.start()
+        results = {}
+        selected = set(args.only.split(",")) if args.only else None
+        for name, (operation, cached) in build_scenarios(bot):
+            if selected is not None and name not in selected:
+                continue
+            if cached is not None:
+                bot.set_caching(cached)
+            results[name] = await measure(operation, args.iterations, args.alloc_iterations)
+            print_result(name, results[name])
+        bot.set_caching(True)
+        if selected is None or "psn_user_burst" in selected:
+            results["psn_user_burst"] = await burst(bot, "!psn_user bench", args.burst)
+            print_result("psn_user_burst", results["psn_user_burst"])
+        if selected is None or "lol_player_burst" in selected:
+            # different players, so every command parses its own page
+            bot.set_caching(False)
+            results["lol_player_burst"] = await burst(bot, lambda i: "!lol_player bench" + str(i), args.burst)
+            print_result("lol_player_burst", results["lol_player_burst"])
+            bot.set_caching(True)
+        if selected is None or "reminder_fire" in selected:
+            results["reminder_fire"] = await reminder_fire(bot, args.fire_count)
+            print_result("reminder_fire", results["reminder_fire"])
+        await bot.wolfram.on_unload()
+        await BaseModule.http.close()
+    BaseModule.parse_pool.close()
+    await server.stop()
+    return results
+
+
+def print_result(name, result):
+    print("{:<22} {:>6} {:>10.1f} {:>9.3f} {:>9.3f} {:>10.1f}".format(
+        name, result["iterations"], result["ops_per_sec"], result["p50_ms"], result["p99_ms"],
+        result["peak_alloc_kib"]))
+
+
+def compare(results, baseline_file):
+    """
+    Prints relative change of throughput and p50 latency against stored results.
+    :param results: results of current run.
+    :param baseline_file: path of stored results file.
+    :return: no return value.
+    """
+    with open(baseline_file) as stored:
+        baseline = json.load(stored)
+    print("\nCompared to " + baseline.get("revision", "?") + " (" + baseline.get("timestamp", "?") + ")")
+    print("{:<22} {:>12} {:>12}".format("benchmark", "ops/s", "p50"))
+    for name, result in results.items():
+        old = baseline["results"].get(name)
+        if old is None:
+            continue
+        ops_change = (result["ops_per_sec"] / old["ops_per_sec"] - 1) * 100 if old["ops_per_sec"] else 0.0
+        p50_change = (result["p50_ms"] / old["p50_ms"] - 1) * 100 if old["p50_ms"] else 0.0
+        print("{:<22} {:>+11.1f}% {:>+11.1f}%".format(name, ops_change, p50_change))
+
+
+def save(results, args):
+    os.makedirs(RESULTS_PATH, exist_ok=True)
+    timestamp = datetime.now().strftime("%Y%m%d-%H%M%S")
+    document = {"timestamp": timestamp, "revision": git_revision(), "iterations": args.iterations,
+                "delay": args.delay, "results": results}
+    path = os.path.join(RESULTS_PATH, timestamp + ".json")
+    with open(path, "w") as result_file:
+        json.dump(document, result_file, indent=2, sort_keys=True)
+    return path
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run offline benchmarks of modular_bot.")
+    parser.add_argument("--iterations", type=int, default=200, help="timed runs per benchmark")
+    parser.add_argument("--alloc-iterations", type=int, default=20, help="runs traced for allocation")
+    parser.add_argument("--delay", type=float, default=0.0, help="seconds of simulated upstream latency")
+    parser.add_argument("--burst", type=int, default=50, help="messages sent at once in burst benchmark")
+    parser.add_argument("--fire-count", type=int, default=1000, help="reminders due at once in fire benchmark")
+    parser.add_argument("--parse-processes", type=int, default=0,
+                        help="parser processes of command benchmarks; 0 parses on threads")
+    parser.add_argument("--only", help="comma separated names of benchmarks to run")
+    parser.add_argument("--compare", help="stored results file to compare with")
+    parser.add_argument("--no-save", action="store_true", help="do not store results")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.ERROR)  # rejected commands of burst are expected
+    print("{:<22} {:>6} {:>10} {:>9} {:>9} {:>10}".format("benchmark", "iters", "ops/s", "p50 ms", "p99 ms",
+                                                          "alloc KiB"))
+    results = asyncio.get_event_loop().run_until_complete(run(args))
+    if not args.no_save:
+        print("\nResults saved to " + save(results, args))
+    if args.compare:
+        compare(results, args.compare)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,3 +1,12 @@
+import time
+from urllib.parse import urlsplit
+from modular_bot.http_client import HttpClient, FetchError
+from modular_bot.cache import TTLCache, SingleFlight, request_key
+from modular_bot.metrics import MetricsRegistry
+from modular_bot.outbound import Outbox
+from modular_bot.parse_pool import ParsePool
+
+
 class BaseModule:
     """
     Base module class to be extended by feature modules.
@@ -7,13 +16,40 @@ class BaseModule:
     module_name = ''
     module_description = ''
     commands = []
+    # Command name to name of handler method; handlers receive a Command instance
+    command_handlers = {}
+    # Number of commands of the module allowed to run at once and to wait for a free slot
+    max_concurrency = 4
+    max_backlog = 16
+    # Seconds to keep fetched pages and parsed results in cache; 0 disables caching
+    cache_ttl = 0
+    # Shared by all modules; pooled connections and cached pages are reused between commands
+    http = HttpClient()
+    response_cache = TTLCache(max_entries=1024, max_bytes=32 * 1024 * 1024)
+    # Parsed records are small, and their memory use can't be measured cheaply; only their number is bounded
+    parsed_cache = TTLCache(max_entries=1024, max_bytes=None)
+    # Identical lookups in flight at the same time share one upstream request
+    in_flight = SingleFlight()
+    # Messages go out through per-channel queues paced to Discord rate limits
+    outbound = Outbox()
+    # Parsers run here, in worker processes if configured, so pages are never parsed on the event loop
+    parse_pool = ParsePool()
+    # Latency, error and cache metrics of the whole bot
+    metrics = MetricsRegistry()
+    # ModuleRegistry of the bot, for modules managing other modules; set on startup
+    registry = None
 
-    def __init__(self, user_cmd_char):
+    def __init__(self, user_cmd_char, settings=None):
         """
-        Sets command prefix while initializing.
+        Sets command prefix and module settings while initializing.
         :param user_cmd_char: command prefix.
+        :param settings: optional dictionary-like config section named after the module class.
         """
         self.command_char = user_cmd_char
+        self.settings = settings if settings is not None else {}
+        self.max_concurrency = int(self.settings.get("max_concurrency", self.max_concurrency))
+        self.max_backlog = int(self.settings.get("max_backlog", self.max_backlog))
+        self.cache_ttl = float(self.settings.get("cache_ttl", self.cache_ttl))
 
     def get_module_name(self):
         """
@@ -36,11 +72,139 @@ class BaseModule:
         """
         return self.commands
 
+    async def on_ready(self, client):
+        """
+        Called when bot has connected and is ready. May be called again after reconnecting.
+        To be implemented on subclasses which need client outside of commands.
+        :param client: discord.Client instance.
+        :return: no return value.
+        """
+        pass
+
+    def export_state(self):
+        """
+        Hands state of the module over to a new instance when module is reloaded. Instance must not use exported
+        resources afterwards, except from commands already running.
+        To be implemented on subclasses which keep state worth preserving.
+        :return: state object passed to restore_state of new instance, or None.
+        """
+        return None
+
+    def restore_state(self, state):
+        """
+        Takes over state exported by previous instance of the module. Called before new instance receives commands.
+        :param state: object returned by export_state, never None.
+        :return: no return value.
+        """
+        pass
+
+    async def on_unload(self):
+        """
+        Called after module is unloaded or replaced and its running commands have finished. Releases resources not
+        handed over by export_state.
+        :return: no return value.
+        """
+        pass
+
+    def get_command_handler(self, command_name):
+        """
+        Returns bound handler method of given command. Modules without command_handlers fall back to parse_command.
+        :param command_name: name of the command without prefix.
+        :return: coroutine function taking Command instance.
+        """
+        handler_name = self.command_handlers.get(command_name)
+        if handler_name is None:
+            return self.run_parse_command
+        return getattr(self, handler_name)
+
+    async def run_parse_command(self, command):
+        """
+        Calls parse_command with bundle built from command, for modules which do not declare command_handlers.
+        :param command: Command instance.
+        :return: no return value.
+        """
+        await self.parse_command(command.to_bundle())
+
     async def parse_command(self, bundle):
         """
         Decides which command should be executed and calls it.
-        To be implemented on subclasses.
+        Only used by modules which do not declare command_handlers.
         :param bundle Dictionary passed in from caller.
         :return: no return value.
         """
         pass
+
+    async def fetch(self, url, params=None, headers=None, timeout=None, ttl=None):
+        """
+        Fetches url through shared HTTP client without blocking event loop. Successful responses are kept in shared
+        response cache for ttl seconds, and concurrent requests for the same url are coalesced into one.
+        :param url: target url.
+        :param params: optional dictionary of query parameters.
+        :param headers: optional dictionary of request headers.
+        :param timeout: optional timeout in seconds overriding the default.
+        :param ttl: optional seconds to cache the response, overriding cache_ttl of the module.
+        :return: HttpResponse instance.
+        """
+        if ttl is None:
+            ttl = self.cache_ttl
+        key = request_key(url, params)
+        if ttl > 0:
+            response = self.response_cache.get(key)
+            if response is not None:
+                return response
+        return await self.in_flight.do(("fetch", key), lambda: self.fetch_and_store(key, url, params, headers, timeout,
+                                                                                      ttl))
+
+    async def fetch_and_store(self, key, url, params, headers, timeout, ttl):
+        """
+        Sends request and stores successful response in cache. Called through fetch.
+        :return: HttpResponse instance.
+        """
+        host = urlsplit(url).hostname
+        started = time.perf_counter()
+        try:
+            response = await self.http.get(url, params=params, headers=headers, timeout=timeout)
+        except FetchError:
+            self.metrics.count_fetch_error(host)
+            raise
+        self.metrics.observe_fetch(host, time.perf_counter() - started)
+        if response.status == 200:
+            self.response_cache.put(key, response, ttl, len(response.content))
+        return response
+
+    async def fetch_parsed(self, url, parser, params=None, headers=None, timeout=None, ttl=None):
+        """
+        Fetches url and parses response with given parser. Parsed result is cached by url and parser, so commands
+        reading the same page share one fetch and one parse. Concurrent calls for the same page share one parse.
+        :param url: target url.
+        :param parser: module-level function taking HttpResponse and returning picklable parsed result, or None if
+                       page can't be parsed. It may run in another process.
+        :param params: optional dictionary of query parameters.
+        :param headers: optional dictionary of request headers.
+        :param timeout: optional timeout in seconds overriding the default.
+        :param ttl: optional seconds to cache the result, overriding cache_ttl of the module.
+        :return: parsed result, or None if parser could not parse the page.
+        """
+        if ttl is None:
+            ttl = self.cache_ttl
+        key = (parser.__module__ + "." + parser.__name__, request_key(url, params))
+        if ttl > 0:
+            parsed = self.parsed_cache.get(key)
+            if parsed is not None:
+                return parsed
+        return await self.in_flight.do(key, lambda: self.fetch_and_parse(key, url, parser, params, headers, timeout,
+                                                                          ttl))
+
+    async def fetch_and_parse(self, key, url, parser, params, headers, timeout, ttl):
+        """
+        Fetches page and parses it in parse pool, then stores parsed result in cache. Called through fetch_parsed.
+        :return: parsed result, or None if parser could not parse the page.
+        """
+        response = await self.fetch(url, params=params, headers=headers, timeout=timeout, ttl=ttl)
+        # Parsing is CPU work; run it off the event loop
+        started = time.perf_counter()
+        parsed = await self.parse_pool.run(parser, response)
+        self.metrics.observe_parse(key[0], time.perf_counter() - started)
+        if parsed is not None:
+            self.parsed_cache.put(key, parsed, ttl, 0)
+        return parsed
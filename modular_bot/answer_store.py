@@ -0,0 +1,190 @@
+import asyncio
+import hashlib
+import logging
+import os
+import sqlite3
+import time
+from collections import Counter, namedtuple
+from concurrent.futures import ThreadPoolExecutor
+
+# status is HTTP status of the upstream answer; text is set for text answers, path of the blob file for stored binary
+# ones. content holds bytes of binary answers, read on the store thread so a later prune can't remove them first
+StoredAnswer = namedtuple("StoredAnswer", ["status", "text", "path", "content"])
+
+
+class AnswerStore:
+    """
+    Persistent cache of upstream answers keyed by kind and normalized query. Rows live in SQLite; binary answers such
+    as images are stored once as files named after SHA-256 of their content, so identical images of different queries
+    share one file on disk. Expired rows, then least recently used rows are pruned periodically until blobs fit in
+    max_bytes, and blob files no longer referenced are removed.
+    All database and file work runs on a single background thread.
+    """
+    def __init__(self, database, directory, max_bytes=256 * 1024 * 1024, prune_interval=3600.0):
+        """
+        :param database: path of database file.
+        :param directory: directory of blob files.
+        :param max_bytes: maximum total size of blob files.
+        :param prune_interval: minimum seconds between prunes.
+        """
+        self.database = database
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.prune_interval = prune_interval
+        self.connection = None
+        self.executor = ThreadPoolExecutor(max_workers=1)  # database and blobs are only used from this thread
+        self.open_task = None
+        self.last_prune = 0.0
+        self.hits = 0
+        self.misses = 0
+
+    async def open(self):
+        """
+        Opens database on first call and prunes it; concurrent calls share one open.
+        :return: no return value.
+        """
+        if self.open_task is None:
+            self.open_task = asyncio.ensure_future(self.run(self.open_database))
+        await asyncio.shield(self.open_task)
+
+    async def run(self, function, *args):
+        return await asyncio.get_event_loop().run_in_executor(self.executor, function, *args)
+
+    def open_database(self):
+        """
+        Opens database, creating table if needed, and prunes expired answers. Runs on store thread.
+        :return: no return value.
+        """
+        os.makedirs(self.directory, exist_ok=True)
+        self.connection = sqlite3.connect(self.database, check_same_thread=False)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=NORMAL")  # losing last answers on power loss is harmless
+        self.connection.execute("CREATE TABLE IF NOT EXISTS answers (kind TEXT NOT NULL, query TEXT NOT NULL, "
+                                "status INTEGER NOT NULL, text TEXT, digest TEXT, size INTEGER NOT NULL, "
+                                "expires_at REAL NOT NULL, used_at REAL NOT NULL, PRIMARY KEY (kind, query))")
+        self.connection.execute("CREATE INDEX IF NOT EXISTS answers_used_at ON answers (used_at)")
+        self.connection.commit()
+        self.prune()
+
+    def blob_path(self, digest):
+        return os.path.join(self.directory, digest[:2], digest)
+
+    async def get(self, kind, query):
+        """
+        Looks up answer which has not expired and marks it as recently used.
+        :param kind: kind of answer, like name of the upstream endpoint.
+        :param query: normalized query.
+        :return: StoredAnswer instance, or None if answer is not stored.
+        """
+        await self.open()
+        answer = await self.run(self.lookup, kind, query)
+        if answer is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return answer
+
+    def lookup(self, kind, query):
+        now = time.time()
+        row = self.connection.execute("SELECT status, text, digest FROM answers WHERE kind = ? AND query = ? AND "
+                                      "expires_at > ?", (kind, query, now)).fetchone()
+        if row is None:
+            return None
+        path = None
+        content = None
+        if row[2] is not None:
+            path = self.blob_path(row[2])
+            try:
+                with open(path, "rb") as blob_file:
+                    content = blob_file.read()
+            except FileNotFoundError:  # blob removed by hand
+                return None
+        with self.connection:
+            self.connection.execute("UPDATE answers SET used_at = ? WHERE kind = ? AND query = ?", (now, kind, query))
+        return StoredAnswer(row[0], row[1], path, content)
+
+    async def put(self, kind, query, status, ttl, text=None, content=None):
+        """
+        Stores answer for ttl seconds. Binary content is written to its blob file unless that file exists already.
+        :param kind: kind of answer, like name of the upstream endpoint.
+        :param query: normalized query.
+        :param status: HTTP status of the answer.
+        :param ttl: seconds to keep the answer.
+        :param text: optional text of the answer.
+        :param content: optional bytes of the answer.
+        :return: StoredAnswer instance of stored answer.
+        """
+        await self.open()
+        return await self.run(self.store, kind, query, status, ttl, text, content)
+
+    def store(self, kind, query, status, ttl, text, content):
+        now = time.time()
+        digest = None
+        path = None
+        size = len(text.encode()) if text is not None else 0
+        if content is not None:
+            digest = hashlib.sha256(content).hexdigest()
+            path = self.blob_path(digest)
+            size = len(content)
+            if not os.path.exists(path):
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                temporary_path = path + ".tmp"
+                with open(temporary_path, "wb") as blob_file:
+                    blob_file.write(content)
+                os.replace(temporary_path, path)  # blob appears atomically
+        with self.connection:
+            self.connection.execute("INSERT OR REPLACE INTO answers (kind, query, status, text, digest, size, "
+                                    "expires_at, used_at) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                                    (kind, query, status, text, digest, size, now + ttl, now))
+        if now - self.last_prune >= self.prune_interval:
+            self.prune()
+        return StoredAnswer(status, text, path, content)
+
+    def prune(self):
+        """
+        Removes expired answers, then least recently used answers until blobs fit in max_bytes, then blob files no
+        answer refers to. Runs on store thread.
+        :return: no return value.
+        """
+        started = time.perf_counter()
+        self.last_prune = time.time()
+        with self.connection:
+            expired = self.connection.execute("DELETE FROM answers WHERE expires_at <= ?", (self.last_prune,)).rowcount
+            rows = self.connection.execute("SELECT kind, query, digest, size FROM answers WHERE digest IS NOT NULL "
+                                           "ORDER BY used_at").fetchall()
+            references = Counter(row[2] for row in rows)
+            total = sum(dict((row[2], row[3]) for row in rows).values())
+            evicted = []
+            for kind, query, digest, size in rows:
+                if total <= self.max_bytes:
+                    break
+                evicted.append((kind, query))
+                references[digest] -= 1
+                if references[digest] == 0:
+                    total -= size
+            self.connection.executemany("DELETE FROM answers WHERE kind = ? AND query = ?", evicted)
+        removed = 0
+        for root, _, files in os.walk(self.directory):
+            for name in files:
+                if references[name] <= 0:  # unreferenced blob, or temporary file left by a crash
+                    try:
+                        os.remove(os.path.join(root, name))
+                        removed += 1
+                    except OSError:  # blob being sent on Windows
+                        continue
+        logging.info("Pruned answer store in " + "{:.0f}".format((time.perf_counter() - started) * 1000) + " ms: " +
+                     str(expired) + " expired, " + str(len(evicted)) + " evicted, " + str(removed) + " files removed")
+
+    async def close(self):
+        """
+        Waits for pending work and closes database.
+        :return: no return value.
+        """
+        if self.open_task is not None:
+            try:
+                await self.open_task
+            except Exception:
+                pass
+        if self.connection is not None:
+            await self.run(self.connection.close)
+            self.connection = None
@@ -0,0 +1,209 @@
+import threading
+from collections import deque
+import discord
+import numpy
+
+# Discord voice frame: 20 ms of 48 kHz 16-bit stereo PCM
+SAMPLES_PER_FRAME = 960
+CHANNELS = 2
+FRAME_BYTES = SAMPLES_PER_FRAME * CHANNELS * 2
+# Position of each sample inside a frame, from 0 to just below 1; gain ramps are interpolated along it
+FRAME_POSITIONS = (numpy.arange(SAMPLES_PER_FRAME, dtype=numpy.float32) / SAMPLES_PER_FRAME)[:, None]
+
+
+def frames_for(seconds):
+    """
+    Converts duration to number of frames.
+    :param seconds: duration in seconds.
+    :return: number of 20 ms frames, at least 0.
+    """
+    return max(0, int(round(seconds * 50)))
+
+
+def to_samples(frame):
+    """
+    Converts PCM frame to float samples. Short frames at end of stream are padded with silence.
+    :param frame: bytes of 16-bit stereo PCM, at most FRAME_BYTES long.
+    :return: float32 array of shape (SAMPLES_PER_FRAME, CHANNELS).
+    """
+    if len(frame) < FRAME_BYTES:
+        frame = frame + b"\x00" * (FRAME_BYTES - len(frame))
+    return numpy.frombuffer(frame, dtype=numpy.int16).reshape(SAMPLES_PER_FRAME, CHANNELS).astype(numpy.float32)
+
+
+def to_frame(samples):
+    """
+    Converts float samples back to PCM frame, clipping values out of 16-bit range.
+    :param samples: float32 array of shape (SAMPLES_PER_FRAME, CHANNELS).
+    :return: bytes of 16-bit stereo PCM.
+    """
+    return numpy.clip(samples, -32768, 32767).astype(numpy.int16).tobytes()
+
+
+def gain_curve(start, end):
+    """
+    Returns gain to multiply a frame with, ramping linearly from start to end across the frame.
+    :param start: gain at first sample.
+    :param end: gain after last sample.
+    :return: float for constant gain, or float32 array of shape (SAMPLES_PER_FRAME, 1).
+    """
+    if start == end:
+        return start
+    return start + (end - start) * FRAME_POSITIONS
+
+
+def crossfade_curves(position, length):
+    """
+    Returns equal-power fade out and fade in gains of a frame inside a crossfade.
+    :param position: index of the frame inside crossfade.
+    :param length: number of frames of crossfade.
+    :return: tuple of fade out and fade in gains, float32 arrays of shape (SAMPLES_PER_FRAME, 1).
+    """
+    progress = (position + FRAME_POSITIONS) * (numpy.float32(numpy.pi / 2) / length)
+    return numpy.cos(progress), numpy.sin(progress)
+
+
+class GainRamp:
+    """
+    Gain moving linearly to its target over a fixed number of frames, so changes never click.
+    """
+    def __init__(self, value, ramp_frames):
+        """
+        :param value: initial gain.
+        :param ramp_frames: number of frames a change takes.
+        """
+        self.value = value
+        self.target = value
+        self.ramp_frames = ramp_frames
+        self.step = 0.0
+
+    def set_target(self, target):
+        self.target = target
+        if self.ramp_frames <= 0:
+            self.value = target
+            self.step = 0.0
+        else:
+            self.step = (target - self.value) / self.ramp_frames
+
+    def advance(self):
+        """
+        Moves gain by one frame.
+        :return: tuple of gain at start and at end of the frame.
+        """
+        start = self.value
+        if start != self.target:
+            end = start + self.step
+            if (self.step > 0 and end >= self.target) or (self.step < 0 and end <= self.target) or self.step == 0:
+                end = self.target
+            self.value = end
+        return start, self.value
+
+
+class EffectsSource(discord.AudioSource):
+    """
+    Applies volume ramps, ducking and crossfade to a PCM audio source, one whole 20 ms frame at a time with NumPy.
+    Source is read ahead by crossfade length, so the end of the song is known before it is played. From that moment
+    the next song can be handed over; remaining frames of this song then fade out while the next one fades in, and
+    reads are passed on to the next song until player switches to it.
+    read runs on player thread of discord.py; other methods run on event loop thread.
+    """
+    def __init__(self, original, volume=1.0, ducking=1.0, ramp_frames=0, tail_frames=0):
+        """
+        :param original: discord.AudioSource producing PCM.
+        :param volume: initial volume.
+        :param ducking: initial ducking gain, 1.0 when not ducked.
+        :param ramp_frames: number of frames volume and ducking changes take.
+        :param tail_frames: number of frames read ahead, which is also the longest crossfade.
+        """
+        self.original = original
+        self.gain = GainRamp(volume, ramp_frames)
+        self.ducking = GainRamp(ducking, ramp_frames)
+        self.tail_frames = tail_frames
+        self.lookahead = deque()  # frames read from original but not played yet
+        self.exhausted = False
+        self.incoming = None  # EffectsSource of next song during crossfade
+        self.fade_position = 0
+        self.fade_length = 0
+        self.on_ending = None  # called once original is exhausted; remaining lookahead can be crossfaded
+        self.on_handed_over = None  # called once crossfade is done and player should switch to incoming
+        self.lock = threading.Lock()
+        self.cleaned_up = False
+
+    @property
+    def volume(self):
+        return self.gain.target
+
+    @volume.setter
+    def volume(self, value):
+        self.gain.set_target(value)
+
+    def duck(self, level):
+        self.ducking.set_target(level)
+
+    def is_opus(self):
+        return False
+
+    def fill(self):
+        """
+        Reads original until lookahead holds tail_frames frames, at most two frames per call so a slow stream never
+        holds up playback.
+        :return: no return value.
+        """
+        reads = 2 if len(self.lookahead) < self.tail_frames else 1
+        for _ in range(reads):
+            if self.exhausted:
+                return
+            frame = self.original.read()
+            if frame:
+                self.lookahead.append(frame)
+            if len(frame) < FRAME_BYTES:
+                self.exhausted = True
+                if self.on_ending is not None:
+                    self.on_ending()
+
+    def read(self):
+        with self.lock:
+            if self.incoming is not None and self.fade_position >= self.fade_length:
+                return self.incoming.read()  # until player switches to incoming
+            self.fill()
+            if not self.lookahead:
+                return b""
+            frame = self.lookahead.popleft()
+            volume_start, volume_end = self.gain.advance()
+            duck_start, duck_end = self.ducking.advance()
+            if self.incoming is None and volume_start == volume_end == 1.0 and duck_start == duck_end == 1.0 and \
+                    len(frame) == FRAME_BYTES:
+                return frame
+            samples = to_samples(frame)  # fresh array, so it is scaled in place
+            samples *= gain_curve(volume_start * duck_start, volume_end * duck_end)
+            if self.incoming is not None:
+                fade_out, fade_in = crossfade_curves(self.fade_position, self.fade_length)
+                samples *= fade_out
+                incoming = to_samples(self.incoming.read())
+                incoming *= fade_in
+                samples += incoming
+                self.fade_position += 1
+                if self.fade_position >= self.fade_length and self.on_handed_over is not None:
+                    self.on_handed_over()
+            return to_frame(samples)
+
+    def hand_over(self, incoming, on_handed_over):
+        """
+        Starts crossfade into next song over frames left in lookahead. Only possible once original is exhausted.
+        :param incoming: EffectsSource of next song.
+        :param on_handed_over: function called from player thread when crossfade is done.
+        :return: True if crossfade started, False if this song has nothing left to fade out.
+        """
+        with self.lock:
+            if not self.exhausted or self.incoming is not None or not self.lookahead:
+                return False
+            self.incoming = incoming
+            self.fade_position = 0
+            self.fade_length = len(self.lookahead)
+            self.on_handed_over = on_handed_over
+            return True
+
+    def cleanup(self):
+        if not self.cleaned_up:
+            self.cleaned_up = True
+            self.original.cleanup()
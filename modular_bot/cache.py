@@ -0,0 +1,170 @@
+import asyncio
+import time
+from collections import OrderedDict
+from urllib.parse import urlencode
+
+
+def request_key(url, params=None):
+    """
+    Builds cache key of a request from url and query parameters.
+    :param url: target url.
+    :param params: optional dictionary of query parameters.
+    :return: key in string.
+    """
+    if not params:
+        return url
+    return url + "?" + urlencode(sorted(params.items()))
+
+
+class TTLCache:
+    """
+    In-memory cache with per-entry time-to-live and least-recently-used eviction. Size is bounded by number of
+    entries and, unless max_bytes is None, by total size of values in bytes.
+    """
+    def __init__(self, max_entries=1024, max_bytes=32 * 1024 * 1024):
+        """
+        :param max_entries: maximum number of entries kept.
+        :param max_bytes: maximum total size of entries in bytes, or None to bound cache by number of entries only.
+        """
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()  # key -> (expire time, value, size); least recently used first
+        self.total_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def configure(self, section, prefix=""):
+        """
+        Updates limits from config section.
+        :param section: dictionary-like config section.
+        :param prefix: prefix of option names, for several caches configured in one section.
+        :return: no return value.
+        """
+        self.max_entries = int(section.get(prefix + "max_entries", self.max_entries))
+        max_bytes = section.get(prefix + "max_bytes", self.max_bytes)
+        self.max_bytes = None if max_bytes is None else int(max_bytes)
+        self.evict()
+
+    def get(self, key, default=None):
+        """
+        Returns cached value and marks it as recently used. Expired entries are dropped.
+        :param key: key of the entry.
+        :param default: value returned on miss.
+        :return: cached value, or default if key is not cached or expired.
+        """
+        entry = self.entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return default
+        if entry[0] <= time.monotonic():
+            self.remove(key)
+            self.misses += 1
+            return default
+        self.entries.move_to_end(key)
+        self.hits += 1
+        return entry[1]
+
+    def put(self, key, value, ttl, size=1):
+        """
+        Stores value for ttl seconds, evicting least recently used entries if cache is full.
+        :param key: key of the entry.
+        :param value: value to store.
+        :param ttl: time to live in seconds. Value is not stored if ttl is not positive.
+        :param size: size of the value in bytes.
+        :return: no return value.
+        """
+        if ttl <= 0 or (self.max_bytes is not None and size > self.max_bytes):
+            return
+        self.remove(key)
+        self.entries[key] = (time.monotonic() + ttl, value, size)
+        self.total_bytes += size
+        self.evict()
+
+    def remove(self, key):
+        """
+        Removes entry if it exists.
+        :param key: key of the entry.
+        :return: no return value.
+        """
+        entry = self.entries.pop(key, None)
+        if entry is not None:
+            self.total_bytes -= entry[2]
+
+    def evict(self):
+        """
+        Drops least recently used entries until cache fits in its limits.
+        :return: no return value.
+        """
+        while self.entries and (len(self.entries) > self.max_entries or
+                                (self.max_bytes is not None and self.total_bytes > self.max_bytes)):
+            _, entry = self.entries.popitem(last=False)
+            self.total_bytes -= entry[2]
+            self.evictions += 1
+
+    def clear(self):
+        """
+        Removes all entries. Counters are kept.
+        :return: no return value.
+        """
+        self.entries.clear()
+        self.total_bytes = 0
+
+    def stats(self):
+        """
+        Returns counters of the cache.
+        :return: Dictionary of hits, misses, lookups, hit rate in percent, evictions, number of entries and size in
+                 bytes.
+        """
+        lookups = self.hits + self.misses
+        return {"hits": self.hits, "misses": self.misses, "lookups": lookups,
+                "hit_rate": 0.0 if lookups == 0 else self.hits * 100.0 / lookups, "evictions": self.evictions,
+                "entries": len(self.entries), "bytes": self.total_bytes}
+
+
+class SingleFlight:
+    """
+    De-duplicates identical concurrent calls. While a call for a key is in flight, other callers with the same key
+    await the same pending call and share its result or exception.
+    """
+    def __init__(self):
+        self.calls = {}
+        self.executed = 0
+        self.shared = 0
+
+    async def do(self, key, function):
+        """
+        Runs function for key, or joins call already in flight for the same key.
+        :param key: key identifying the call.
+        :param function: coroutine function without arguments.
+        :return: result of the call.
+        """
+        future = self.calls.get(key)
+        if future is None:
+            future = asyncio.ensure_future(function())
+            self.calls[key] = future
+            future.add_done_callback(lambda done: self.finish(key, done))
+            self.executed += 1
+        else:
+            self.shared += 1
+        # Cancelling one caller must not cancel the call other callers are waiting for
+        return await asyncio.shield(future)
+
+    def finish(self, key, future):
+        """
+        Removes finished call so next caller starts a new one.
+        :param key: key of the call.
+        :param future: finished future of the call.
+        :return: no return value.
+        """
+        if self.calls.get(key) is future:
+            del self.calls[key]
+        if not future.cancelled():
+            future.exception()  # mark exception as retrieved even if every caller was cancelled
+
+    def stats(self):
+        """
+        Returns counters of coalesced calls.
+        :return: Dictionary of executed calls, calls that joined an executed one and calls in flight.
+        """
+        return {"executed": self.executed, "shared": self.shared, "in_flight": len(self.calls)}
@@ -0,0 +1,95 @@
+from modular_bot.module_registry import ModuleSpec
+
+
+class Command:
+    """
+    Command parsed from a message. Passed to handler methods of modules instead of raw message content.
+    """
+    __slots__ = ("name", "args", "message", "client", "vchannel")
+
+    def __init__(self, name, args, message, client=None, vchannel=None):
+        """
+        :param name: command term without prefix.
+        :param args: rest of the message after command term, stripped of surrounding whitespace.
+        :param message: discord.Message instance.
+        :param client: discord.Client instance.
+        :param vchannel: id of voice channel from config.
+        """
+        self.name = name
+        self.args = args
+        self.message = message
+        self.client = client
+        self.vchannel = vchannel
+
+    @property
+    def channel(self):
+        return self.message.channel
+
+    @property
+    def author(self):
+        return self.message.author
+
+    def split_args(self, maxsplit=-1):
+        """
+        Splits arguments by whitespace.
+        :param maxsplit: maximum number of splits, same as str.split.
+        :return: list of arguments in string.
+        """
+        return self.args.split(maxsplit=maxsplit)
+
+    def to_bundle(self):
+        """
+        Creates bundle dictionary for modules which still implement parse_command.
+        :return: Dictionary with client, message and voice channel.
+        """
+        return {"client": self.client, "message": self.message, "vchannel": self.vchannel}
+
+
+class CommandRouter:
+    """
+    Routing table built once from enabled modules. Parses each message in a single pass and resolves the bound
+    handler method of the command.
+    """
+    def __init__(self, command_char, listening_channels, command_dict):
+        """
+        :param command_char: command prefix.
+        :param listening_channels: ids of listening text channels, in string or integer.
+        :param command_dict: Dictionary of command name to module instance, or to ModuleSpec of module which is not
+        loaded yet. Commands of such modules resolve to (ModuleSpec, None).
+        """
+        self.command_char = command_char
+        self.prefix_length = len(command_char)
+        self.channel_ids = frozenset(int(channel) for channel in listening_channels if str(channel).strip())
+        self.routes = {}
+        for command_name, module in command_dict.items():
+            handler = None if isinstance(module, ModuleSpec) else module.get_command_handler(command_name)
+            self.routes[command_name] = (module, handler)
+
+    def parse(self, message, client=None, vchannel=None):
+        """
+        Parses message into command if it has command prefix and comes from listening channel.
+        :param message: discord.Message instance.
+        :param client: discord.Client instance.
+        :param vchannel: id of voice channel from config.
+        :return: Command instance, or None if message is not a command for the bot.
+        """
+        if message.channel.id not in self.channel_ids:
+            return None
+        content = message.content
+        if not content.startswith(self.command_char):
+            return None
+        body = content[self.prefix_length:]
+        if len(body) == 0 or body[0].isspace():
+            return Command("", body.strip(), message, client, vchannel)
+        parts = body.split(maxsplit=1)
+        if len(parts) == 1:
+            return Command(parts[0], "", message, client, vchannel)
+        return Command(parts[0], parts[1].strip(), message, client, vchannel)
+
+    def resolve(self, command):
+        """
+        Finds module and handler of the command.
+        :param command: Command instance.
+        :return: tuple of module instance and bound handler method, or None if command does not exist.
+        """
+        return self.routes.get(command.name)
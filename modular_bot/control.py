@@ -0,0 +1,227 @@
+import asyncio
+import json
+import logging
+import time
+from collections import deque
+
+# Control panel protocol: one JSON object per line in both directions, each with a "type".
+# Panel sends "hello" first, then "enable", "disable", "save", "metrics" or "shutdown"; requests carrying an "id"
+# are answered with a "result" of the same id. Bot sends "modules" on attach and after every change, and "log",
+# "status" and "metrics" as they come.
+
+
+def encode_message(message):
+    """
+    Encodes message of control protocol.
+    :param message: dictionary with "type" key.
+    :return: bytes of one line.
+    """
+    return (json.dumps(message, separators=(",", ":")) + "\n").encode("utf-8")
+
+
+def decode_message(line):
+    """
+    Decodes message of control protocol.
+    :param line: bytes of one line.
+    :return: dictionary, or None if line is not a valid message.
+    """
+    try:
+        message = json.loads(line.decode("utf-8"))
+    except ValueError:
+        return None
+    return message if isinstance(message, dict) and isinstance(message.get("type"), str) else None
+
+
+class LogBuffer(logging.Handler):
+    """
+    Logging handler keeping last lines of log for control panels. Lines are numbered, so each panel receives every
+    line once, and a panel attaching later still sees recent history.
+    """
+    def __init__(self, max_lines=5000):
+        """
+        :param max_lines: number of lines kept.
+        """
+        logging.Handler.__init__(self)
+        self.setFormatter(logging.Formatter("[%(asctime)s][%(levelname)s]: %(message)s", datefmt="%Y/%m/%d %H:%M:%S"))
+        self.lines = deque(maxlen=max_lines)  # (number, line)
+        self.next_number = 0
+
+    def emit(self, record):
+        try:
+            line = self.format(record)
+        except Exception:
+            self.handleError(record)
+            return
+        # handle holds handler lock, so numbers are unique
+        self.lines.append((self.next_number, line))
+        self.next_number += 1
+
+    def lines_after(self, number):
+        """
+        Returns lines logged since given line number.
+        :param number: number of first line wanted.
+        :return: tuple of list of lines and number of next line.
+        """
+        kept = list(self.lines)
+        lines = [line for line_number, line in kept if line_number >= number]
+        return lines, kept[-1][0] + 1 if lines else number
+
+
+class ControlServer:
+    """
+    Local socket server letting a control panel running in another process watch and manage the bot. Panels can
+    attach to and detach from running bot at any time; bot never waits on them, and a panel which stops reading is
+    dropped once its send buffer is full.
+    """
+    def __init__(self, client, registry, metrics, log_buffer, host="127.0.0.1", port=9109, token="", interval=0.1,
+                 status_interval=1.0):
+        """
+        :param client: discord.Client instance.
+        :param registry: ModuleRegistry of the bot.
+        :param metrics: MetricsRegistry of the bot.
+        :param log_buffer: LogBuffer attached to root logger.
+        :param host: address to listen on.
+        :param port: port to listen on.
+        :param token: secret panels must send in hello, or empty string to accept any local panel.
+        :param interval: seconds between log updates sent to panels.
+        :param status_interval: seconds between status updates sent to panels.
+        """
+        self.client = client
+        self.registry = registry
+        self.metrics = metrics
+        self.log_buffer = log_buffer
+        self.host = host
+        self.port = port
+        self.token = token
+        self.interval = interval
+        self.status_interval = status_interval
+        self.server = None
+        self.writers = set()
+        self.started_at = time.time()
+
+    async def start(self):
+        """
+        Starts listening. Failure to bind is logged and leaves the bot running without control panel.
+        :return: no return value.
+        """
+        if self.server is not None:
+            return
+        try:
+            self.server = await asyncio.start_server(self.handle, self.host, self.port)
+        except OSError:
+            logging.exception("Could not start control server on " + self.host + ":" + str(self.port))
+            return
+        logging.info("Control panel can attach on " + self.host + ":" + str(self.port))
+
+    async def stop(self):
+        if self.server is not None:
+            self.server.close()
+            for writer in list(self.writers):
+                writer.close()
+            await self.server.wait_closed()
+            self.server = None
+
+    async def handle(self, reader, writer):
+        """
+        Serves one attached panel until it detaches.
+        :param reader: asyncio.StreamReader of the connection.
+        :param writer: asyncio.StreamWriter of the connection.
+        :return: no return value.
+        """
+        hello = decode_message(await reader.readline())
+        if hello is None or hello["type"] != "hello" or (self.token and hello.get("token") != self.token):
+            writer.write(encode_message({"type": "error", "error": "Invalid hello or token"}))
+            writer.close()
+            return
+        logging.info("Control panel attached")
+        self.writers.add(writer)
+        writer.write(encode_message(self.modules_message()))
+        push_task = asyncio.ensure_future(self.push(writer))
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                message = decode_message(line)
+                if message is not None:
+                    await self.handle_request(writer, message)
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            push_task.cancel()
+            self.writers.discard(writer)
+            writer.close()
+            logging.info("Control panel detached")
+
+    async def push(self, writer):
+        """
+        Sends new log lines and status to panel periodically.
+        :param writer: asyncio.StreamWriter of the connection.
+        :return: no return value.
+        """
+        number = 0
+        next_status = 0.0
+        try:
+            while True:
+                lines, number = self.log_buffer.lines_after(number)
+                if lines:
+                    writer.write(encode_message({"type": "log", "lines": lines}))
+                if time.monotonic() >= next_status:
+                    writer.write(encode_message(self.status_message()))
+                    next_status = time.monotonic() + self.status_interval
+                if writer.transport.get_write_buffer_size() > 4 * 1024 * 1024:
+                    logging.warning("Control panel is not reading; detaching it")
+                    writer.close()
+                    return
+                await asyncio.sleep(self.interval)
+        except ConnectionError:
+            pass
+
+    async def handle_request(self, writer, message):
+        """
+        Runs request of a panel and answers it.
+        :param writer: asyncio.StreamWriter of the connection.
+        :param message: decoded request.
+        :return: no return value.
+        """
+        kind = message["type"]
+        error = None
+        try:
+            if kind in ("enable", "disable"):
+                spec = self.registry.specs[int(message["index"])]
+                await (self.registry.enable(spec) if kind == "enable" else self.registry.disable(spec))
+                self.broadcast(self.modules_message())
+            elif kind == "save":
+                await asyncio.get_event_loop().run_in_executor(None, self.registry.save)
+            elif kind == "metrics":
+                writer.write(encode_message({"type": "metrics", "text": self.metrics.render()}))
+            elif kind == "shutdown":
+                logging.info("Shutdown requested by control panel")
+                asyncio.ensure_future(self.client.close())
+            else:
+                error = "Unknown request " + kind
+        except Exception as e:
+            logging.exception("Control panel request " + kind + " failed")
+            error = repr(e)
+        if "id" in message:
+            writer.write(encode_message({"type": "result", "id": message["id"], "ok": error is None,
+                                         "error": error}))
+
+    def broadcast(self, message):
+        data = encode_message(message)
+        for writer in list(self.writers):
+            writer.write(data)
+
+    def modules_message(self):
+        return {"type": "modules", "modules": [{"name": spec.get_module_name(),
+                                                "description": spec.get_module_description(),
+                                                "commands": list(spec.get_all_commands()), "enabled": spec.enabled,
+                                                "loaded": spec.instance is not None} for spec in self.registry.specs]}
+
+    def status_message(self):
+        user = self.client.user
+        dispatcher = self.registry.dispatcher
+        return {"type": "status", "user": user.name if user is not None else None, "ready": self.client.is_ready(),
+                "latency": self.client.latency, "guilds": len(self.client.guilds),
+                "running": len(dispatcher.tasks) if dispatcher is not None else 0,
+                "uptime": time.time() - self.started_at}
@@ -0,0 +1,137 @@
+import asyncio
+import logging
+import time
+
+
+class ModuleLane:
+    """
+    Execution lane of a single module. Limits number of commands of the module running at once and number of
+    commands allowed to wait for a free slot.
+    """
+    def __init__(self, module):
+        self.module = module
+        self.semaphore = asyncio.Semaphore(module.max_concurrency)
+        self.capacity = module.max_concurrency + module.max_backlog
+        self.pending = 0  # running and waiting commands
+
+    def is_full(self):
+        """
+        Checks if lane can accept another command.
+        :return: True if both running slots and backlog are taken, False if not.
+        """
+        return self.pending >= self.capacity
+
+
+class CommandDispatcher:
+    """
+    Runs each command as a separate supervised task so slow modules never hold up handling of other messages.
+    Every module gets its own lane, so a noisy module can only use up its own slots.
+    """
+    def __init__(self, metrics=None, outbox=None):
+        """
+        :param metrics: optional MetricsRegistry recording latency, errors and rejections of commands.
+        :param outbox: optional Outbox which failure notices are sent through.
+        """
+        self.lanes = {}
+        self.tasks = set()
+        self.running = {}  # task -> (lane, command)
+        self.metrics = metrics
+        self.outbox = outbox
+
+    def get_lane(self, module):
+        """
+        Returns lane of given module, creating it on first use.
+        :param module: module instance.
+        :return: ModuleLane instance.
+        """
+        lane = self.lanes.get(module)
+        if lane is None:
+            lane = ModuleLane(module)
+            self.lanes[module] = lane
+        return lane
+
+    def submit(self, module, handler, command):
+        """
+        Schedules command for execution on given module.
+        :param module: module instance which executes the command.
+        :param handler: bound handler method of the command.
+        :param command: Command instance passed to the handler.
+        :return: True if command is scheduled, False if it is rejected because backlog of the module is full.
+        """
+        lane = self.get_lane(module)
+        if lane.is_full():
+            if self.metrics is not None:
+                self.metrics.count_rejected(module.get_module_name())
+            return False
+        lane.pending += 1
+        task = asyncio.ensure_future(self.run_command(lane, handler, command, time.perf_counter()))
+        self.tasks.add(task)
+        self.running[task] = (lane, command)
+        task.add_done_callback(self.forget)
+        return True
+
+    def forget(self, task):
+        # Runs for every task, even one cancelled before its coroutine started, so lane count always goes down
+        self.tasks.discard(task)
+        entry = self.running.pop(task, None)
+        if entry is not None:
+            entry[0].pending -= 1
+
+    def describe(self, task):
+        """
+        Returns command run by given task.
+        :param task: asyncio.Task instance.
+        :return: tuple of module name and command name, or None if task is not a command task.
+        """
+        entry = self.running.get(task)
+        if entry is None:
+            return None
+        lane, command = entry
+        return lane.module.get_module_name(), command.name
+
+    async def drain(self, module):
+        """
+        Waits until commands already accepted for module have finished, then drops its lane. Used when module is
+        replaced or unloaded; new commands go to the new instance in the meantime. Command calling drain, like one
+        reloading its own module, is not waited for.
+        :param module: module instance.
+        :return: no return value.
+        """
+        current = asyncio.current_task()
+        tasks = [task for task, (lane, _) in self.running.items() if lane.module is module and task is not current]
+        if tasks:
+            await asyncio.wait(tasks)
+        self.lanes.pop(module, None)
+
+    async def run_command(self, lane, handler, command, accepted):
+        """
+        Waits for free slot of the lane and executes command. Exceptions are logged and reported back to channel
+        instead of being lost inside the task.
+        :param lane: ModuleLane instance of executing module.
+        :param handler: bound handler method of the command.
+        :param command: Command instance passed to the handler.
+        :param accepted: perf_counter value when command was accepted; time spent waiting for a slot counts as latency.
+        :return: no return value.
+        """
+        module_name = lane.module.get_module_name()
+        try:
+            async with lane.semaphore:
+                await handler(command)
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            logging.exception("Command " + command.name + " of module " + module_name + " failed")
+            if self.metrics is not None:
+                self.metrics.count_error(module_name, command.name)
+            try:
+                notice = "Something went wrong while running your command."
+                if self.outbox is not None:
+                    await self.outbox.send(command.channel, notice)
+                else:
+                    await command.channel.send(notice)
+            except Exception:
+                logging.exception("Could not report failure to channel " + command.channel.name)
+        finally:
+            if self.metrics is not None:
+                self.metrics.observe_command(module_name, command.name, time.perf_counter() - accepted)
+
@@ -0,0 +1,64 @@
+from bisect import bisect_left, insort
+
+
+class EventIndex:
+    """
+    Index of reminder events partitioned by guild. Each partition keeps (time, id) pairs of its events in sorted
+    order, so listing or picking an event by index only touches events of one guild.
+    """
+    def __init__(self):
+        self.partitions = {}  # guild id -> sorted list of (time, event id)
+
+    def __len__(self):
+        return sum(len(partition) for partition in self.partitions.values())
+
+    def add(self, event):
+        """
+        Adds event to partition of its guild.
+        :param event: ReminderEvent instance.
+        :return: no return value.
+        """
+        insort(self.partitions.setdefault(event.guild_id, []), (event.time, event.id))
+
+    def remove(self, event):
+        """
+        Removes event from partition of its guild. Empty partitions are dropped.
+        :param event: ReminderEvent instance.
+        :return: no return value.
+        """
+        partition = self.partitions.get(event.guild_id)
+        if partition is None:
+            return
+        position = bisect_left(partition, (event.time, event.id))
+        if position < len(partition) and partition[position] == (event.time, event.id):
+            del partition[position]
+        if not partition:
+            del self.partitions[event.guild_id]
+
+    def count(self, guild_id):
+        """
+        Returns number of events of guild.
+        :param guild_id: id of the guild.
+        :return: number of events in integer.
+        """
+        return len(self.partitions.get(guild_id, ()))
+
+    def event_ids(self, guild_id):
+        """
+        Returns ids of events of guild ordered by time.
+        :param guild_id: id of the guild.
+        :return: list of event ids.
+        """
+        return [event_id for _, event_id in self.partitions.get(guild_id, ())]
+
+    def event_id_at(self, guild_id, index):
+        """
+        Returns id of event at given position in guild's event list.
+        :param guild_id: id of the guild.
+        :param index: zero-based position in the list.
+        :return: id of the event.
+        :raises IndexError: if index is out of bounds.
+        """
+        if index < 0:
+            raise IndexError(index)
+        return self.partitions.get(guild_id, [])[index][1]
@@ -0,0 +1,129 @@
+import asyncio
+import logging
+import sqlite3
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+ReminderEvent = namedtuple("ReminderEvent", ["id", "name", "time", "channel_id", "guild_id"])
+
+
+class EventStore:
+    """
+    Durable store of reminder events backed by SQLite in WAL mode. Writes are queued and committed in batches on a
+    single background thread; each caller awaits the commit of the batch containing its write, so a burst of
+    commands shares one transaction and one fsync.
+    """
+    def __init__(self, path, batch_interval=0.01):
+        """
+        :param path: path of the database file.
+        :param batch_interval: seconds to wait for more writes before committing a batch.
+        """
+        self.path = path
+        self.batch_interval = batch_interval
+        self.connection = None
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self.pending = []  # (sql, parameters, future) waiting for next batch
+        self.flush_task = None
+
+    def open(self):
+        """
+        Opens database and creates table if it does not exist.
+        :return: no return value.
+        """
+        self.connection = sqlite3.connect(self.path, check_same_thread=False)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=FULL")
+        self.connection.execute("CREATE TABLE IF NOT EXISTS events (id INTEGER PRIMARY KEY, name TEXT NOT NULL, "
+                                "time REAL NOT NULL, channel_id INTEGER, guild_id INTEGER)")
+        self.connection.commit()
+
+    async def run(self, function, *args):
+        """
+        Runs function on store thread, after writes being committed.
+        :param function: function using the database, like open or load.
+        :param args: arguments of the function.
+        :return: result of the function.
+        """
+        return await asyncio.get_event_loop().run_in_executor(self.executor, function, *args)
+
+    async def close(self):
+        """
+        Commits queued writes and closes database.
+        :return: no return value.
+        """
+        if self.flush_task is not None:
+            await self.flush_task
+        if self.connection is not None:
+            # runs after any commit still in progress on store thread
+            await asyncio.get_event_loop().run_in_executor(self.executor, self.connection.close)
+            self.connection = None
+
+    def load(self):
+        """
+        Reads all stored events in one query.
+        :return: list of ReminderEvent.
+        """
+        rows = self.connection.execute("SELECT id, name, time, channel_id, guild_id FROM events").fetchall()
+        return [ReminderEvent(row[0], row[1], datetime.fromtimestamp(row[2]), row[3], row[4]) for row in rows]
+
+    def put(self, event):
+        """
+        Inserts or replaces event.
+        :param event: ReminderEvent instance.
+        :return: future resolved when the write is committed.
+        """
+        return self.queue("INSERT OR REPLACE INTO events (id, name, time, channel_id, guild_id) VALUES (?, ?, ?, ?, ?)",
+                          (event.id, event.name, event.time.timestamp(), event.channel_id, event.guild_id))
+
+    def delete(self, event_id):
+        """
+        Deletes event.
+        :param event_id: id of the event.
+        :return: future resolved when the write is committed.
+        """
+        return self.queue("DELETE FROM events WHERE id = ?", (event_id,))
+
+    def queue(self, sql, parameters):
+        """
+        Adds write to next batch and starts flush task if it is not running.
+        :param sql: SQL statement.
+        :param parameters: tuple of statement parameters.
+        :return: future resolved when the write is committed.
+        """
+        future = asyncio.get_event_loop().create_future()
+        self.pending.append((sql, parameters, future))
+        if self.flush_task is None:
+            self.flush_task = asyncio.ensure_future(self.flush())
+        return future
+
+    async def flush(self):
+        """
+        Waits for more writes, then commits all queued writes in a single transaction.
+        :return: no return value.
+        """
+        await asyncio.sleep(self.batch_interval)
+        batch = self.pending
+        self.pending = []
+        self.flush_task = None
+        try:
+            await asyncio.get_event_loop().run_in_executor(self.executor, self.commit, batch)
+        except Exception as e:
+            logging.exception("Failed to commit " + str(len(batch)) + " event store writes")
+            for _, _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+        for _, _, future in batch:
+            if not future.done():
+                future.set_result(None)
+
+    def commit(self, batch):
+        """
+        Executes batch of writes in one transaction. Runs on store thread.
+        :param batch: list of (sql, parameters, future).
+        :return: no return value.
+        """
+        with self.connection:
+            for sql, parameters, _ in batch:
+                self.connection.execute(sql, parameters)
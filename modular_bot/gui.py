@@ -0,0 +1,476 @@
+import argparse
+import itertools
+import logging
+import socket
+import threading
+import time
+from collections import deque
+from tkinter import *
+from tkinter import messagebox
+from tkinter import ttk
+from tkinter import scrolledtext
+from tkinter import colorchooser
+from configobj import ConfigObj
+from modular_bot.control import decode_message, encode_message
+
+
+class LogHandler(logging.Handler):
+    """
+    Class for custom logging handler. Logging message from default logger is passed to this handler and shown in
+    ScrollText widget in GUI. emit only appends formatted message to a bounded buffer, so logging thread never waits
+    on Tk; Tk thread moves buffered messages to the widget in batches and keeps at most max_lines lines. Log lines
+    streamed from the bot are added to the same buffer.
+    """
+    def __init__(self, log_space, max_lines=5000, interval=100):
+        """
+        :param log_space: ScrolledText widget showing log.
+        :param max_lines: maximum number of lines kept in widget and in buffer.
+        :param interval: milliseconds between moving buffered messages to widget.
+        """
+        logging.Handler.__init__(self)
+        fmt = logging.Formatter("[%(asctime)s][%(levelname)s]: %(message)s", datefmt="%Y/%m/%d %H:%M:%S")
+        self.setFormatter(fmt)
+        self.text = log_space
+        self.max_lines = max_lines
+        self.interval = interval
+        # deque append and popleft are atomic; oldest messages are dropped if Tk falls behind
+        self.buffer = deque(maxlen=max_lines)
+
+    def emit(self, record):
+        try:
+            self.buffer.append(self.format(record))
+        except Exception:
+            self.handleError(record)
+
+    def start(self):
+        """
+        Starts moving buffered messages to widget. Must be called from Tk thread.
+        :return: no return value.
+        """
+        self.text.after(self.interval, self.flush_to_widget)
+
+    def flush_to_widget(self):
+        """
+        Inserts buffered messages into widget at once and trims oldest lines. Runs on Tk thread.
+        :return: no return value.
+        """
+        logs = []
+        try:
+            while True:
+                logs.append(self.buffer.popleft())
+        except IndexError:
+            pass
+        if logs:
+            at_bottom = self.text.yview()[1] >= 1.0  # don't scroll away from what user is reading
+            self.text["state"] = "normal"
+            self.text.insert(END, "\n".join(logs) + "\n")
+            lines = int(self.text.index("end-1c").split(".")[0]) - 1
+            if lines > self.max_lines:
+                self.text.delete("1.0", str(lines - self.max_lines + 1) + ".0")
+            self.text["state"] = "disabled"
+            if at_bottom:
+                self.text.see(END)
+        self.text.after(self.interval, self.flush_to_widget)
+
+
+class BotConnection:
+    """
+    Connection of control panel to bot over local socket. A reader thread connects, reconnecting whenever bot is not
+    reachable, and queues received messages; Tk thread takes them with poll and sends requests with send.
+    """
+    def __init__(self, host, port, token="", retry_interval=2.0):
+        """
+        :param host: address of control server of the bot.
+        :param port: port of control server of the bot.
+        :param token: secret sent in hello.
+        :param retry_interval: seconds between connection attempts.
+        """
+        self.host = host
+        self.port = port
+        self.token = token
+        self.retry_interval = retry_interval
+        self.incoming = deque()  # messages received, plus "connected" and "disconnected" events
+        self.sock = None
+        self.lock = threading.Lock()
+        self.closed = False
+        self.request_ids = itertools.count(1)
+
+    def start(self):
+        threading.Thread(target=self.run, daemon=True).start()
+
+    def run(self):
+        """
+        Body of reader thread. Keeps connecting to bot until connection is closed.
+        :return: no return value.
+        """
+        while not self.closed:
+            try:
+                sock = socket.create_connection((self.host, self.port), timeout=5)
+            except OSError:
+                time.sleep(self.retry_interval)
+                continue
+            sock.settimeout(None)
+            with self.lock:
+                self.sock = sock
+            try:
+                sock.sendall(encode_message({"type": "hello", "token": self.token}))
+                self.incoming.append({"type": "connected"})
+                for line in sock.makefile("rb"):
+                    message = decode_message(line)
+                    if message is not None:
+                        self.incoming.append(message)
+            except OSError:
+                pass
+            finally:
+                with self.lock:
+                    self.sock = None
+                sock.close()
+                self.incoming.append({"type": "disconnected"})
+            if not self.closed:
+                time.sleep(self.retry_interval)
+
+    def send(self, message):
+        """
+        Sends request to bot.
+        :param message: dictionary with "type" key.
+        :return: True if request was sent, False if panel is not connected.
+        """
+        with self.lock:
+            if self.sock is None:
+                return False
+            try:
+                self.sock.sendall(encode_message(message))
+            except OSError:
+                return False
+        return True
+
+    def request(self, message):
+        """
+        Sends request whose result is reported back.
+        :param message: dictionary with "type" key.
+        :return: id of the request, or None if panel is not connected.
+        """
+        message["id"] = next(self.request_ids)
+        return message["id"] if self.send(message) else None
+
+    def poll(self):
+        """
+        Takes messages received since last poll.
+        :return: list of messages.
+        """
+        messages = []
+        try:
+            while True:
+                messages.append(self.incoming.popleft())
+        except IndexError:
+            pass
+        return messages
+
+    def close(self):
+        self.closed = True
+        with self.lock:
+            if self.sock is not None:
+                try:
+                    self.sock.shutdown(socket.SHUT_RDWR)
+                except OSError:
+                    pass
+
+
+def gui_setup(connection, config_gui):
+    """
+    Sets up GUI layout and starts TkInter GUI event loop. GUI runs in its own process and knows the bot only through
+    connection, so redrawing never holds up the bot.
+    :param connection: BotConnection instance, not started yet.
+    :param config_gui: dictionary-like [GUI] config section.
+    :return: no return value.
+    """
+    modules_list = []  # modules as last reported by bot
+    pending_saves = set()  # ids of save requests waiting for result
+
+    def sys_exit():
+        """
+        Shuts down the bot and closes panel if user chooses to exit.
+        :return: no return value.
+        """
+        exit_check = messagebox.askyesno("Exit?", "Do you want to shutdown the bot?")
+        if exit_check:
+            if not connection.send({"type": "shutdown"}):
+                messagebox.showerror("Not Connected", "Panel is not connected to the bot.")
+                return
+            detach()
+
+    def detach():
+        """
+        Closes panel. Bot keeps running and panel can attach again later.
+        :return: no return value.
+        """
+        connection.close()
+        window.destroy()
+
+    def open_setting():
+        """
+        Settings menu for GUI. Opens another window on top of main window and show settings. Grabs focus until it is
+        closed by user.
+        :return: no return value.
+        """
+        setting_window = Toplevel()
+        setting_window.title("GUI Settings")
+        setting_window.minsize(480, 270)
+        setting_window.maxsize(480, 270)
+        # Main window not focusable while in settings
+        setting_window.grab_set()
+        setting_notebook = ttk.Notebook(setting_window)
+        # Console theme page
+        console_theme_page = ttk.Frame(setting_notebook)
+        console_bg_label = Label(console_theme_page, text="Background Color: ")
+        console_bg_label.grid(row=0, sticky=E)
+        console_bg_picker = Button(console_theme_page, bg=console_text["bg"],
+                                   width=10, height=1, bd=4, command=lambda: color_picker("bg", console_bg_picker))
+        console_bg_picker.grid(row=0, column=1, sticky=W)
+        console_fg_label = Label(console_theme_page, text="Font Color: ")
+        console_fg_label.grid(row=1, sticky=E)
+        console_fg_picker = Button(console_theme_page, bg=console_text["fg"],
+                                   width=10, height=1, bd=4, command=lambda: color_picker("fg", console_fg_picker))
+        console_fg_picker.grid(row=1, column=1, sticky=W)
+        console_theme_page.rowconfigure(0, weight=1)
+        console_theme_page.rowconfigure(1, weight=1)
+        console_theme_page.columnconfigure(0, weight=1)
+        console_theme_page.columnconfigure(1, weight=1)
+        setting_notebook.add(console_theme_page, text="Console Theme")
+        setting_notebook.pack(side=TOP, fill=BOTH, expand=True)
+
+    def color_picker(target, button):
+        """
+        Shows color picker and updates background / font color of console according to color picked by user.
+        :param target: "bg" for console background, "fg" for console text.
+        :param button: Color picker button widget on settings window.
+        :return: No return value.
+        """
+        if target == "bg":
+            new_color = colorchooser.askcolor(console_text["bg"], parent=button, title="Pick Background Color")
+            if new_color[1] is None:
+                return
+            console_text.configure(bg=new_color[1])
+        else:
+            new_color = colorchooser.askcolor(console_text["fg"], parent=button, title="Pick Font Color")
+            if new_color[1] is None:
+                return
+            console_text.configure(fg=new_color[1])
+        button.configure(bg=new_color[1])
+
+    def checkbox_toggle(index):
+        """
+        Callback from toggle event of checkbox. Asks bot to enable or disable module right away, which also updates
+        its config object. Object is not written to actual config file before user hits Apply button.
+        :param index: Index of module in modules_list
+        :return: no return value.
+        """
+        request = "disable" if modules_list[index]["enabled"] else "enable"
+        if connection.request({"type": request, "index": index}) is None:
+            messagebox.showerror("Not Connected", "Panel is not connected to the bot.")
+
+    def module_onselect(event):
+        """
+        OnSelect event handler. Updates values of text labels every time user selects a module list item.
+        :param event: Select event.
+        :return: no return value.
+        """
+        w = event.widget
+        if not w.curselection():  # list was refreshed
+            return
+        show_module(int(w.curselection()[0]))
+
+    def show_module(selected_idx):
+        """
+        Shows information of module in module description frame.
+        :param selected_idx: Index of module in modules_list.
+        :return: no return value.
+        """
+        for label in module_desc.winfo_children():
+            label.destroy()
+        selected_module = modules_list[selected_idx]
+        # Set name of module
+        module_name = StringVar()
+        module_name.set("Name: " + selected_module["name"])
+        module_name_label = Label(module_desc, textvariable=module_name, wraplength=400,
+                                  justify=LEFT, anchor=W)
+        module_name_label.grid(row=0, sticky=W, padx=5)
+        # Set description of module
+        module_description_str = StringVar()
+        module_description_str.set("Description: \n" + selected_module["description"])
+        module_description_label = Label(module_desc, textvariable=module_description_str, wraplength=470,
+                                         justify=LEFT, anchor=W)
+        module_description_label.grid(row=1, sticky=W, padx=5)
+        # Set commands of module
+        module_command = StringVar()
+        module_command.set("Commands: \n" + ", ".join(selected_module["commands"]))
+        module_command_label = Label(module_desc, textvariable=module_command, wraplength=470,
+                                     justify=LEFT, anchor=W)
+        module_command_label.grid(row=2, sticky=W, padx=5)
+        # Set on/off checkbox
+        module_switch = Checkbutton(module_desc, text="Enabled", command=lambda: checkbox_toggle(selected_idx))
+        if selected_module["enabled"]:
+            module_switch.select()
+        else:
+            module_switch.deselect()
+        module_switch.grid(row=3, sticky=W, padx=5, pady=10)
+
+    def write_config():
+        """
+        Asks bot to write its config object to config file. User is notified when bot reports the result. Module
+        changes are already applied to running bot.
+        :return: no return value.
+        """
+        request_id = connection.request({"type": "save"})
+        if request_id is None:
+            messagebox.showerror("Not Connected", "Panel is not connected to the bot.")
+        else:
+            pending_saves.add(request_id)
+
+    def update_modules(modules):
+        """
+        Replaces module list with list reported by bot, keeping selection.
+        :param modules: list of dictionaries describing modules.
+        :return: no return value.
+        """
+        selection = module_checklist.curselection()
+        modules_list[:] = modules
+        module_checklist.delete(0, END)
+        for i in range(0, len(modules_list)):
+            module_checklist.insert(i, " " + modules_list[i]["name"])
+        if selection and selection[0] < len(modules_list):
+            module_checklist.selection_set(selection[0])
+            show_module(selection[0])
+
+    def process_messages():
+        """
+        Handles messages received from bot since last call. Runs on a timer of Tk thread.
+        :return: no return value.
+        """
+        for message in connection.poll():
+            kind = message["type"]
+            if kind == "log":
+                gui_log_handler.buffer.extend(message["lines"])
+            elif kind == "status":
+                status_text.set(format_status(message))
+            elif kind == "modules":
+                update_modules(message["modules"])
+            elif kind == "metrics":
+                metrics_text["state"] = "normal"
+                metrics_text.delete("1.0", END)
+                metrics_text.insert(END, message["text"])
+                metrics_text["state"] = "disabled"
+            elif kind == "result":
+                if not message["ok"]:
+                    logging.error("Bot could not carry out request: " + str(message["error"]))
+                elif message["id"] in pending_saves:
+                    messagebox.showinfo("Changes Saved", "Changes you made are applied and saved to config file.")
+                pending_saves.discard(message["id"])
+            elif kind == "connected":
+                logging.info("Attached to bot at " + connection.host + ":" + str(connection.port))
+                status_text.set("Attached; waiting for status..")
+            elif kind == "disconnected":
+                status_text.set("Not attached to bot at " + connection.host + ":" + str(connection.port) +
+                                "; retrying..")
+            elif kind == "error":
+                logging.error("Bot refused panel: " + str(message.get("error")))
+        window.after(100, process_messages)
+
+    def refresh_metrics():
+        """
+        Requests metrics from bot while metrics tab is shown.
+        :return: no return value.
+        """
+        if notebook.select() == str(metrics_page):
+            connection.send({"type": "metrics"})
+        window.after(2000, refresh_metrics)
+
+    window = Tk()
+    window.title("TestBot Configuration")
+    window.minsize(800, 450)
+    window.maxsize(800, 450)
+    # Menu bar settings
+    menu_bar = Menu(window)
+    file_menu = Menu(menu_bar, tearoff=0)
+    file_menu.add_command(label="Settings..", command=open_setting)
+    file_menu.add_separator()
+    file_menu.add_command(label="Detach", command=detach)
+    file_menu.add_command(label="Exit..", command=sys_exit)
+    menu_bar.add_cascade(label="File", menu=file_menu)
+    window.config(menu=menu_bar)
+    # Notebook (tabs) settings
+    notebook = ttk.Notebook(window)
+    # Module list tab
+    module_list_page = ttk.Frame(notebook)
+    # List of currently existing modules
+    module_checklist = Listbox(module_list_page, bg="white", relief=SUNKEN, borderwidth=2, activestyle="none",
+                               selectmode=SINGLE, highlightthickness=0, width=40)
+    module_checklist.bind('<<ListboxSelect>>', module_onselect)
+    # Module description & apply button
+    module_desc = LabelFrame(module_list_page, text="Module Information")
+    module_apply = Button(module_list_page, text="Apply Changes..", width=20, command=write_config)
+    # Grid settings
+    module_checklist.grid(column=0, row=0, sticky=N + S + E + W, padx=5, pady=5, rowspan=2)
+    module_desc.grid(column=1, row=0, sticky=N + S + E + W, padx=5, pady=5)
+    module_apply.grid(column=1, row=1, sticky=N + S, padx=5, pady=5)
+    module_list_page.columnconfigure(1, weight=1)
+    module_list_page.rowconfigure(0, weight=1)
+    # Console tab
+    console_page = ttk.Frame(notebook)
+    console_text = scrolledtext.ScrolledText(console_page, state="disabled", wrap="none", bg="black", fg="lawn green")
+    console_text.pack(fill=BOTH, expand=True, padx=5, pady=5)
+    gui_log_handler = LogHandler(console_text, int(config_gui.get("console_max_lines", 5000)),
+                                 int(config_gui.get("console_refresh_interval", 100)))
+    logging.getLogger().addHandler(gui_log_handler)
+    gui_log_handler.start()
+    # Metrics tab
+    metrics_page = ttk.Frame(notebook)
+    metrics_text = scrolledtext.ScrolledText(metrics_page, state="disabled", wrap="none")
+    metrics_text.pack(fill=BOTH, expand=True, padx=5, pady=5)
+    notebook.add(console_page, text="Console")
+    notebook.add(module_list_page, text="Modules")
+    notebook.add(metrics_page, text="Metrics")
+    notebook.pack(side=TOP, fill=BOTH, expand=True)
+    # Status bar
+    status_text = StringVar()
+    status_text.set("Attaching to bot at " + connection.host + ":" + str(connection.port) + "..")
+    Label(window, textvariable=status_text, anchor=W).pack(side=BOTTOM, fill=X, padx=5)
+    window.protocol("WM_DELETE_WINDOW", detach)
+    connection.start()
+    window.after(100, process_messages)
+    window.after(2000, refresh_metrics)
+    logging.info("GUI loading complete")
+    window.mainloop()
+
+
+def format_status(status):
+    """
+    Formats status reported by bot for status bar.
+    :param status: status message of control protocol.
+    :return: status in string.
+    """
+    if not status["ready"]:
+        return "Bot is connecting to Discord.."
+    uptime = int(status["uptime"])
+    return "Logged in as {} | {} servers | latency {:.0f} ms | {} commands running | up {}:{:02d}:{:02d}".format(
+        status["user"], status["guilds"], status["latency"] * 1000, status["running"], uptime // 3600,
+        uptime // 60 % 60, uptime % 60)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Control panel of modular_bot. Attaches to running bot.")
+    parser.add_argument("--config", default="config.ini", help="config file of the bot")
+    parser.add_argument("--host", help="address of control server, overriding config")
+    parser.add_argument("--port", type=int, help="port of control server, overriding config")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO,
+                        format="[%(asctime)s][%(levelname)s]: %(message)s", datefmt="%Y/%m/%d %H:%M:%S")
+    config_gui = ConfigObj(args.config).get("GUI", {})
+    connection = BotConnection(args.host or config_gui.get("control_host", "127.0.0.1"),
+                               args.port or int(config_gui.get("control_port", 9109)),
+                               config_gui.get("control_token", ""))
+    gui_setup(connection, config_gui)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,121 @@
+import asyncio
+import logging
+from urllib.parse import urlsplit
+import aiohttp
+
+
+class FetchError(Exception):
+    """
+    Raised when an upstream request fails because of a connection error or timeout.
+    """
+    pass
+
+
+class HttpResponse:
+    """
+    Fully read response returned by HttpClient. Body is read before the connection is released back to the pool, so
+    the object can be kept and shared after the request finished.
+    """
+    def __init__(self, url, status, content, encoding):
+        self.url = url
+        self.status = status
+        self.content = content
+        self.encoding = encoding
+
+    @property
+    def text(self):
+        """
+        Decodes body of the response.
+        :return: body of the response in string.
+        """
+        return self.content.decode(self.encoding or "utf-8", errors="replace")
+
+
+class HttpClient:
+    """
+    Non-blocking HTTP client shared by all modules. Keeps a single aiohttp session whose connector pools keep-alive
+    connections per host, and limits number of requests in flight to each host.
+    """
+    def __init__(self, timeout=10.0, limit_per_host=8, keepalive_timeout=30.0):
+        """
+        Sets default limits of the client. Session is created lazily inside running event loop.
+        :param timeout: default total timeout of a request in seconds.
+        :param limit_per_host: default maximum number of concurrent requests to one host.
+        :param keepalive_timeout: seconds to keep idle connection open for reuse.
+        """
+        self.timeout = timeout
+        self.limit_per_host = limit_per_host
+        self.keepalive_timeout = keepalive_timeout
+        self.host_limit_overrides = {}
+        self.host_semaphores = {}
+        self.session = None
+
+    def configure(self, section):
+        """
+        Updates limits from [HTTP] section of config file. Must be called before first request.
+        :param section: dictionary-like config section.
+        :return: no return value.
+        """
+        self.timeout = float(section.get("timeout", self.timeout))
+        self.limit_per_host = int(section.get("limit_per_host", self.limit_per_host))
+        self.keepalive_timeout = float(section.get("keepalive_timeout", self.keepalive_timeout))
+        # Format: host:limit, host:limit, ...
+        for item in section.get("host_limits", "").split(","):
+            if ":" not in item:
+                continue
+            host, limit = item.rsplit(":", maxsplit=1)
+            self.host_limit_overrides[host.strip()] = int(limit)
+
+    def get_session(self):
+        """
+        Returns shared session, creating it on first use.
+        :return: aiohttp.ClientSession instance.
+        """
+        if self.session is None or self.session.closed:
+            connector = aiohttp.TCPConnector(limit=0, limit_per_host=0, ttl_dns_cache=300,
+                                             keepalive_timeout=self.keepalive_timeout)
+            self.session = aiohttp.ClientSession(connector=connector,
+                                                 timeout=aiohttp.ClientTimeout(total=self.timeout))
+        return self.session
+
+    def get_host_semaphore(self, host):
+        """
+        Returns semaphore limiting concurrent requests to given host.
+        :param host: host name of the request.
+        :return: asyncio.Semaphore instance.
+        """
+        semaphore = self.host_semaphores.get(host)
+        if semaphore is None:
+            semaphore = asyncio.Semaphore(self.host_limit_overrides.get(host, self.limit_per_host))
+            self.host_semaphores[host] = semaphore
+        return semaphore
+
+    async def get(self, url, params=None, headers=None, timeout=None):
+        """
+        Sends GET request and reads whole body.
+        :param url: target url.
+        :param params: optional dictionary of query parameters.
+        :param headers: optional dictionary of request headers.
+        :param timeout: optional total timeout in seconds overriding the default.
+        :return: HttpResponse instance.
+        """
+        options = {"params": params, "headers": headers}
+        if timeout is not None:
+            options["timeout"] = aiohttp.ClientTimeout(total=timeout)
+        async with self.get_host_semaphore(urlsplit(url).hostname):
+            try:
+                async with self.get_session().get(url, **options) as response:
+                    content = await response.read()
+                    return HttpResponse(str(response.url), response.status, content, response.charset)
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                logging.warning("Request to " + url + " failed: " + repr(e))
+                raise FetchError(url) from e
+
+    async def close(self):
+        """
+        Closes shared session and all pooled connections.
+        :return: no return value.
+        """
+        if self.session is not None and not self.session.closed:
+            await self.session.close()
+        self.session = None
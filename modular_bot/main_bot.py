@@ -1,284 +1,211 @@
+import argparse
+import asyncio
 import discord
 import logging
-from configobj import ConfigObj
-from pydoc import locate
-import _thread
-import asyncio
-from tkinter import *
-from tkinter import messagebox
-from tkinter import ttk
-from tkinter import scrolledtext
-from tkinter import colorchooser
+import subprocess
+import sys
 import time
+from configobj import ConfigObj
+from modular_bot.Module import BaseModule
+from modular_bot.control import ControlServer, LogBuffer
+from modular_bot.dispatcher import CommandDispatcher
+from modular_bot.command_router import CommandRouter
+from modular_bot.metrics import LoopLagProbe, MetricsServer, cache_collector, outbox_collector, \
+    parse_pool_collector, single_flight_collector
+from modular_bot.watchdog import LoopWatchdog
+from modular_bot.module_registry import ModuleRegistry
+from modular_bot.supervisor import Supervisor
 
-client = discord.Client()
+client = None
 config = ConfigObj("config.ini")
-modules_list = []
-enabled_list = []
+registry = None
+modules_list = []  # ModuleSpec of every module in config
 command_dict = {}
+dispatcher = CommandDispatcher(BaseModule.metrics, BaseModule.outbound)
+router = None
+lag_probe = None
+metrics_server = None
+control_server = None
+watchdog = None
 command_char = ''
 listening_channels = []
 voice_channel = ""
+ready = False
+started_at = 0.0  # perf_counter value when process started
 
 
-class LogHandler(logging.Handler):
+def create_client(shard_ids=None, shard_count=None):
     """
-    Class for custom logging handler. Logging message from default logger is passed to this handler and used to
-    update text in ScrollText widget in GUI.
+    Creates client and registers event handlers of the bot on it.
+    :param shard_ids: list of gateway shards to connect, or None to connect as a single unsharded client.
+    :param shard_count: total number of shards of the bot, given together with shard_ids.
+    :return: discord.Client or discord.AutoShardedClient instance.
     """
-    def __init__(self, log_space):
-        logging.Handler.__init__(self)
-        fmt = logging.Formatter("[%(asctime)s][%(levelname)s]: %(message)s", datefmt="%Y/%m/%d %H:%M:%S")
-        self.setFormatter(fmt)
-        self.text = log_space
-
-    def emit(self, record):
-        log = self.format(record)
-        self.text["state"] = "normal"
-        self.text.insert(END, log + "\n")
-        self.text["state"] = "disabled"
-        self.text.see(END)
+    if shard_ids is None:
+        new_client = discord.Client()
+    else:
+        new_client = discord.AutoShardedClient(shard_ids=shard_ids, shard_count=shard_count)
+    new_client.event(on_ready)
+    new_client.event(on_message)
+    return new_client
 
 
-@client.event
 async def on_ready():
+    global ready
     logging.info("Logged in as {} (ID: {})".format(client.user.name, client.user.id))
-    for channel in listening_channels:
-        await client.get_channel(int(channel)).send(':thumbsup:')
+    if not ready:
+        logging.info("Ready in {:.2f}s after start".format(time.perf_counter() - started_at))
+    ready = True
+    registry.client = client
+    if lag_probe is not None:
+        lag_probe.start()
+    if metrics_server is not None:
+        await metrics_server.start()
+    if control_server is not None:
+        await control_server.start()
+    if watchdog is not None:
+        watchdog.start()
+    for spec in modules_list:
+        if spec.enabled and spec.instance is not None:
+            await spec.instance.on_ready(client)
+    for channel_id in router.channel_ids:
+        channel = client.get_channel(channel_id)
+        if channel is not None:  # channels of guilds on shards of other workers are not visible
+            await BaseModule.outbound.send(channel, ':thumbsup:')
 
 
-@client.event
 async def on_message(message):
-    if message.content.startswith(command_char) and check_message_channel(message):
-        command_term = message.content.split(" ")[0]
-        executing_module = command_dict.get(command_term[1:])
-        if executing_module is None:
-            # Invalid command
-            logging.info("Invalid command requested by " + message.author.name + " on " + message.channel.name)
-            return_text = command_term[1:]
-            if len(return_text) == 0:
-                return_text = "null"
-            await message.channel.send("Invalid Command: " + "`" + return_text + "`")
-        else:
-            # Create a bundle to pass to module as argument
-            bundle = {"client": client, "message": message, "vchannel": voice_channel}
-            # Pass bundle to corresponding module
-            await executing_module.parse_command(bundle)
+    command = router.parse(message, client, voice_channel)
+    if command is None:
+        return
+    route = router.resolve(command)
+    if route is None:
+        # Invalid command
+        logging.info("Invalid command requested by " + message.author.name + " on " + message.channel.name)
+        BaseModule.metrics.count_invalid()
+        return_text = command.name
+        if len(return_text) == 0:
+            return_text = "null"
+        await BaseModule.outbound.send(message.channel, "Invalid Command: " + "`" + return_text + "`")
+        return
+    executing_module, handler = route
+    if handler is None:
+        # Module is imported on first use of its commands
+        try:
+            await registry.load_async(executing_module)
+        except Exception:
+            logging.exception("Could not load module " + executing_module.path)
+        route = router.resolve(command)
+        if route is None or route[1] is None:
+            await BaseModule.outbound.send(message.channel,
+                                           executing_module.get_module_name() + " is not available right now.")
+            return
+        executing_module, handler = route
+    # Command runs in its own task
+    if not dispatcher.submit(executing_module, handler, command):
+        logging.warning("Rejected command " + command.name + " of " + message.author.name +
+                        "; module " + executing_module.get_module_name() + " is busy")
+        await BaseModule.outbound.send(message.channel,
+                                       executing_module.get_module_name() + " is busy right now. Try again later.")
 
 
-def check_message_channel(msg):
+def load_commands():
     """
-    Checks if bot should respond to given message by comparing channel id.
-    :param msg: Message object
-    :return: True if message is from listening channel, False if not.
+    Reads all available commands from enabled modules and builds command router.
+    :return: No return value.
     """
-    if str(msg.channel.id) in listening_channels:
-        return True
-    else:
-        return False
+    set_routes(registry.command_dict())
 
 
-def load_commands():
+def set_routes(new_command_dict):
     """
-    Reads all available commands from modules and update command dictionary.
+    Replaces command dictionary and router at once. Called on startup and whenever modules are changed at runtime;
+    messages are routed either entirely by old routes or entirely by new ones.
+    :param new_command_dict: Dictionary of command name to module instance or ModuleSpec.
     :return: No return value.
     """
-    for i in range(0, len(modules_list)):
-        if not enabled_list[i]:
-            continue
-        command_list = modules_list[i].get_all_commands()
-        for command_item in command_list:
-            if command_dict.get(command_item) is not None:
-                logging.warning("Conflict in command " + command_item + " of module " + modules_list[i].get_module_name
-                                + ". Command from existing module will be used.")
-            else:
-                command_dict[command_item] = modules_list[i]
+    global command_dict, router
+    new_router = CommandRouter(command_char, listening_channels, new_command_dict)
+    command_dict, router = new_command_dict, new_router
 
 
-def gui_setup():
+def load_modules(lazy):
     """
-    Sets up GUI layout and starts TkInter GUI event loop. This function must be started in separate thread from the
-    main thread.
+    Imports and instantiates enabled modules. With lazy loading, only modules which have to see on_ready or whose
+    commands could not be read from source are loaded now; the rest are loaded on first use of their commands.
+    :param lazy: True to defer loading where possible.
     :return: no return value.
     """
-    def sys_exit():
-        """
-        Logs out client and exit if user chooses to exit.
-        :return: no return value.
-        """
-        exit_check = messagebox.askyesno("Exit?", "Do you want to shutdown the bot?")
-        if exit_check:
-            try:  # call client.logout in new event loop
-                loop = asyncio.new_event_loop()
-                loop.run_until_complete(client.logout())
-            except RuntimeError:  # Suppress exception; exiting program anyway
-                pass
-        else:
-            pass
-
-    def open_setting():
-        """
-        Settings menu for GUI. Opens another window on top of main window and show settings. Grabs focus until it is
-        closed by user.
-        :return: no return value.
-        """
-        setting_window = Toplevel()
-        setting_window.title("GUI Settings")
-        setting_window.minsize(480, 270)
-        setting_window.maxsize(480, 270)
-        # Main window not focusable while in settings
-        setting_window.grab_set()
-        setting_notebook = ttk.Notebook(setting_window)
-        # Console theme page
-        console_theme_page = ttk.Frame(setting_notebook)
-        console_bg_label = Label(console_theme_page, text="Background Color: ")
-        console_bg_label.grid(row=0, sticky=E)
-        console_bg_picker = Button(console_theme_page, bg=console_text["bg"],
-                                   width=10, height=1, bd=4, command=lambda: color_picker("bg", console_bg_picker))
-        console_bg_picker.grid(row=0, column=1, sticky=W)
-        console_fg_label = Label(console_theme_page, text="Font Color: ")
-        console_fg_label.grid(row=1, sticky=E)
-        console_fg_picker = Button(console_theme_page, bg=console_text["fg"],
-                                   width=10, height=1, bd=4, command=lambda: color_picker("fg", console_fg_picker))
-        console_fg_picker.grid(row=1, column=1, sticky=W)
-        console_theme_page.rowconfigure(0, weight=1)
-        console_theme_page.rowconfigure(1, weight=1)
-        console_theme_page.columnconfigure(0, weight=1)
-        console_theme_page.columnconfigure(1, weight=1)
-        setting_notebook.add(console_theme_page, text="Console Theme")
-        setting_notebook.pack(side=TOP, fill=BOTH, expand=True)
-
-    def color_picker(target, button):
-        """
-        Shows color picker and updates background / font color of console according to color picked by user.
-        :param target: "bg" for console background, "fg" for console text.
-        :param button: Color picker button widget on settings window.
-        :return: No return value.
-        """
-        if target == "bg":
-            new_color = colorchooser.askcolor(console_text["bg"], parent=button, title="Pick Background Color")
-            if new_color[1] is None:
-                return
-            console_text.configure(bg=new_color[1])
-        else:
-            new_color = colorchooser.askcolor(console_text["fg"], parent=button, title="Pick Font Color")
-            if new_color[1] is None:
-                return
-            console_text.configure(fg=new_color[1])
-        button.configure(bg=new_color[1])
+    for spec in modules_list:
+        if not spec.enabled:
+            continue
+        if lazy and spec.has_metadata and not spec.needs_ready:
+            continue
+        try:
+            registry.load(spec)
+        except Exception:
+            logging.exception("Could not load module " + spec.path + "; module is disabled")
+            spec.enabled = False
 
-    def checkbox_toggle(index):
-        """
-        Callback from toggle event of checkbox. Enables or disables module in config object. Object is not written
-        to actual config file before user hits Apply button.
-        :param index: Index of module in modules_list
-        :return: no return value.
-        """
-        enabled_list[index] = not enabled_list[index]
-        config_modules = config["MODULES"]
-        modules_path_list = config_modules["modules_list"].split("\n")
-        path = modules_path_list[index].split(";")[0]
-        if enabled_list[index]:
-            modules_path_list[index] = path + ";T"
-        else:
-            modules_path_list[index] = path + ";F"
-        config_modules["modules_list"] = "\n".join(modules_path_list)
 
-    def module_onselect(event):
-        """
-        OnSelect event handler. Updates values of text labels every time user selects a module list item.
-        :param event: Select event.
-        :return: no return value.
-        """
-        w = event.widget
-        # Clear labels from previous select
-        for label in module_desc.winfo_children():
-            label.destroy()
-        selected_idx = int(w.curselection()[0])
-        selected_module = modules_list[selected_idx]
-        # Set name of module
-        module_name = StringVar()
-        module_name.set("Name: " + selected_module.get_module_name())
-        module_name_label = Label(module_desc, textvariable=module_name, wraplength=400,
-                                  justify=LEFT, anchor=W)
-        module_name_label.grid(row=0, sticky=W, padx=5)
-        # Set description of module
-        module_description_str = StringVar()
-        module_description_str.set("Description: \n" + selected_module.get_module_description())
-        module_description_label = Label(module_desc, textvariable=module_description_str, wraplength=470,
-                                         justify=LEFT, anchor=W)
-        module_description_label.grid(row=1, sticky=W, padx=5)
-        # Set commands of module
-        module_command = StringVar()
-        module_command.set("Commands: \n" + ", ".join(selected_module.get_all_commands()))
-        module_command_label = Label(module_desc, textvariable=module_command, wraplength=470,
-                                     justify=LEFT, anchor=W)
-        module_command_label.grid(row=2, sticky=W, padx=5)
-        # Set on/off checkbox
-        module_switch = Checkbutton(module_desc, text="Enabled", command=lambda: checkbox_toggle(selected_idx))
-        if enabled_list[selected_idx]:
-            module_switch.select()
-        else:
-            module_switch.deselect()
-        module_switch.grid(row=3, sticky=W, padx=5, pady=10)
+def parse_args():
+    parser = argparse.ArgumentParser(description="Runs modular_bot.")
+    # Set by supervisor when bot runs as one of several workers
+    parser.add_argument("--worker-id", type=int, help="id of this worker process")
+    parser.add_argument("--shard-ids", help="comma-separated gateway shards this worker connects")
+    parser.add_argument("--shard-count", type=int, help="total number of gateway shards")
+    return parser.parse_args()
 
-    def write_config():
-        """
-        Writes config object to config file and notify user. Changes will be reflected after restarting.
-        :return: no return value.
-        """
-        config.write()
-        messagebox.showinfo("Changes Applied", "Changes you made will be applied after restarting the bot.")
 
-    window = Tk()
-    window.title("TestBot Configuration")
-    window.minsize(800, 450)
-    window.maxsize(800, 450)
-    # Menu bar settings
-    menu_bar = Menu(window)
-    file_menu = Menu(menu_bar, tearoff=0)
-    file_menu.add_command(label="Settings..", command=open_setting)
-    file_menu.add_separator()
-    file_menu.add_command(label="Exit..", command=sys_exit)
-    menu_bar.add_cascade(label="File", menu=file_menu)
-    window.config(menu=menu_bar)
-    # Notebook (tabs) settings
-    notebook = ttk.Notebook(window)
-    # Module list tab
-    module_list_page = ttk.Frame(notebook)
-    # List of currently existing modules
-    module_checklist = Listbox(module_list_page, bg="white", relief=SUNKEN, borderwidth=2, activestyle="none",
-                               selectmode=SINGLE, highlightthickness=0, width=40)
-    for i in range(0, len(modules_list)):
-        module_checklist.insert(i, " " + modules_list[i].get_module_name())
-    module_checklist.bind('<<ListboxSelect>>', module_onselect)
-    # Module description & apply button
-    module_desc = LabelFrame(module_list_page, text="Module Information")
-    module_apply = Button(module_list_page, text="Apply Changes..", width=20, command=write_config)
-    # Grid settings
-    module_checklist.grid(column=0, row=0, sticky=N + S + E + W, padx=5, pady=5, rowspan=2)
-    module_desc.grid(column=1, row=0, sticky=N + S + E + W, padx=5, pady=5)
-    module_apply.grid(column=1, row=1, sticky=N + S, padx=5, pady=5)
-    module_list_page.columnconfigure(1, weight=1)
-    module_list_page.rowconfigure(0, weight=1)
-    # Console tab
-    console_page = ttk.Frame(notebook)
-    console_text = scrolledtext.ScrolledText(console_page, state="disabled", wrap="none", bg="black", fg="lawn green")
-    console_text.pack(fill=BOTH, expand=True, padx=5, pady=5)
-    gui_log_handler = LogHandler(console_text)
-    logging.getLogger().addHandler(gui_log_handler)
-    notebook.add(console_page, text="Console")
-    notebook.add(module_list_page, text="Modules")
-    notebook.pack(side=TOP, fill=BOTH, expand=True)
-    logging.info("GUI loading complete")
-    window.mainloop()
+def run_supervisor(config_sharding):
+    """
+    Runs bot as several worker processes managed by Supervisor, and opens control panel of the first worker.
+    :param config_sharding: [SHARDING] section of config file.
+    :return: no return value.
+    """
+    config_metrics = config.get("METRICS", {})
+    metrics_port = None
+    if config_metrics.get("endpoint", "0") == "1":
+        metrics_port = int(config_metrics.get("port", 9108))
+    supervisor = Supervisor([sys.executable, "-m", "modular_bot.runbot"], int(config_sharding.get("workers", 1)),
+                            int(config_sharding.get("shard_count", 0)), config["GENERAL"].get("token"),
+                            config_metrics.get("host", "127.0.0.1"), metrics_port,
+                            max_restart_delay=float(config_sharding.get("max_restart_delay", 60)))
+    config_gui = config["GUI"]
+    if config_gui["use_gui"] == "1":
+        # worker i serves control panels on control_port + i
+        subprocess.Popen([sys.executable, "-m", "modular_bot.gui", "--config", config.filename])
+    try:
+        asyncio.get_event_loop().run_until_complete(supervisor.run())
+    except KeyboardInterrupt:
+        pass
 
 
-def main():
+def main(start_time=None):
+    """
+    Loads config and modules and runs the bot until it is shut down.
+    :param start_time: optional perf_counter value taken before the bot was imported, so startup report includes
+                       import time.
+    :return: no return value.
+    """
     # Logging configuration
     logging.basicConfig(level=logging.INFO,
                         format="[%(asctime)s][%(levelname)s]: %(message)s", datefmt="%Y/%m/%d %H:%M:%S")
-    global command_char, listening_channels, voice_channel
+    global client, command_char, listening_channels, voice_channel, lag_probe, metrics_server, control_server, \
+        watchdog, registry, started_at
+    started_at = start_time if start_time is not None else time.perf_counter()
+    args = parse_args()
+    if args.worker_id is None and int(config.get("SHARDING", {}).get("workers", 1)) > 1:
+        run_supervisor(config["SHARDING"])
+        return
+    # Workers serve metrics and control panels on ports after those of the supervisor and previous workers
+    worker_id = args.worker_id
+    if worker_id is None:
+        client = create_client()
+    else:
+        client = create_client([int(shard_id) for shard_id in args.shard_ids.split(",")], args.shard_count)
+    phase_started = time.perf_counter()
+    phases = [("imports", phase_started - started_at)]
     # Parse config file and load settings
     logging.debug("Loading settings from config.ini")
     config_general = config["GENERAL"]
@@ -288,33 +215,88 @@ def main():
     token = config_general.get("token")
     # Set listening channels
     listening_channels = config_general.get("listening_channels")
+    if isinstance(listening_channels, str):
+        listening_channels = [listening_channels]
     # Set voice channel
     voice_channel = config_general.get("voice_channel")
-    # Read module lists and create list of module class instances
+    # Configure shared HTTP client used by modules
+    BaseModule.http.configure(config.get("HTTP", {}))
+    BaseModule.response_cache.configure(config.get("CACHE", {}))
+    BaseModule.parsed_cache.configure(config.get("CACHE", {}), "parsed_")
+    BaseModule.outbound.configure(config.get("OUTBOUND", {}))
+    BaseModule.parse_pool.configure(config.get("PARSING", {}))
+    BaseModule.parse_pool.start()
+    # Set up metrics; probe and endpoint start once client is connected
+    config_metrics = config.get("METRICS", {})
+    BaseModule.metrics.add_collector(cache_collector("response", BaseModule.response_cache))
+    BaseModule.metrics.add_collector(cache_collector("parsed", BaseModule.parsed_cache))
+    BaseModule.metrics.add_collector(single_flight_collector(BaseModule.in_flight))
+    BaseModule.metrics.add_collector(outbox_collector(BaseModule.outbound))
+    BaseModule.metrics.add_collector(parse_pool_collector(BaseModule.parse_pool))
+    lag_probe = LoopLagProbe(BaseModule.metrics, float(config_metrics.get("lag_probe_interval", 0.5)))
+    if config_metrics.get("endpoint", "0") == "1":
+        metrics_port = int(config_metrics.get("port", 9108))
+        if worker_id is not None:
+            metrics_port += 1 + worker_id
+        metrics_server = MetricsServer(BaseModule.metrics, config_metrics.get("host", "127.0.0.1"), metrics_port)
+    # Opt-in detector of handlers blocking the event loop
+    config_watchdog = config.get("WATCHDOG", {})
+    if config_watchdog.get("enabled", "0") == "1":
+        watchdog = LoopWatchdog(float(config_watchdog.get("threshold", 0.25)), BaseModule.metrics, dispatcher)
+    phases.append(("config", time.perf_counter() - phase_started))
+    # Read module lists from config; metadata is read from source, without importing modules
+    phase_started = time.perf_counter()
     config_modules = config["MODULES"]
+    registry = ModuleRegistry(command_char, config, dispatcher, BaseModule.parse_pool)
+    registry.routes_changed = set_routes
+    BaseModule.registry = registry
     modules_path_list = config_modules.get("modules_list").split("\n")
     for entry in modules_path_list:
         path = entry.split(";")[0]
         enabled = False
         if entry.split(";")[1] == "T":
             enabled = True
-        class_attribute = locate(path)
-        modules_list.append(class_attribute(command_char))
-        enabled_list.append(enabled)
+        modules_list.append(registry.add(path, enabled))
+    phases.append(("metadata", time.perf_counter() - phase_started))
+    # Import and create instances of enabled modules
+    phase_started = time.perf_counter()
+    load_modules(config_modules.get("lazy_load", "1") == "1")
+    phases.append(("modules", time.perf_counter() - phase_started))
     # Update commands dictionary
     load_commands()
-    # Check GUI option and start GUI thread
-    gui_switch = config["GUI"]["use_gui"]
-    if gui_switch == "1":
-        _thread.start_new_thread(gui_setup, ())
-        time.sleep(1)  # give some time for GUI to load
+    # Check GUI option; control panel runs in its own process and attaches to control server
+    phase_started = time.perf_counter()
+    config_gui = config["GUI"]
+    gui_switch = config_gui["use_gui"]
+    if gui_switch == "1" or config_gui.get("control", "0") == "1":
+        log_buffer = LogBuffer(int(config_gui.get("console_max_lines", 5000)))
+        logging.getLogger().addHandler(log_buffer)
+        control_server = ControlServer(client, registry, BaseModule.metrics, log_buffer,
+                                       config_gui.get("control_host", "127.0.0.1"),
+                                       int(config_gui.get("control_port", 9109)) + (worker_id or 0),
+                                       config_gui.get("control_token", ""))
+    if gui_switch == "1" and worker_id is None:  # supervisor opens control panel of sharded bot
+        subprocess.Popen([sys.executable, "-m", "modular_bot.gui", "--config", config.filename])
+    phases.append(("gui", time.perf_counter() - phase_started))
     logging.info("========== BOT BOOTING COMPLETE ==========")
     logging.info("Command prefix: " + command_char)
     logging.info("Listening to: " + str(listening_channels))
     logging.info("Voice channel: " + voice_channel)
+    if worker_id is not None:
+        logging.info("Worker " + str(worker_id) + " with shards " + args.shard_ids + " of " + str(args.shard_count))
     logging.info("Number of modules in library: " + str(len(modules_path_list)))
-    logging.info("Number of modules enabled: " + str(enabled_list.count(True)))
+    logging.info("Number of modules enabled: " + str(len([spec for spec in modules_list if spec.enabled])))
+    logging.info("Startup time: " + ", ".join(["{} {:.1f} ms".format(name, seconds * 1000)
+                                               for name, seconds in phases]))
+    for spec in modules_list:
+        if spec.instance is not None:
+            logging.info("  " + spec.class_name + " import: {:.1f} ms".format(spec.import_seconds * 1000))
+        elif spec.enabled:
+            logging.info("  " + spec.class_name + " import: deferred to first use")
     logging.info("==========================================")
     # Connect to server
     logging.info("Connecting to Discord server...")
-    client.run(token)
+    try:
+        client.run(token)
+    finally:
+        BaseModule.parse_pool.close()
@@ -0,0 +1,352 @@
+import asyncio
+import bisect
+import logging
+import time
+from aiohttp import web
+
+# Upper bounds of histogram buckets in seconds
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+
+class Histogram:
+    """
+    Cumulative-bucket histogram in the form Prometheus expects. Quantiles are estimated from buckets, so they are
+    only as precise as bucket boundaries.
+    """
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)  # last slot counts values above the largest bucket
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+        if value > self.max:
+            self.max = value
+
+    def quantile(self, fraction):
+        """
+        Estimates quantile by linear interpolation inside the bucket it falls in.
+        :param fraction: quantile between 0 and 1.
+        :return: estimated value in seconds, 0 if nothing was observed.
+        """
+        if self.count == 0:
+            return 0.0
+        rank = fraction * self.count
+        seen = 0
+        lower = 0.0
+        for index, bucket_count in enumerate(self.counts):
+            upper = self.buckets[index] if index < len(self.buckets) else self.max
+            if bucket_count > 0 and seen + bucket_count >= rank:
+                return min(lower + (upper - lower) * (rank - seen) / bucket_count, self.max)
+            seen += bucket_count
+            lower = upper
+        return self.max
+
+    def samples(self, name, labels):
+        """
+        Yields bucket, sum and count samples of the histogram.
+        :param name: metric name.
+        :param labels: dictionary of labels.
+        :return: iterator of (name, labels, value).
+        """
+        cumulative = 0
+        for index, bound in enumerate(self.buckets):
+            cumulative += self.counts[index]
+            yield name + "_bucket", dict(labels, le=repr(bound)), cumulative
+        yield name + "_bucket", dict(labels, le="+Inf"), self.count
+        yield name + "_sum", labels, self.sum
+        yield name + "_count", labels, self.count
+
+
+class MetricsRegistry:
+    """
+    In-process metrics of the bot. Dispatcher, modules and loop probe record into it, and it is rendered in
+    Prometheus text format or summarized for !stats.
+    """
+    def __init__(self):
+        self.command_latency = {}  # (module name, command name) -> Histogram
+        self.module_latency = {}  # module name -> Histogram
+        self.command_errors = {}  # (module name, command name) -> count
+        self.rejected = {}  # module name -> count
+        self.invalid_commands = 0
+        self.fetch_latency = {}  # host -> Histogram
+        self.fetch_errors = {}  # host -> count
+        self.parse_latency = {}  # parser name -> Histogram
+        self.loop_lag = Histogram()
+        self.blocked = {}  # (module name, command name) -> count of calls holding the loop
+        self.blocked_duration = Histogram()
+        self.collectors = []
+
+    def observe_command(self, module_name, command_name, seconds):
+        """
+        Records time taken by a command, from the moment it was accepted until it finished.
+        :param module_name: name of executing module.
+        :param command_name: name of the command.
+        :param seconds: elapsed time in seconds.
+        :return: no return value.
+        """
+        key = (module_name, command_name)
+        if key not in self.command_latency:
+            self.command_latency[key] = Histogram()
+        self.command_latency[key].observe(seconds)
+        if module_name not in self.module_latency:
+            self.module_latency[module_name] = Histogram()
+        self.module_latency[module_name].observe(seconds)
+
+    def count_error(self, module_name, command_name):
+        key = (module_name, command_name)
+        self.command_errors[key] = self.command_errors.get(key, 0) + 1
+
+    def count_rejected(self, module_name):
+        self.rejected[module_name] = self.rejected.get(module_name, 0) + 1
+
+    def count_invalid(self):
+        self.invalid_commands += 1
+
+    def observe_fetch(self, host, seconds):
+        if host not in self.fetch_latency:
+            self.fetch_latency[host] = Histogram()
+        self.fetch_latency[host].observe(seconds)
+
+    def count_fetch_error(self, host):
+        self.fetch_errors[host] = self.fetch_errors.get(host, 0) + 1
+
+    def observe_parse(self, parser_name, seconds):
+        if parser_name not in self.parse_latency:
+            self.parse_latency[parser_name] = Histogram()
+        self.parse_latency[parser_name].observe(seconds)
+
+    def observe_blocked(self, module_name, command_name, seconds):
+        """
+        Records a call which held the event loop longer than watchdog threshold.
+        :param module_name: name of module whose command was running, empty if unknown.
+        :param command_name: name of the command, empty if unknown.
+        :param seconds: approximate time loop was held.
+        :return: no return value.
+        """
+        key = (module_name, command_name)
+        self.blocked[key] = self.blocked.get(key, 0) + 1
+        self.blocked_duration.observe(seconds)
+
+    def add_collector(self, collector):
+        """
+        Adds function called on every render to report values owned by other objects, such as cache counters.
+        :param collector: function returning iterable of (name, type, help, samples) where samples is a list of
+        (labels, value).
+        :return: no return value.
+        """
+        self.collectors.append(collector)
+
+    def families(self):
+        """
+        Yields every metric family of the registry.
+        :return: iterator of (name, type, help, samples) where samples are (name, labels, value).
+        """
+        yield ("modular_bot_command_duration_seconds", "histogram", "Time from accepting a command until it finished.",
+               [sample for (module, command), histogram in sorted(self.command_latency.items())
+                for sample in histogram.samples("modular_bot_command_duration_seconds",
+                                                {"module": module, "command": command})])
+        yield ("modular_bot_module_duration_seconds", "histogram", "Time taken by commands of each module.",
+               [sample for module, histogram in sorted(self.module_latency.items())
+                for sample in histogram.samples("modular_bot_module_duration_seconds", {"module": module})])
+        yield ("modular_bot_command_errors_total", "counter", "Commands which raised an exception.",
+               [("modular_bot_command_errors_total", {"module": module, "command": command}, count)
+                for (module, command), count in sorted(self.command_errors.items())])
+        yield ("modular_bot_commands_rejected_total", "counter", "Commands rejected because module backlog was full.",
+               [("modular_bot_commands_rejected_total", {"module": module}, count)
+                for module, count in sorted(self.rejected.items())])
+        yield ("modular_bot_invalid_commands_total", "counter", "Messages with unknown command.",
+               [("modular_bot_invalid_commands_total", {}, self.invalid_commands)])
+        yield ("modular_bot_fetch_duration_seconds", "histogram", "Time taken by upstream requests.",
+               [sample for host, histogram in sorted(self.fetch_latency.items())
+                for sample in histogram.samples("modular_bot_fetch_duration_seconds", {"host": host})])
+        yield ("modular_bot_fetch_errors_total", "counter", "Upstream requests which failed or timed out.",
+               [("modular_bot_fetch_errors_total", {"host": host}, count)
+                for host, count in sorted(self.fetch_errors.items())])
+        yield ("modular_bot_parse_duration_seconds", "histogram", "Time taken by page parsers.",
+               [sample for parser, histogram in sorted(self.parse_latency.items())
+                for sample in histogram.samples("modular_bot_parse_duration_seconds", {"parser": parser})])
+        yield ("modular_bot_event_loop_lag_seconds", "histogram", "Delay of event loop measured by probe.",
+               list(self.loop_lag.samples("modular_bot_event_loop_lag_seconds", {})))
+        yield ("modular_bot_loop_blocked_total", "counter",
+               "Calls which held event loop longer than watchdog threshold.",
+               [("modular_bot_loop_blocked_total", {"module": module, "command": command}, count)
+                for (module, command), count in sorted(self.blocked.items())])
+        yield ("modular_bot_loop_blocked_seconds", "histogram", "Time event loop was held by blocking calls.",
+               list(self.blocked_duration.samples("modular_bot_loop_blocked_seconds", {})))
+        for collector in self.collectors:
+            for name, metric_type, help_text, samples in collector():
+                yield name, metric_type, help_text, [(name, labels, value) for labels, value in samples]
+
+    def render(self):
+        """
+        Renders all metrics in Prometheus text exposition format.
+        :return: metrics in string.
+        """
+        lines = []
+        for name, metric_type, help_text, samples in self.families():
+            lines.append("# HELP " + name + " " + help_text)
+            lines.append("# TYPE " + name + " " + metric_type)
+            for sample_name, labels, value in samples:
+                lines.append(sample_name + format_labels(labels) + " " + repr(value))
+        return "\n".join(lines) + "\n"
+
+
+def format_labels(labels):
+    """
+    Formats labels of a sample, escaping values as Prometheus requires.
+    :param labels: dictionary of labels.
+    :return: labels in string, empty if there are none.
+    """
+    if not labels:
+        return ""
+    escaped = []
+    for key, value in labels.items():
+        value = str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+        escaped.append(key + "=\"" + value + "\"")
+    return "{" + ",".join(escaped) + "}"
+
+
+def cache_collector(name, cache):
+    """
+    Creates collector reporting counters of a TTLCache.
+    :param name: value of "cache" label.
+    :param cache: TTLCache instance.
+    :return: collector function for MetricsRegistry.add_collector.
+    """
+    def collect():
+        stats = cache.stats()
+        labels = {"cache": name}
+        families = [("modular_bot_cache_hits_total", "counter", "Cache lookups which found a fresh entry.",
+                     [(labels, stats["hits"])]),
+                    ("modular_bot_cache_misses_total", "counter", "Cache lookups which found nothing.",
+                     [(labels, stats["misses"])]),
+                    ("modular_bot_cache_evictions_total", "counter", "Entries evicted to stay within cache limits.",
+                     [(labels, stats["evictions"])]),
+                    ("modular_bot_cache_entries", "gauge", "Entries currently in cache.", [(labels, stats["entries"])])]
+        if cache.max_bytes is not None:
+            families.append(("modular_bot_cache_bytes", "gauge", "Approximate size of cached entries.",
+                             [(labels, stats["bytes"])]))
+        return families
+    return collect
+
+
+def single_flight_collector(single_flight):
+    """
+    Creates collector reporting how many lookups were coalesced by a SingleFlight.
+    :param single_flight: SingleFlight instance.
+    :return: collector function for MetricsRegistry.add_collector.
+    """
+    def collect():
+        stats = single_flight.stats()
+        return [("modular_bot_coalesced_requests_total", "counter", "Lookups which ran or joined one in flight.",
+                 [({"result": "executed"}, stats["executed"]), ({"result": "shared"}, stats["shared"])])]
+    return collect
+
+
+def outbox_collector(outbox):
+    """
+    Creates collector reporting messages sent through the shared Outbox.
+    :param outbox: Outbox instance.
+    :return: collector function for MetricsRegistry.add_collector.
+    """
+    def collect():
+        stats = outbox.stats()
+        return [("modular_bot_messages_sent_total", "counter", "Messages sent through outbound queue.",
+                 [({}, stats["sent"])]),
+                ("modular_bot_messages_delayed_total", "counter", "Messages held back by channel rate limit.",
+                 [({}, stats["delayed"])]),
+                ("modular_bot_messages_pending", "gauge", "Messages waiting in outbound queues.",
+                 [({}, stats["pending"])])]
+    return collect
+
+
+def parse_pool_collector(parse_pool):
+    """
+    Creates collector reporting pages parsed by the shared ParsePool.
+    :param parse_pool: ParsePool instance.
+    :return: collector function for MetricsRegistry.add_collector.
+    """
+    def collect():
+        stats = parse_pool.stats()
+        return [("modular_bot_pages_parsed_total", "counter", "Pages parsed in parse pool.",
+                 [({}, stats["completed"])]),
+                ("modular_bot_parse_pending", "gauge", "Pages being parsed or waiting for a parser process.",
+                 [({}, stats["pending"])]),
+                ("modular_bot_parse_pool_restarts_total", "counter",
+                 "Process pools replaced after a parser process died.", [({}, stats["restarts"])])]
+    return collect
+
+
+class LoopLagProbe:
+    """
+    Background task measuring how late the event loop wakes it up. A loop busy with blocking work wakes it late,
+    so the delay is the time every other coroutine had to wait as well.
+    """
+    def __init__(self, metrics, interval=0.5):
+        """
+        :param metrics: MetricsRegistry instance.
+        :param interval: seconds between measurements.
+        """
+        self.metrics = metrics
+        self.interval = interval
+        self.task = None
+
+    def start(self):
+        if self.task is None:
+            self.task = asyncio.ensure_future(self.run())
+
+    def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+            self.task = None
+
+    async def run(self):
+        while True:
+            expected = time.perf_counter() + self.interval
+            await asyncio.sleep(self.interval)
+            self.metrics.loop_lag.observe(max(time.perf_counter() - expected, 0.0))
+
+
+class MetricsServer:
+    """
+    Local HTTP endpoint serving metrics in Prometheus text format on /metrics.
+    """
+    def __init__(self, metrics, host="127.0.0.1", port=9108):
+        self.metrics = metrics
+        self.host = host
+        self.port = port
+        self.runner = None
+
+    async def start(self):
+        """
+        Starts serving. Failure to bind is logged and leaves the bot running without endpoint.
+        :return: no return value.
+        """
+        if self.runner is not None:
+            return
+        app = web.Application()
+        app.router.add_get("/metrics", self.handle_metrics)
+        self.runner = web.AppRunner(app, access_log=None)
+        await self.runner.setup()
+        try:
+            await web.TCPSite(self.runner, self.host, self.port).start()
+        except OSError:
+            logging.exception("Could not start metrics endpoint on " + self.host + ":" + str(self.port))
+            await self.runner.cleanup()
+            self.runner = None
+            return
+        logging.info("Serving metrics on http://" + self.host + ":" + str(self.port) + "/metrics")
+
+    async def stop(self):
+        if self.runner is not None:
+            await self.runner.cleanup()
+            self.runner = None
+
+    async def handle_metrics(self, request):
+        return web.Response(body=self.metrics.render().encode("utf-8"),
+                            headers={"Content-Type": "text/plain; version=0.0.4; charset=utf-8"})
@@ -0,0 +1,336 @@
+import ast
+import asyncio
+import importlib
+import importlib.util
+import logging
+import sys
+import time
+from modular_bot.cache import SingleFlight
+
+# Class attributes read from module source without importing it
+METADATA_FIELDS = ("module_name", "module_description", "commands", "command_handlers")
+
+
+def read_class_metadata(module_path, class_name):
+    """
+    Reads literal class attributes and names of defined methods of a class by parsing source of its module.
+    The module itself is not imported, so its dependencies are not loaded either.
+    :param module_path: dotted path of the python module.
+    :param class_name: name of the class.
+    :return: tuple of dictionary of literal attributes and set of method names, or None if class is not found.
+    """
+    spec = importlib.util.find_spec(module_path)
+    if spec is None or spec.origin is None or not spec.origin.endswith(".py"):
+        return None
+    with open(spec.origin, encoding="utf-8") as source_file:
+        tree = ast.parse(source_file.read(), spec.origin)
+    for node in tree.body:
+        if isinstance(node, ast.ClassDef) and node.name == class_name:
+            attributes = {}
+            methods = set()
+            for item in node.body:
+                if isinstance(item, (ast.FunctionDef, ast.AsyncFunctionDef)):
+                    methods.add(item.name)
+                elif isinstance(item, ast.Assign) and len(item.targets) == 1 and \
+                        isinstance(item.targets[0], ast.Name) and item.targets[0].id in METADATA_FIELDS:
+                    try:
+                        attributes[item.targets[0].id] = ast.literal_eval(item.value)
+                    except ValueError:  # not a literal; known only after import
+                        pass
+            return attributes, methods
+    return None
+
+
+class ModuleSpec:
+    """
+    Entry of modules_list in config. Describes a module from metadata read out of its source, and imports and
+    instantiates the module class only when it is needed.
+    """
+    def __init__(self, path, enabled=True):
+        """
+        :param path: dotted path of module class, like modular_bot.modules.psn_module.PSNModule.
+        :param enabled: True if module is enabled in config.
+        """
+        self.path = path
+        self.module_path, self.class_name = path.rsplit(".", 1)
+        self.enabled = enabled
+        self.instance = None
+        self.import_seconds = 0.0
+        self.read_metadata()
+
+    def read_metadata(self):
+        """
+        Reads name, description and commands of the module from its source.
+        :return: no return value.
+        """
+        self.apply_metadata(read_class_metadata(self.module_path, self.class_name))
+
+    def apply_metadata(self, metadata):
+        """
+        Sets name, description and commands of the module from metadata read out of its source.
+        :param metadata: value returned by read_class_metadata.
+        :return: no return value.
+        """
+        self.module_name = self.class_name
+        self.module_description = ""
+        self.commands = []
+        self.needs_ready = True  # unless source shows otherwise, assume module has to see on_ready
+        self.has_metadata = False
+        if metadata is not None:
+            attributes, methods = metadata
+            self.module_name = attributes.get("module_name", self.module_name)
+            self.module_description = attributes.get("module_description", self.module_description)
+            self.commands = attributes.get("commands", self.commands)
+            self.needs_ready = "on_ready" in methods
+            self.has_metadata = "commands" in attributes
+
+    def get_module_name(self):
+        if self.instance is not None:
+            return self.instance.get_module_name()
+        return self.module_name
+
+    def get_module_description(self):
+        if self.instance is not None:
+            return self.instance.get_module_description()
+        return self.module_description
+
+    def get_all_commands(self):
+        if self.instance is not None:
+            return self.instance.get_all_commands()
+        return self.commands
+
+    def import_class(self, reload=False):
+        """
+        Imports python module of the class and records time it took and third-party packages it pulled in.
+        :param reload: True to execute module code again even if it is already imported.
+        :return: module class.
+        """
+        before = set(sys.modules)
+        started = time.perf_counter()
+        if reload and self.module_path in sys.modules:
+            module = importlib.reload(sys.modules[self.module_path])
+        else:
+            module = importlib.import_module(self.module_path)
+        module_class = getattr(module, self.class_name)
+        self.import_seconds = time.perf_counter() - started
+        packages = sorted({name.split(".")[0] for name in set(sys.modules) - before} - {"modular_bot"})
+        logging.info(("Reloaded " if reload else "Imported ") + self.class_name + " in " +
+                     "{:.1f}".format(self.import_seconds * 1000) + " ms" +
+                     (" (new packages: " + ", ".join(packages) + ")" if packages else ""))
+        return module_class
+
+
+class ModuleRegistry:
+    """
+    Keeps ModuleSpec of every module in config. Loads modules on demand, and enables, disables, unloads and reloads
+    them while bot is running. Every change publishes a new command dictionary at once, and replaced instances
+    finish commands they already accepted before they are unloaded.
+    """
+    def __init__(self, command_char, config, dispatcher=None, parse_pool=None):
+        """
+        :param command_char: command prefix.
+        :param config: ConfigObj instance; module settings are read from section named after each class.
+        :param dispatcher: optional CommandDispatcher used to wait for running commands of replaced instances.
+        :param parse_pool: optional ParsePool restarted on reload, so parser processes run new code of parsers.
+        """
+        self.command_char = command_char
+        self.config = config
+        self.dispatcher = dispatcher
+        self.parse_pool = parse_pool
+        self.specs = []
+        self.loading = SingleFlight()
+        self.lock = None
+        self.client = None  # set once bot is ready; modules loaded later receive on_ready right away
+        self.routes_changed = None  # function called with new command dictionary after every change
+
+    def add(self, path, enabled):
+        spec = ModuleSpec(path, enabled)
+        self.specs.append(spec)
+        return spec
+
+    def find(self, name):
+        """
+        Finds module by class name or module name, ignoring case.
+        :param name: name to look for.
+        :return: ModuleSpec instance, or None if there is no such module.
+        """
+        name = name.strip().lower()
+        for spec in self.specs:
+            if spec.class_name.lower() == name or spec.get_module_name().lower() == name:
+                return spec
+        return None
+
+    def command_dict(self):
+        """
+        Builds dictionary of command name to module instance of enabled modules. Commands of modules which are not
+        loaded yet map to their ModuleSpec. On conflict, module listed first in config keeps the command.
+        :return: Dictionary of command name to module instance or ModuleSpec.
+        """
+        commands = {}
+        for spec in self.specs:
+            if not spec.enabled:
+                continue
+            owner = spec.instance if spec.instance is not None else spec
+            for command_item in spec.get_all_commands():
+                if commands.get(command_item) is not None:
+                    logging.warning("Conflict in command " + command_item + " of module " +
+                                    spec.get_module_name() + ". Command from existing module will be used.")
+                else:
+                    commands[command_item] = owner
+        return commands
+
+    def publish(self):
+        if self.routes_changed is not None:
+            self.routes_changed(self.command_dict())
+
+    def set_enabled(self, spec, enabled):
+        """
+        Sets enabled flag of module and its entry in config object. Config file is written only by save.
+        :param spec: ModuleSpec instance.
+        :param enabled: True to enable module.
+        :return: no return value.
+        """
+        spec.enabled = enabled
+        config_modules = self.config.get("MODULES")
+        if config_modules is None or "modules_list" not in config_modules:
+            return
+        modules_path_list = config_modules["modules_list"].split("\n")
+        for index, entry in enumerate(modules_path_list):
+            if entry.split(";")[0] == spec.path:
+                modules_path_list[index] = spec.path + (";T" if enabled else ";F")
+        config_modules["modules_list"] = "\n".join(modules_path_list)
+
+    def save(self):
+        self.config.write()
+
+    def get_lock(self):
+        if self.lock is None:
+            self.lock = asyncio.Lock()
+        return self.lock
+
+    def load(self, spec):
+        """
+        Loads module synchronously. Used at startup, before event loop runs.
+        :param spec: ModuleSpec instance.
+        :return: module instance.
+        """
+        if spec.instance is None:
+            spec.instance = spec.import_class()(self.command_char, self.config.get(spec.class_name))
+        return spec.instance
+
+    async def load_async(self, spec):
+        """
+        Loads module without blocking event loop for the import, and routes its commands to the new instance.
+        Concurrent loads of the same module share one load.
+        :param spec: ModuleSpec instance.
+        :return: module instance.
+        """
+        if spec.instance is not None:
+            return spec.instance
+        return await self.loading.do(spec.path, lambda: self.import_and_load(spec))
+
+    async def import_and_load(self, spec):
+        module_class = await asyncio.get_event_loop().run_in_executor(None, spec.import_class)
+        if spec.instance is None:
+            spec.instance = module_class(self.command_char, self.config.get(spec.class_name))
+            self.publish()
+            if self.client is not None:
+                await spec.instance.on_ready(self.client)
+        return spec.instance
+
+    async def enable(self, spec):
+        """
+        Loads module if needed and starts routing its commands.
+        :param spec: ModuleSpec instance.
+        :return: no return value.
+        """
+        async with self.get_lock():
+            await self.load_async(spec)
+            self.set_enabled(spec, True)
+            self.publish()
+
+    async def disable(self, spec):
+        """
+        Stops routing commands of module. Instance stays loaded, so its state is kept until it is enabled again.
+        :param spec: ModuleSpec instance.
+        :return: no return value.
+        """
+        async with self.get_lock():
+            self.set_enabled(spec, False)
+            self.publish()
+
+    async def unload(self, spec):
+        """
+        Disables module and drops its instance once commands it already accepted have finished.
+        :param spec: ModuleSpec instance.
+        :return: no return value.
+        """
+        async with self.get_lock():
+            self.set_enabled(spec, False)
+            old = spec.instance
+            spec.instance = None
+            self.publish()
+            if old is not None:
+                await self.retire(old)
+
+    async def reload(self, spec):
+        """
+        Imports code of module again and replaces its instance. Commands arriving meanwhile wait for the new instance,
+        and commands the old instance already accepted finish before module code is executed again. Module code is
+        executed on the event loop thread, so no command sees the module half rebuilt; only its source is read in the
+        background. State exported by the old instance is handed to the new one. If import fails, old instance stays.
+        :param spec: ModuleSpec instance.
+        :return: new module instance.
+        """
+        async with self.get_lock():
+            metadata = await asyncio.get_event_loop().run_in_executor(None, read_class_metadata, spec.module_path,
+                                                                      spec.class_name)
+            # Commands routed to the module while it is replaced join this call in load_async
+            return await self.loading.do(spec.path, lambda: self.replace(spec, metadata))
+
+    async def replace(self, spec, metadata):
+        """
+        Replaces instance of module with one of freshly executed module code. Called through reload.
+        :param spec: ModuleSpec instance.
+        :param metadata: value returned by read_class_metadata for new source of the module.
+        :return: new module instance.
+        """
+        old = spec.instance
+        spec.instance = None
+        self.publish()
+        if old is not None and self.dispatcher is not None:
+            await self.dispatcher.drain(old)
+        try:
+            new = spec.import_class(True)(self.command_char, self.config.get(spec.class_name))
+        except Exception:
+            spec.instance = old
+            self.publish()
+            raise
+        spec.apply_metadata(metadata)
+        if old is not None:
+            state = old.export_state()
+            if state is not None:
+                new.restore_state(state)
+        spec.instance = new
+        self.publish()
+        if self.parse_pool is not None:
+            # Parser processes import parsers by name and would keep running their old code
+            self.parse_pool.restart()
+        if self.client is not None and spec.enabled:
+            await new.on_ready(self.client)
+        if old is not None:
+            await self.retire(old)
+        return new
+
+    async def retire(self, module):
+        """
+        Waits for running commands of replaced or unloaded instance, then lets it release its resources.
+        :param module: module instance.
+        :return: no return value.
+        """
+        if self.dispatcher is not None:
+            await self.dispatcher.drain(module)
+        try:
+            await module.on_unload()
+        except Exception:
+            logging.exception("Module " + module.get_module_name() + " failed to unload cleanly")
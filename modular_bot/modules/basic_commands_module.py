@@ -9,54 +9,185 @@ class BasicCommands(BaseModule):
     """
     module_name = "Basic Commands"
     module_description = "Basic commands for testing purpose and shutdown."
-    commands = ["echo", "sleep", "shutdown"]
+    commands = ["echo", "sleep", "shutdown", "cachestats", "stats", "module"]
+    command_handlers = {"echo": "echo", "sleep": "sleep", "shutdown": "shutdown", "cachestats": "cache_stats",
+                        "stats": "stats", "module": "manage_module"}
 
-    async def parse_command(self, bundle):
-        """
-        Decides which command should be executed and calls it.
-        :param bundle Dictionary passed in from caller.
-        :return: no return value.
-        """
-        client = bundle.get("client")
-        message = bundle.get("message")
-        if message.content.startswith(self.command_char + "echo"):
-            await self.echo(message)
-        elif message.content.startswith(self.command_char + "sleep"):
-            await self.sleep(message)
-        elif message.content.startswith(self.command_char + "shutdown"):
-            await self.shutdown(client, message)
-
-    async def echo(self, message):
+    async def echo(self, command):
         """
         Echoes given message(excluding command term).
-        :param message: discord.Message instance.
+        :param command: Command instance.
         :return: no return value.
         """
+        message = command.message
         logging.info("Echo requested by " + message.author.name + " on " + message.channel.name)
-        return_text = message.content[6:]
+        return_text = command.args
         if len(return_text) == 0:
             return_text = "`null`"
-        await message.channel.send(return_text)
+        await self.outbound.send(message.channel, return_text)
 
-    async def sleep(self, message):
+    async def sleep(self, command):
         """
         Sleeps for 5 seconds. Any commands initiated during sleep will executed after sleep finishes.
-        :param message: discord.Message instance.
+        :param command: Command instance.
         :return: no return value.
         """
+        message = command.message
         logging.info("Sleep requested by " + message.author.name + " on " + message.channel.name)
-        await message.channel.send("Sleeping...")
+        await self.outbound.send(message.channel, "Sleeping...")
         time.sleep(5)
-        await message.channel.send("Slept 5 seconds!")
+        await self.outbound.send(message.channel, "Slept 5 seconds!")
 
-    async def shutdown(self, client, message):
+    async def shutdown(self, command):
         """
         Shuts down the bot.
-        :param client: discord.Client instance.
-        :param message: discord.Message instance.
+        :param command: Command instance.
         :return: no return value.
         """
+        client = command.client
+        message = command.message
         logging.info("Shutdown requested by " + message.author.name + " on " + message.channel.name)
-        await message.channel.send(":wave:")
+        await self.outbound.send(message.channel, ":wave:")
+        await self.http.close()
         await client.logout()
         logging.info("Logged out and closed connection.")
+
+    async def cache_stats(self, command):
+        """
+        Shows hit/miss counters of shared response cache and parsed result cache, and number of coalesced requests.
+        :param command: Command instance.
+        :return: no return value.
+        """
+        message = command.message
+        logging.info("Cache Stats requested by " + message.author.name + " on " + message.channel.name)
+        result_text = ""
+        for cache_name, cache in (("Response cache", self.response_cache), ("Parsed cache", self.parsed_cache)):
+            stats = cache.stats()
+            result_text += "{}: {} hits, {} misses ({:.1f}%), {} evictions, {} entries".format(
+                cache_name, stats["hits"], stats["misses"], stats["hit_rate"], stats["evictions"], stats["entries"])
+            if cache.max_bytes is not None:
+                result_text += ", {} bytes".format(stats["bytes"])
+            result_text += "\n"
+        stats = self.in_flight.stats()
+        result_text += "Coalesced requests: {} executed, {} shared, {} in flight\n".format(
+            stats["executed"], stats["shared"], stats["in_flight"])
+        await self.outbound.send(message.channel, "```" + result_text + "```")
+
+    async def stats(self, command):
+        """
+        Shows latency of modules and commands, upstream fetch timings and event loop lag. Only for administrators.
+        :param command: Command instance.
+        :return: no return value.
+        """
+        message = command.message
+        logging.info("Stats requested by " + message.author.name + " on " + message.channel.name)
+        if not is_administrator(message.author):
+            await self.outbound.send(message.channel, "Only administrators can see stats.")
+            return
+        metrics = self.metrics
+        result_text = "Commands (p50 / p99 / max, runs, errors, rejected):\n"
+        for module_name, histogram in sorted(metrics.module_latency.items()):
+            errors = sum(count for (module, _), count in metrics.command_errors.items() if module == module_name)
+            result_text += "{}: {}, {} runs, {} errors, {} rejected\n".format(
+                module_name, format_latency(histogram), histogram.count, errors, metrics.rejected.get(module_name, 0))
+            for (module, command_name), command_histogram in sorted(metrics.command_latency.items()):
+                if module == module_name:
+                    result_text += "  {}: {}, {} runs, {} errors\n".format(
+                        command_name, format_latency(command_histogram), command_histogram.count,
+                        metrics.command_errors.get((module, command_name), 0))
+        if metrics.fetch_latency or metrics.fetch_errors:
+            result_text += "Upstream (p50 / p99 / max, requests, errors):\n"
+            for host in sorted(set(metrics.fetch_latency) | set(metrics.fetch_errors)):
+                histogram = metrics.fetch_latency.get(host)
+                result_text += "  {}: {}, {} requests, {} errors\n".format(
+                    host, "-" if histogram is None else format_latency(histogram),
+                    0 if histogram is None else histogram.count, metrics.fetch_errors.get(host, 0))
+        for parser_name, histogram in sorted(metrics.parse_latency.items()):
+            result_text += "  parse {}: {}\n".format(parser_name.rsplit(".", 1)[-1], format_latency(histogram))
+        for cache_name, cache in (("Response cache", self.response_cache), ("Parsed cache", self.parsed_cache)):
+            stats = cache.stats()
+            result_text += "{} hit rate: {:.1f}% of {} lookups\n".format(cache_name, stats["hit_rate"],
+                                                                         stats["lookups"])
+        result_text += "Event loop lag: {}\n".format(format_latency(metrics.loop_lag))
+        for (module_name, command_name), count in sorted(metrics.blocked.items()):
+            result_text += "Blocked loop {} times: {}\n".format(count, command_name + " of " + module_name
+                                                                 if command_name else "outside commands")
+        result_text += "Invalid commands: {}\n".format(metrics.invalid_commands)
+        # Discord rejects messages longer than 2000 characters
+        await self.outbound.send(message.channel, "```" + result_text[:1990] + "```")
+
+    async def manage_module(self, command):
+        """
+        Lists, enables, disables, unloads or reloads modules without restarting the bot. Only for administrators.
+        Command: !module list | !module {enable|disable|unload|reload} {module}
+        :param command: Command instance.
+        :return: no return value.
+        """
+        message = command.message
+        logging.info("Module management requested by " + message.author.name + " on " + message.channel.name)
+        if not is_administrator(message.author):
+            await self.outbound.send(message.channel, "Only administrators can manage modules.")
+            return
+        registry = self.registry
+        args_list = command.split_args(maxsplit=1)
+        action = args_list[0].lower() if args_list else ""
+        if action == "list":
+            result_text = ""
+            for spec in registry.specs:
+                state = "enabled" if spec.enabled else "disabled"
+                if spec.instance is None:
+                    state += ", not loaded"
+                result_text += "{} ({}): {}\n".format(spec.class_name, spec.get_module_name(), state)
+            await self.outbound.send(message.channel, "```" + result_text + "```")
+            return
+        if action not in ("enable", "load", "disable", "unload", "reload") or len(args_list) < 2:
+            await self.outbound.send(message.channel,
+                                     "`Usage: !module list | !module {enable|disable|unload|reload} {module}`")
+            return
+        spec = registry.find(args_list[1])
+        if spec is None:
+            await self.outbound.send(message.channel,
+                                     "No module named `" + args_list[1] + "`. Use `!module list` to see modules.")
+            return
+        if spec.instance is self and action in ("disable", "unload"):
+            await self.outbound.send(message.channel, "Can't " + action + " module which runs this command.")
+            return
+        try:
+            if action in ("enable", "load"):
+                await registry.enable(spec)
+            elif action == "disable":
+                await registry.disable(spec)
+            elif action == "unload":
+                await registry.unload(spec)
+            else:
+                await registry.reload(spec)
+        except Exception as e:
+            logging.exception("Could not " + action + " module " + spec.path)
+            await self.outbound.send(message.channel,
+                                     "Could not " + action + " " + spec.class_name + ": `" + repr(e) + "`")
+            return
+        # Keep enabled flags across restarts
+        registry.save()
+        past = {"enable": "enabled", "load": "loaded", "disable": "disabled", "unload": "unloaded",
+                "reload": "reloaded"}
+        await self.outbound.send(message.channel, spec.get_module_name() + " " + past[action] + ".")
+
+
+def is_administrator(user):
+    """
+    Checks if user has administrator permission on guild. Users in direct messages have no permissions.
+    :param user: discord.Member or discord.User instance.
+    :return: True if user is administrator, False if not.
+    """
+    permissions = getattr(user, "guild_permissions", None)
+    return permissions is not None and permissions.administrator
+
+
+def format_latency(histogram):
+    """
+    Formats p50, p99 and max of a latency histogram in milliseconds.
+    :param histogram: Histogram instance.
+    :return: formatted text.
+    """
+    return "{:.0f} / {:.0f} / {:.0f} ms".format(histogram.quantile(0.5) * 1000, histogram.quantile(0.99) * 1000,
+                                               histogram.max * 1000)
@@ -1,175 +1,290 @@
 from datetime import datetime
-import time
+import itertools
 import logging
 import asyncio
-import _thread
 from modular_bot.Module import BaseModule
+from modular_bot.scheduler import TimerScheduler
+from modular_bot.event_store import EventStore, ReminderEvent
+from modular_bot.event_index import EventIndex
+from modular_bot.sharding import shard_of
 
 
 class EventReminderModule(BaseModule):
     """
     Class for event reminder module. User can add event, see added events and remove added event by commands.
     Bot sends a reminder message that mentions everyone on server on time specified by user when adding event.
+    Events are kept in a database, so they survive restarts of the bot. Each guild sees and manages only its own
+    events, while reminders of all guilds share one timer. When bot runs as several workers, each worker reminds only
+    guilds on its own shards.
     """
     module_name = "Event Reminder Module"
     module_description = "Reminds everyone on server on time specified. Users can see and add/edit/remove events."
     commands = ["addevent", "listevent", "editevent", "removeevent"]
-    # Module specific variables
-    reminder_thread = False
-    events_list = []  # use list to hold events; list will be sorted every time item is added
+    command_handlers = {"addevent": "add_event", "listevent": "list_event", "editevent": "edit_event",
+                        "removeevent": "remove_event"}
 
-    async def parse_command(self, bundle):
+    def __init__(self, user_cmd_char, settings=None):
+        super().__init__(user_cmd_char, settings)
+        # Module specific variables
+        self.client = None
+        self.catchup_policy = self.settings.get("catchup_policy", "fire")
+        self.catchup_window = float(self.settings.get("catchup_window", 86400))
+        self.store = EventStore(self.settings.get("database", "events.db"),
+                                float(self.settings.get("batch_interval", 0.01)))
+        self.event_ids = None
+        self.scheduler = TimerScheduler(self.on_event_due)  # event id -> ReminderEvent, ordered by event time
+        self.index = EventIndex()  # events of each guild, ordered by event time
+        self.handed_over = False
+
+    async def on_ready(self, client):
         """
-        Decides which command should be executed and calls it.
-        :param bundle Dictionary passed in from caller.
+        Loads stored events of guilds on shards of this client into scheduler when bot connects for the first time.
+        Events missed while bot was offline are handled by catch-up policy.
+        :param client: discord.Client instance.
         :return: no return value.
         """
-        client = bundle.get("client")
-        message = bundle.get("message")
-        # Start reminder loop thread on first time when event reminder module is called
-        if not self.reminder_thread:
-            self.reminder_thread = True
-            _thread.start_new_thread(self.reminder_loop, (client, message))
-        # Decide which command to execute
-        if message.content.startswith(self.command_char + "addevent"):
-            await self.add_event(message)
-        elif message.content.startswith(self.command_char + "listevent"):
-            await self.list_event(message)
-        elif message.content.startswith(self.command_char + "editevent"):
-            await self.edit_event(message)
-        elif message.content.startswith(self.command_char + "removeevent"):
-            await self.remove_event(message)
+        if self.client is not None:  # reconnected; events are already loaded
+            self.client = client
+            return
+        self.client = client
+        await self.store.run(self.store.open)
+        events = await self.store.run(self.store.load)
+        shard_ids = getattr(client, "shard_ids", None)
+        if shard_ids is None:
+            self.event_ids = itertools.count(max([event.id for event in events], default=0) + 1)
+        else:
+            # workers share the database, so each one takes ids congruent to its first shard
+            last_id = max([event.id for event in events], default=0)
+            offset = min(shard_ids)
+            self.event_ids = itertools.count(last_id + 1 + (offset - last_id - 1) % client.shard_count,
+                                             client.shard_count)
+            events = [event for event in events if shard_of(event.guild_id, client.shard_count) in shard_ids]
+        now = datetime.now()
+        missed = [event for event in events if event.time <= now]
+        discarded = []
+        for event in missed:
+            missed_seconds = (now - event.time).total_seconds()
+            if self.catchup_policy == "fire" and (self.catchup_window <= 0 or missed_seconds <= self.catchup_window):
+                asyncio.ensure_future(self.send_reminder(event, late=True))
+            else:
+                logging.info("Discarding missed reminder for event " + event.name)
+                discarded.append(self.delete_event(event))
+        upcoming = [event for event in events if event.time > now]
+        self.scheduler.schedule_many([(event.id, event.time, event) for event in upcoming])
+        for event in upcoming:
+            self.index.add(event)
+        logging.info("Loaded " + str(len(events)) + " events (" + str(len(missed)) + " missed while offline)")
+        await asyncio.gather(*discarded)
 
-    def reminder_loop(self, client, message):
+    def export_state(self):
         """
-        Function to be executed in separate thread. This function polls time every 5 seconds, check events list and send
-        reminder if current time is equal or larger than event time.
-        :param client: discord.Client instance.
-        :param message: discord.Message instance.
+        Hands loaded events, database and timers over to reloaded module, so no reminder is lost or sent twice.
+        :return: Dictionary of state.
+        """
+        self.handed_over = True
+        return {"client": self.client, "store": self.store, "event_ids": self.event_ids,
+                "scheduler": self.scheduler, "index": self.index}
+
+    def restore_state(self, state):
+        """
+        Takes over state of previous instance. Timers fire callback of this instance from now on.
+        :param state: Dictionary returned by export_state.
         :return: no return value.
         """
-        target_channel = message.channel
-        while True:
-            if len(self.events_list) == 0:
-                pass  # Do nothing if event list is empty
-            elif datetime.now() >= self.events_list[0][1]:
-                asyncio.run_coroutine_threadsafe(self.send_reminder(target_channel), client.loop)
-            time.sleep(5)
+        self.client = state["client"]
+        self.store = state["store"]
+        self.event_ids = state["event_ids"]
+        self.scheduler = state["scheduler"]
+        self.scheduler.callback = self.on_event_due
+        self.index = state["index"]
 
-    async def send_reminder(self, channel):
+    async def on_unload(self):
         """
-        Coroutine to be called in separate thread to send reminder message.
-        :param channel: discord.Channel instance.
+        Stops timers and closes database unless they were handed over to a reloaded instance.
         :return: no return value.
         """
-        event_item = self.events_list.pop(0)
-        logging.info("Sending reminder for event " + event_item[0] + " on channel " + channel.name)
-        await channel.send("@everyone Reminder for event " + event_item[0])
+        if self.handed_over:
+            return
+        self.scheduler.stop()
+        await self.store.close()
 
-    async def add_event(self, message):
+    def on_event_due(self, event_id, event):
         """
-        Adds new event to event list. Command should be in format !addevent {event_name} {event_time}.
+        Callback from scheduler, called exactly once when event time is reached.
+        :param event_id: id of the event.
+        :param event: ReminderEvent instance.
+        :return: no return value.
+        """
+        self.index.remove(event)
+        asyncio.ensure_future(self.send_reminder(event))
+
+    async def send_reminder(self, event, late=False):
+        """
+        Coroutine to send reminder message to channel where event was added, and remove event from database.
+        :param event: ReminderEvent instance.
+        :param late: True if reminder was missed while bot was offline.
+        :return: no return value.
+        """
+        # removal is committed while reminder is being sent
+        deletion = asyncio.ensure_future(self.delete_event(event))
+        channel = self.client.get_channel(event.channel_id)
+        if channel is None:
+            logging.warning("Channel of event " + event.name + " is not available; reminder dropped")
+        else:
+            logging.info("Sending reminder for event " + event.name + " on channel " + channel.name)
+            if late:
+                await self.outbound.send(channel, "@everyone Reminder for event " + event.name + " (was due on " +
+                                         event.time.strftime("%Y-%m-%d %H:%M") + ")")
+            else:
+                await self.outbound.send(channel, "@everyone Reminder for event " + event.name)
+        await deletion
+
+    async def delete_event(self, event):
+        """
+        Removes event which was reminded or discarded from database. Failure is logged, since the reminder is done
+        either way; the event is then loaded and handled by catch-up policy again on next start.
+        :param event: ReminderEvent instance.
+        :return: no return value.
+        """
+        try:
+            await self.store.delete(event.id)
+        except Exception:
+            logging.warning("Could not remove event " + event.name + " from database; it may be reminded again "
+                            "after restart")
+
+    def get_guild_id(self, message):
+        """
+        Returns id of guild which message belongs to. Events are partitioned by this id.
         :param message: discord.Message instance.
+        :return: id of the guild, or None for direct messages.
+        """
+        if message.guild is None:
+            return None
+        return message.guild.id
+
+    async def add_event(self, command):
+        """
+        Adds new event to event list. Command should be in format !addevent {event_name} {event_time}.
+        :param command: Command instance.
         :return: no return value.
         """
+        message = command.message
         logging.info("Add Event requested by " + message.author.name + " on " + message.channel.name)
-        args_list = message.content.split(" ", maxsplit=2)
+        args_list = command.split_args(maxsplit=1)
         try:
-            event_name = args_list[1]
-            event_time = datetime.strptime(args_list[2], "%Y-%m-%d %H:%M")
+            event_name = args_list[0]
+            event_time = datetime.strptime(args_list[1], "%Y-%m-%d %H:%M")
         except IndexError:
-            await message.channel.send("`Usage: !addevent {event_name} {event_time}`")
+            await self.outbound.send(message.channel, "`Usage: !addevent {event_name} {event_time}`")
             return
         except ValueError:
-            await message.channel.send("Time must be in `YYYY-mm-dd HH:MM` format.")
+            await self.outbound.send(message.channel, "Time must be in `YYYY-mm-dd HH:MM` format.")
             return
         if event_time <= datetime.now():
-            await message.channel.send("Event cannot happen earlier than current time.")
+            await self.outbound.send(message.channel, "Event cannot happen earlier than current time.")
+            return
+        if self.event_ids is None:  # stored events are still being loaded
+            await self.outbound.send(message.channel, "Events are still loading. Try again in a moment.")
             return
-        self.events_list.append((event_name, event_time))
-        self.events_list = sorted(self.events_list, key=lambda x: x[1])  # sort events list by time in ascending order
-        await message.channel.send("Event " + event_name + " on " + str(event_time)[:-3] + " added by " + message.author.name)
+        event = ReminderEvent(next(self.event_ids), event_name, event_time, message.channel.id,
+                              self.get_guild_id(message))
+        self.scheduler.schedule(event.id, event.time, event)
+        self.index.add(event)
+        await self.store.put(event)
+        await self.outbound.send(message.channel, "Event " + event_name + " on " + str(event_time)[:-3] + " added by " +
+                                 message.author.name)
 
-    async def list_event(self, message):
+    async def list_event(self, command):
         """
         Lists all events currently stored in event list.
-        :param message: discord.Message instance.
+        :param command: Command instance.
         :return: no return value.
         """
+        message = command.message
         logging.info("List Event requested by " + message.author.name + " on " + message.channel.name)
-        if len(self.events_list) == 0:
-            await message.channel.send("Event list is empty.")
+        guild_id = self.get_guild_id(message)
+        if self.index.count(guild_id) == 0:
+            await self.outbound.send(message.channel, "Event list is empty.")
             return
         list_index = 1
         result_text = "Current event list:\n"
-        for event_item in self.events_list:
-            result_text += "\t" + str(list_index) + ". " + event_item[0] + " on " + str(event_item[1])[:-3] + "\n"
+        for event_id in self.index.event_ids(guild_id):
+            event = self.scheduler.get(event_id)[1]
+            result_text += "\t" + str(list_index) + ". " + event.name + " on " + str(event.time)[:-3]
+            if event.channel_id != message.channel.id:
+                result_text += " in <#" + str(event.channel_id) + ">"
+            result_text += "\n"
             list_index += 1
-        await message.channel.send(result_text)
+        await self.outbound.send(message.channel, result_text)
 
-    async def edit_event(self, message):
+    async def edit_event(self, command):
         """
         Edits event in event list. Uses index to identify event item.
         Command: !editevent {index} {new_name} {new time}
-        :param message: discord.Message instance.
+        :param command: Command instance.
         :return: no return value.
         """
+        message = command.message
         logging.info("Edit Event requested by " + message.author.name + " on " + message.channel.name)
-        if len(self.events_list) == 0:
-            await message.channel.send("Event list is empty. Nothing to edit!")
+        guild_id = self.get_guild_id(message)
+        if self.index.count(guild_id) == 0:
+            await self.outbound.send(message.channel, "Event list is empty. Nothing to edit!")
             return
-        args_list = message.content.split(" ", maxsplit=3)
-        if len(args_list) != 4:
-            await message.channel.send("`Usage: !editevent {index} {new_name} {new_time}`")
+        args_list = command.split_args(maxsplit=2)
+        if len(args_list) != 3:
+            await self.outbound.send(message.channel, "`Usage: !editevent {index} {new_name} {new_time}`")
             return
         try:
-            if args_list[1] == 0:  # assume user picked first item
-                list_index = 1
-            else:
-                list_index = int(args_list[1]) - 1
-            old_event_item = self.events_list[list_index]
+            list_index = max(int(args_list[0]), 1) - 1  # assume user picked first item if index is 0
+            old_event = self.scheduler.get(self.index.event_id_at(guild_id, list_index))[1]
         except ValueError:
-            await message.channel.send("Invalid index. Use index from `!listevent` command.")
+            await self.outbound.send(message.channel, "Invalid index. Use index from `!listevent` command.")
             return
         except IndexError:
-            await message.channel.send("Index out of bounds. Check index using `!listevent` command.")
+            await self.outbound.send(message.channel, "Index out of bounds. Check index using `!listevent` command.")
             return
-        new_event_name = args_list[2]
+        new_event_name = args_list[1]
         try:
-            new_event_time = datetime.strptime(args_list[3], "%Y-%m-%d %H:%M")
+            new_event_time = datetime.strptime(args_list[2], "%Y-%m-%d %H:%M")
             if new_event_time <= datetime.now():
-                await message.channel.send("Event cannot happen earlier than current time.")
+                await self.outbound.send(message.channel, "Event cannot happen earlier than current time.")
                 return
         except ValueError:
-            await message.channel.send("Time must be in `YYYY-mm-dd HH:MM` format.")
+            await self.outbound.send(message.channel, "Time must be in `YYYY-mm-dd HH:MM` format.")
             return
-        self.events_list[list_index] = (new_event_name, new_event_time)
-        self.events_list = sorted(self.events_list, key=lambda x: x[1])
-        result_text = "Discarded: Event " + old_event_item[0] + " on " + str(old_event_item[1])[:-3] + "\n"
+        new_event = old_event._replace(name=new_event_name, time=new_event_time)
+        self.scheduler.schedule(new_event.id, new_event.time, new_event)
+        self.index.remove(old_event)
+        self.index.add(new_event)
+        await self.store.put(new_event)
+        result_text = "Discarded: Event " + old_event.name + " on " + str(old_event.time)[:-3] + "\n"
         result_text += "Added: Event " + new_event_name + " on " + str(new_event_time)[:-3]
-        await message.channel.send(result_text)
+        await self.outbound.send(message.channel, result_text)
 
-    async def remove_event(self, message):
+    async def remove_event(self, command):
         """
         Removes event in event list. Uses index to identify event item.
         Command: !removeevent {index}
-        :param message: discord.Message instance.
+        :param command: Command instance.
         :return: no return value.
         """
+        message = command.message
         logging.info("Remove Event requested by " + message.author.name + " on " + message.channel.name)
-        if len(self.events_list) == 0:
-            await message.channel.send("Event list is empty. Nothing to remove!")
+        guild_id = self.get_guild_id(message)
+        if self.index.count(guild_id) == 0:
+            await self.outbound.send(message.channel, "Event list is empty. Nothing to remove!")
             return
         try:
-            remove_index = int(message.content[13:])
-            if remove_index == 0:  # assume user picked first item
-                remove_index = 1
-            removed_event = self.events_list.pop(remove_index - 1)
+            remove_index = max(int(command.args), 1) - 1  # assume user picked first item if index is 0
+            event_id = self.index.event_id_at(guild_id, remove_index)
         except ValueError:
-            await message.channel.send("`Usage: !removeevent {event_index}`\n"
-                                       "You can check index of event using `!listevent` command.")
+            await self.outbound.send(message.channel, "`Usage: !removeevent {event_index}`\n"
+                                     "You can check index of event using `!listevent` command.")
             return
         except IndexError:
-            await message.channel.send("Index out of bounds. Use `!listevent` command to check index.")
+            await self.outbound.send(message.channel, "Index out of bounds. Use `!listevent` command to check index.")
             return
-        await message.channel.send("Removed event " + removed_event[0] + " from event list.")
+        removed_event = self.scheduler.cancel(event_id)
+        self.index.remove(removed_event)
+        await self.store.delete(event_id)
+        await self.outbound.send(message.channel, "Removed event " + removed_event.name + " from event list.")
@@ -1,8 +1,78 @@
 import logging
-import requests
 from bs4 import BeautifulSoup
 import discord
 from modular_bot.Module import BaseModule
+from modular_bot.http_client import FetchError
+
+
+def parse_player_page(response):
+    """
+    Parses player page of best.gg. Profile, top champions and recent matches are read in one pass, so all commands
+    of the module can share the parsed result. Each section is parsed on its own, so a section missing from the page
+    does not hide the others.
+    :param response: HttpResponse of player page.
+    :return: Dictionary with "name", "profile", "champions" and "matches" entries, each None if it is not found.
+    """
+    soup = BeautifulSoup(response.text, "lxml")
+    info_div = soup.find("div", {"class": "player__profile-info"})
+    try:
+        player_name = info_div.find("div", {"class": "player__profile-info-name"}).text
+    except (AttributeError, TypeError):
+        player_name = None
+    try:
+        # Parse html elements and get needed values
+        img_tag = soup.find("img", {"class": "player__profile-face-img"})
+        player_birth_div = info_div.find("div", {"class": "player__profile-info-birth"}).find("span")
+        profile = {
+            "image": None if img_tag is None else "http:" + img_tag["src"],
+            "name": player_name,
+            "team": info_div.find("div", {"class": "player__profile-info-team-team"}).text,
+            "league": info_div.find("span", {"class": "player__profile-info-team-league"}).text,
+            "position": info_div.find("div", {"class": "player__profile-info-team-position"}).text,
+            "realname": info_div.find("span", {"class": "player__profile-info-full-name-name"}).text,
+            # Birth date is not always provided
+            "birth": " " if player_birth_div is None else player_birth_div.text
+        }
+        if player_name is None:
+            profile = None
+    except (AttributeError, TypeError):
+        profile = None
+    try:
+        champions = []
+        # Only keep first 5 from list of li tags
+        for champ in soup.findAll("li", {"class": "topChampions__item"})[:5]:
+            champions.append({
+                "name": champ.find("div", {"class": "topChampions__item-champ-info-name"}).text,
+                "kda": champ.find("div", {"class": "topChampions__item-kda-count"}).text,
+                "winrate": champ.find("div", {"class": "topChampions__item-winRate-percent"}).text,
+                "played": champ.find("div", {"class": "topChampions__item-winRate-played"}).text
+            })
+    except (AttributeError, TypeError):
+        champions = None
+    try:
+        matches = []
+        for match in soup.findAll("div", {"class": "player__matches-item"}):
+            sets = []
+            for set_item in match.find("ul", {"class": "player__matches-sets"}).findAll("li"):
+                sets.append({
+                    "number": set_item.find("div", {"class": "player__matches-set-info-set"}).text,
+                    "result": set_item.find("div", {"class": "player__matches-set-info-win"}).text,
+                    "time": set_item.find("div", {"class": "player__matches-set-info-time"}).text,
+                    "champion": set_item.find("div", {"class": "player__matches-set-champion-name"}).text,
+                    "kda": set_item.find("div", {"class": "player__matches-set-kda-detail"}).text
+                })
+            matches.append({
+                "name": match.find("div", {"class": "player__matches-item-content-header-info-name"}).text,
+                "date": match.find("div", {"class": "player__matches-item-content-header-info-date"}).text,
+                "my_team": match.find("span",
+                                      {"class": "player__matches-item-content-header-match-info-my-team"}).text,
+                "enemy": match.find("span", {"class": "player__matches-item-content-header-match-info-opponent"})
+                              .find("span").text,
+                "sets": sets
+            })
+    except (AttributeError, TypeError):
+        matches = None
+    return {"name": player_name, "profile": profile, "champions": champions, "matches": matches}
 
 
 class LOLEsportsModule(BaseModule):
@@ -13,137 +83,97 @@ class LOLEsportsModule(BaseModule):
     module_description = "Fetches profile, top champions used or recent official matches of professional League of" \
                          " Legends player. All data referenced from best.gg."
     commands = ["lol_player", "lol_topchamps", "lol_recent"]
+    command_handlers = {"lol_player": "get_player_info", "lol_topchamps": "get_top_champs",
+                        "lol_recent": "get_recent_match"}
+    # Player pages change only after matches; keep them for 5 minutes
+    cache_ttl = 300
+    base_url = "http://best.gg/player/"
 
-    async def parse_command(self, bundle):
+    async def get_player_page(self, command, *sections):
         """
-        Decides which command should be executed and calls it.
-        :param bundle Dictionary passed in from caller.
-        :return: no return value.
+        Fetches and parses player page of given player. Sends error message to channel on failure.
+        :param command: Command instance.
+        :param sections: names of sections of the page the command needs.
+        :return: parsed player page, or None if player or any of the sections is not found.
         """
-        client = bundle.get("client")
-        message = bundle.get("message")
-        if message.content.startswith(self.command_char + "lol_player"):
-            await self.get_player_info(client, message)
-        elif message.content.startswith(self.command_char + "lol_topchamps"):
-            await self.get_top_champs(client, message)
-        elif message.content.startswith(self.command_char + "lol_recent"):
-            await self.get_recent_match(client, message)
+        message = command.message
+        search_arg = command.args
+        if len(search_arg) == 0:
+            await self.outbound.send(message.channel, "No user name is provided!")
+            return None
+        target_url = self.base_url + search_arg
+        try:
+            async with self.outbound.typing(message.channel):
+                page = await self.fetch_parsed(target_url, parse_player_page, headers={"Accept-Language": "en-US"})
+        except FetchError:
+            await self.outbound.send(message.channel, "Could not reach best.gg. Try again later.")
+            return None
+        if any(page[section] is None for section in sections):
+            await self.outbound.send(message.channel, "Player not found.")
+            return None
+        return page
 
-    async def get_player_info(self, client, message):
+    async def get_player_info(self, command):
         """
         Gets profile of player, makes embed and returns to server as message. Fetches data from best.gg.
-        :param client: discord.Client instance.
-        :param message: discord.Message instance.
+        :param command: Command instance.
         :return: no return value.
         """
+        message = command.message
         logging.info("lol_player requested by " + message.author.name + " on " + message.channel.name)
-        search_arg = message.content[12:]
-        if len(search_arg) == 0:
-            await client.send_message(message.channel, "No user name is provided!")
+        page = await self.get_player_page(command, "profile")
+        if page is None:
             return
-        target_url = "http://best.gg/player/" + search_arg
-        await client.send_typing(message.channel)
-        raw_page = requests.get(target_url, headers={"Accept-Language": "en-US"})
-        soup = BeautifulSoup(raw_page.text, "lxml")
-        try:
-            # Parse html elements and get needed values
-            img_src = "http:" + soup.find("img", {"class": "player__profile-face-img"})["src"]
-            info_div = soup.find("div", {"class": "player__profile-info"})
-            player_name = info_div.find("div", {"class": "player__profile-info-name"}).text
-            player_team = info_div.find("div", {"class": "player__profile-info-team-team"}).text
-            player_league = info_div.find("span", {"class": "player__profile-info-team-league"}).text
-            player_position = info_div.find("div", {"class": "player__profile-info-team-position"}).text
-            player_realname = info_div.find("span", {"class": "player__profile-info-full-name-name"}).text
-            player_birth_div = info_div.find("div", {"class": "player__profile-info-birth"}).find("span")
-            # Birth date is not always provided
-            if player_birth_div is None:
-                player_birth = " "
-            else:
-                player_birth = player_birth_div.text
-            # Create embed to send back
-            result_embed = discord.Embed(title=player_realname, description=player_birth)
-            result_embed.set_author(name=player_name, url=target_url)
-            result_embed.set_thumbnail(url=img_src)
-            result_embed.add_field(name="TEAM", value=player_team, inline=True)
-            result_embed.add_field(name="LEAGUE", value=player_league, inline=True)
-            result_embed.add_field(name="POSITION", value=player_position, inline=True)
-        except (AttributeError, TypeError):
-            await client.send_message(message.channel, "Player not found.")
-            return
-        await client.send_message(message.channel, embed=result_embed)
+        profile = page["profile"]
+        # Create embed to send back
+        result_embed = discord.Embed(title=profile["realname"], description=profile["birth"])
+        result_embed.set_author(name=profile["name"], url=self.base_url + command.args)
+        if profile["image"] is not None:
+            result_embed.set_thumbnail(url=profile["image"])
+        result_embed.add_field(name="TEAM", value=profile["team"], inline=True)
+        result_embed.add_field(name="LEAGUE", value=profile["league"], inline=True)
+        result_embed.add_field(name="POSITION", value=profile["position"], inline=True)
+        await self.outbound.send(message.channel, embed=result_embed)
 
-    async def get_top_champs(self, client, message):
+    async def get_top_champs(self, command):
         """
         Gets top 5 champions used by player this year, makes embed and returns to server as message.
         Fetches data from best.gg.
-        :param client: discord.Client instance.
-        :param message: discord.Message instance.
+        :param command: Command instance.
         :return: no return value.
         """
+        message = command.message
         logging.info("lol_topchamps requested by " + message.author.name + " on " + message.channel.name)
-        search_arg = message.content[15:]
-        if len(search_arg) == 0:
-            await client.send_message(message.channel, "No user name is provided!")
+        page = await self.get_player_page(command, "name", "champions")
+        if page is None:
             return
-        target_url = "http://best.gg/player/" + search_arg
-        await client.send_typing(message.channel)
-        raw_page = requests.get(target_url, headers={"Accept-Language": "en-US"})
-        soup = BeautifulSoup(raw_page.text, "lxml")
-        try:
-            # parse html elements and get needed values
-            info_div = soup.find("div", {"class": "player__profile-info"})
-            player_name = info_div.find("div", {"class": "player__profile-info-name"}).text
-            result_embed = discord.Embed(title="Top 5 Champions Used")
-            result_embed.set_author(name=player_name)
-            champ_list = soup.findAll("li", {"class": "topChampions__item"})
-            # Only show first 5 from list of li tags
-            for champ in champ_list[:5]:
-                champ_name = champ.find("div", {"class": "topChampions__item-champ-info-name"}).text
-                champ_kda = champ.find("div", {"class": "topChampions__item-kda-count"}).text
-                champ_winrate = champ.find("div", {"class": "topChampions__item-winRate-percent"}).text
-                champ_played = champ.find("div", {"class": "topChampions__item-winRate-played"}).text
-                result_embed.add_field(name=champ_name, value=champ_kda + " / " + champ_winrate + " / " + champ_played, inline=False)
-        except (AttributeError, TypeError):
-            await client.send_message(message.channel, "Player not found.")
-            return
-        await client.send_message(message.channel, embed=result_embed)
+        result_embed = discord.Embed(title="Top 5 Champions Used")
+        result_embed.set_author(name=page["name"])
+        for champ in page["champions"]:
+            result_embed.add_field(name=champ["name"],
+                                   value=champ["kda"] + " / " + champ["winrate"] + " / " + champ["played"],
+                                   inline=False)
+        await self.outbound.send(message.channel, embed=result_embed)
 
-    async def get_recent_match(self, client, message):
+    async def get_recent_match(self, command):
         """
         Gets recent matches of player, makes embed and returns to server as message. Fetches data from best.gg.
-        :param client: discord.Client instance.
-        :param message: discord.Message instance.
+        :param command: Command instance.
         :return: no return value.
         """
+        message = command.message
         logging.info("lol_recent requested by " + message.author.name + " on " + message.channel.name)
-        search_arg = message.content[12:]
-        if len(search_arg) == 0:
-            await client.send_message(message.channel, "No user name is provided!")
-            return
-        target_url = "http://best.gg/player/" + search_arg
-        await client.send_typing(message.channel)
-        raw_page = requests.get(target_url, headers={"Accept-Language": "en-US"})
-        soup = BeautifulSoup(raw_page.text, "lxml")
-        try:
-            matches = soup.findAll("div", {"class": "player__matches-item"})
-            for match in matches:
-                match_name = match.find("div", {"class": "player__matches-item-content-header-info-name"}).text
-                match_date = match.find("div", {"class": "player__matches-item-content-header-info-date"}).text
-                match_myteam = match.find("span", {"class": "player__matches-item-content-header-match-info-my-team"}).text
-                match_enemy = match.find("span", {"class": "player__matches-item-content-header-match-info-opponent"}).find("span").text
-                result_embed = discord.Embed(title=match_name, description=match_date)
-                result_embed.set_author(name=match_myteam + " vs " + match_enemy)
-                sets = match.find("ul", {"class": "player__matches-sets"}).findAll("li")
-                for set_item in sets:
-                    set_number = set_item.find("div", {"class": "player__matches-set-info-set"}).text
-                    set_result = set_item.find("div", {"class": "player__matches-set-info-win"}).text
-                    set_time = set_item.find("div", {"class": "player__matches-set-info-time"}).text
-                    set_champ = set_item.find("div", {"class": "player__matches-set-champion-name"}).text
-                    set_kda = set_item.find("div", {"class": "player__matches-set-kda-detail"}).text
-                    result_embed.add_field(name=set_number, value=set_time + " / " + set_result, inline=True)
-                    result_embed.add_field(name="Champion", value=set_champ, inline=True)
-                    result_embed.add_field(name="KDA", value=set_kda, inline=True)
-                await client.send_message(message.channel, embed=result_embed)
-        except (AttributeError, TypeError):
-            await client.send_message(message.channel, "Player not found.")
+        page = await self.get_player_page(command, "matches")
+        if page is None:
             return
+        result_embeds = []
+        for match in page["matches"]:
+            result_embed = discord.Embed(title=match["name"], description=match["date"])
+            result_embed.set_author(name=match["my_team"] + " vs " + match["enemy"])
+            for set_item in match["sets"]:
+                result_embed.add_field(name=set_item["number"], value=set_item["time"] + " / " + set_item["result"],
+                                       inline=True)
+                result_embed.add_field(name="Champion", value=set_item["champion"], inline=True)
+                result_embed.add_field(name="KDA", value=set_item["kda"], inline=True)
+            result_embeds.append(result_embed)
+        await self.outbound.send_embeds(message.channel, result_embeds)
@@ -1,358 +1,499 @@
+import asyncio
 import discord
 import logging
-import asyncio
-import queue
 import os
 from modular_bot.Module import BaseModule
+from modular_bot.audio_effects import frames_for
+from modular_bot.music_library import MusicLibrary, display_name
+from modular_bot.music_session import MusicSession, PLAYING, PAUSED
+from modular_bot.opus_cache import OpusCache, OpusCacheError
+from modular_bot.track_resolver import TrackResolver, TrackError
+
+# Number of songs listed by search_local
+MAX_SEARCH_RESULTS = 10
 
 
 class MusicModule(BaseModule):
     """
-    Class for music module. Music module supports streaming audio from youtube url or local files. User can switch
-    between each player instance anytime, but all queue or playlist index data will be lost during switching.
+    Class for music module. Music module supports streaming audio from youtube url or local files. Every guild gets
+    its own player session with its own voice connection and queue, created on first use and closed when idle. User
+    can switch between youtube and local files after stopping the player, but queue is emptied on stop.
     """
     module_name = "Music Module"
-    module_description = "Streams audio from Youtube URLs or local mp3 files. Users can add musics if playing on" \
-                         " Youtube player, but local file player has a fixed playlist(order by filename). Users can" \
-                         " skip, pause or change volume while playing."
-    commands = ["play", "play_local", "stop", "pause", "resume", "skip", "volume", "music", "musicoff"]
-    # Module specific variables
-    function_dict = {}
-    voice_channel = ""
-    voice_client = None
-    current_player = None
-    song_queue = queue.Queue(0)
-    local_song_list = []
-    local_song_index = 0
-    player_switch = False
-    is_playing = False
-    is_local = False
+    module_description = "Streams audio from Youtube URLs or local music files. Users can add musics if playing on" \
+                         " Youtube player. Local files are indexed with their tags, so users can search them, queue" \
+                         " them by title or artist and shuffle the playlist. Users can skip, pause, change volume" \
+                         " or lower music for a while to talk over it while playing."
+    commands = ["play", "play_local", "queue_local", "search_local", "shuffle", "rescan_local", "stop", "pause",
+                "resume", "skip", "volume", "duck", "music", "musicoff"]
+    command_handlers = {"play": "play", "play_local": "play_local", "queue_local": "queue_local",
+                        "search_local": "search_local", "shuffle": "shuffle", "rescan_local": "rescan_local",
+                        "stop": "stop", "pause": "pause", "resume": "resume", "skip": "skip", "volume": "volume",
+                        "duck": "duck", "music": "music", "musicoff": "musicoff"}
+    # Each guild has its own session, so commands of different guilds don't wait for each other
+    max_concurrency = 8
+    max_backlog = 32
     default_volume = 0.15
+    # Number of upcoming songs in queue resolved in background while current song plays
+    prefetch_count = 2
+    # Seconds a session may have nothing to play before it disconnects
+    idle_timeout = 300.0
+    # Seconds songs overlap when one song ends and next begins. 0 plays songs back to back
+    crossfade = 0.0
+    # Seconds a volume change takes, so it never clicks
+    volume_ramp = 0.25
+    # Volume multiplier while music is ducked by !duck
+    duck_level = 0.3
+    # Seconds music stays ducked if !duck is given no duration
+    duck_seconds = 30.0
 
-    def initialize_function_dict(self):
-        """
-        Initializes dictionary for functions. Result of refactoring if-elif statements.
-        :return: No return value.
-        """
-        self.function_dict[self.command_char + "play"] = self.play
-        self.function_dict[self.command_char + "play_local"] = self.play_local
-        self.function_dict[self.command_char + "stop"] = self.stop
-        self.function_dict[self.command_char + "pause"] = self.pause
-        self.function_dict[self.command_char + "resume"] = self.resume
-        self.function_dict[self.command_char + "skip"] = self.skip
-        self.function_dict[self.command_char + "volume"] = self.volume
-        self.function_dict[self.command_char + "music"] = self.music
-        self.function_dict[self.command_char + "musicoff"] = self.musicoff
+    def __init__(self, user_cmd_char, settings=None):
+        super().__init__(user_cmd_char, settings)
+        self.prefetch_count = int(self.settings.get("prefetch_count", self.prefetch_count))
+        self.idle_timeout = float(self.settings.get("idle_timeout", self.idle_timeout))
+        self.crossfade_frames = frames_for(float(self.settings.get("crossfade", self.crossfade)))
+        self.ramp_frames = frames_for(float(self.settings.get("volume_ramp", self.volume_ramp)))
+        self.duck_level = float(self.settings.get("duck_level", self.duck_level))
+        self.duck_seconds = float(self.settings.get("duck_seconds", self.duck_seconds))
+        self.resolver = TrackResolver(fallback_ttl=float(self.settings.get("stream_url_ttl", 1800)))
+        self.library = MusicLibrary(os.path.join(os.getcwd(), self.settings.get("library_path", "music_cache")),
+                                    self.settings.get("library_database", "music_library.db"))
+        # Local files are encoded to Opus once; later plays send cached packets without ffmpeg
+        self.opus_cache = None
+        if self.settings.get("opus_cache", "1") == "1":
+            self.opus_cache = OpusCache(os.path.join(os.getcwd(), self.settings.get("opus_cache_path", "opus_cache")),
+                                        bitrate=int(self.settings.get("opus_bitrate", 128)), gain=self.default_volume,
+                                        max_bytes=int(self.settings.get("opus_cache_max_bytes", 2147483648)))
+        self.sessions = {}  # guild id -> MusicSession
+        self.client = None
+
+    def export_state(self):
+        # Voice connections are kept across reload; sessions use resolver and library of the new instance
+        state = (self.sessions, self.client)
+        self.sessions = {}
+        return state
+
+    def restore_state(self, state):
+        self.sessions, self.client = state
+        for session in self.sessions.values():
+            session.module = self
+
+    async def on_unload(self):
+        for session in list(self.sessions.values()):
+            await session.close()
+        await self.library.close()
 
-    def clear_attributes(self):
+    async def update_presence(self):
         """
-        Clears all data holding attributes of class on end of connection.
+        Shows song started most recently in any guild as game of the bot, or nothing if no guild is playing.
         :return: No return value.
         """
-        self.song_queue = queue.Queue(0)
-        self.local_song_list = []
-        self.local_song_index = 0
-        self.player_switch = False
-        self.is_playing = False
-        self.is_local = False
+        if self.client is None:
+            return
+        playing = [session for session in self.sessions.values() if session.state in (PLAYING, PAUSED)]
+        activity = None
+        if playing:
+            activity = discord.Game(name=max(playing, key=lambda session: session.started_at).title)
+        try:
+            await self.client.change_presence(activity=activity)
+        except Exception:
+            logging.exception("Could not update presence")
 
-    def end_song(self, client, message):
+    def cache_local(self, tracks):
         """
-        Function to be executed after youtube player stops.
-        :param client: discord.Client instance.
-        :param message: discord.Message instance.
+        Starts encoding local songs which are not in Opus cache yet in background.
+        :param tracks: list of LibraryTrack.
         :return: No return value.
         """
-        if not self.player_switch:
-            self.current_player = None
+        if self.opus_cache is None:
             return
-        logging.info("Playing next song in queue")
-        if self.song_queue.qsize() == 0:
-            logging.info("Queue is empty; stopping player")
-            self.is_playing = False
-            asyncio.run_coroutine_threadsafe(self.end_song_queue_empty(client), client.loop)
+        for track in tracks:
+            if not self.opus_cache.has(self.library.digest_of(track)):
+                asyncio.ensure_future(self.add_to_cache(track))
+
+    async def add_to_cache(self, track):
+        try:
+            digest = await self.opus_cache.add(self.library.full_path(track))
+        except (OpusCacheError, OSError) as e:
+            logging.warning("Could not cache " + track.path + ": " + str(e))
             return
-        # Setup new player in different thread
-        asyncio.run_coroutine_threadsafe(self.end_song_await_ytdl_player(client, message), client.loop)
+        self.library.set_digest(track, digest)
 
-    async def end_song_queue_empty(self, client):
-        """
-        Empties now playing status if queue exhausts.
-        :param client: discord.Client instance.
-        :return: No return value.
-        """
-        await client.change_presence(game=None)
+    def session_closed(self, session):
+        if self.sessions.get(session.guild_id) is session:
+            del self.sessions[session.guild_id]
+
+    def find_voice_channel(self, command):
+        """
+        Finds voice channel to play in: the one the author is in, or voice channel from config if it belongs to the
+        guild of the message.
+        :param command: Command instance.
+        :return: discord.VoiceChannel instance, or None if there is none.
+        """
+        voice_state = getattr(command.author, "voice", None)
+        if voice_state is not None and voice_state.channel is not None:
+            return voice_state.channel
+        if command.vchannel:
+            channel = command.client.get_channel(int(command.vchannel))
+            if channel is not None and channel.guild == command.message.guild:
+                return channel
+        return None
+
+    async def get_session(self, command, create=True):
+        """
+        Returns music session of guild of the message, connecting to voice channel if guild has none. Replies to
+        user if there is no session and none can be created.
+        :param command: Command instance.
+        :param create: False to only look up existing session.
+        :return: MusicSession instance, or None.
+        """
+        message = command.message
+        if message.guild is None:
+            await self.outbound.send(message.channel, "Music can only be played in servers.")
+            return None
+        session = self.sessions.get(message.guild.id)
+        if session is not None:
+            session.channel = message.channel
+            return session
+        if not create:
+            await self.outbound.send(message.channel, "Player is offline. Turn on player first by !music command.")
+            return None
+        voice_channel = self.find_voice_channel(command)
+        if voice_channel is None:
+            await self.outbound.send(message.channel, "Join a voice channel first.")
+            return None
+        # Concurrent commands of the same guild share one connection
+        return await self.in_flight.do(("voice", message.guild.id), lambda: self.connect(command, voice_channel))
 
-    async def end_song_await_ytdl_player(self, client, message):
+    async def connect(self, command, voice_channel):
+        """
+        Connects to voice channel and starts session of its guild. Called through get_session.
+        :param command: Command instance.
+        :param voice_channel: discord.VoiceChannel instance.
+        :return: MusicSession instance.
+        """
+        self.client = command.client
+        voice_client = await voice_channel.connect()
+        session = MusicSession(self, voice_channel.guild.id, voice_client, command.message.channel)
+        self.sessions[session.guild_id] = session
+        session.start()
+        logging.info("Music player connected to " + voice_channel.name + " of guild " + str(session.guild_id))
+        return session
+
+    async def music(self, command):
         """
-        Sets up new youtube player instance and sends now playing message.
-        Wrapped in asyncio to be included in non-async function.
-        :param client: discord.Client instance.
-        :param message: discord.Message instance.
+        Turns on the music player and connects client to voice channel of the author, or voice channel in config.
+        :param command: Command instance.
         :return: No return value.
         """
-        target_song = self.song_queue.get()
-        self.current_player = await self.voice_client.create_ytdl_player(target_song,
-                                                                         after=lambda: self.end_song(client, message))
-        self.current_player.volume = self.default_volume
-        self.current_player.start()
-        await client.change_presence(game=discord.Game(name=self.current_player.title))
-        await client.send_message(message.channel, "Now Playing " + self.current_player.title)
+        message = command.message
+        logging.info("music requested by " + message.author.name + " on " + message.channel.name)
+        if message.guild is not None and message.guild.id in self.sessions:
+            await self.outbound.send(message.channel, "Music player is already on.")
+            return
+        if await self.get_session(command) is not None:
+            await self.outbound.send(message.channel, ":musical_note: Turning on music player!")
 
-    def end_song_local(self, client, message):
+    async def musicoff(self, command):
         """
-        Function to be executed after local music player stops.
-        :param client: discord.Client instance.
-        :param message: discord.Message instance.
+        Turns off music player and disconnects from voice channel. Queue of the guild is cleared.
+        :param command: Command instance.
         :return: No return value.
         """
-        if not self.player_switch:
-            self.current_player = None
-            return
-        if len(self.local_song_list) == 0:
+        message = command.message
+        logging.info("musicoff requested by " + message.author.name + " on " + message.channel.name)
+        session = self.sessions.get(message.guild.id) if message.guild is not None else None
+        if session is None:
+            await self.outbound.send(message.channel, "Music player is already off.")
             return
-        logging.info("Playing next song in playlist")
-        local_music_path = os.getcwd() + "/music_cache"
-        self.local_song_index += 1
-        if self.local_song_index == len(self.local_song_list):
-            self.local_song_index = 0
-        self.current_player = self.voice_client.create_ffmpeg_player(local_music_path + "/" +
-                                                                     self.local_song_list[self.local_song_index],
-                                                                     after=lambda: self.end_song_local(client, message))
-        self.current_player.volume = self.default_volume
-        # Send message must be awaited; run in different thread
-        asyncio.run_coroutine_threadsafe(self.end_song_local_await_send_message(client, message), client.loop)
-        self.current_player.start()
+        await session.close()
+        await self.outbound.send(message.channel, "Turning off music player!")
 
-    async def end_song_local_await_send_message(self, client, message):
+    async def stop(self, command):
         """
-        Sends now playing message; wrapped by asyncio to be included in non-async function.
-        :param client: discord.Client instance.
-        :param message: discord.Message instance.
+        Stops current song and empties queue. Player must be stopped first to switch between youtube player or local
+        file player.
+        :param command: Command instance.
         :return: No return value.
         """
-        song_name = self.local_song_list[self.local_song_index]
-        song_name = song_name[:len(song_name) - 4]
-        await client.change_presence(game=discord.Game(name=song_name))
-        await client.send_message(message.channel, "Now Playing " + song_name)
+        message = command.message
+        logging.info("stop requested by " + message.author.name + " on " + message.channel.name)
+        session = await self.get_session(command, create=False)
+        if session is None:
+            return
+        session.stop()
+        await self.outbound.send(message.channel, "Player stopped.")
 
-    async def parse_command(self, bundle):
+    async def play(self, command):
         """
-        Decides which command should be executed and calls it.
-        :param bundle Dictionary passed in from caller.
-        :return: no return value.
+        Streams audio to voice channel from youtube video of given url. If youtube player is already playing, adds
+        url to song queue. Turns on player if it is off.
+        :param command: Command instance.
+        :return: No return value.
         """
-        client = bundle.get("client")
-        message = bundle.get("message")
-        self.voice_channel = bundle.get("vchannel")
-        await self.function_dict[message.content.split(" ")[0]](client, message)
+        message = command.message
+        logging.info("play requested by " + message.author.name + " on " + message.channel.name)
+        session = await self.get_session(command)
+        if session is None:
+            return
+        if session.is_local:
+            await self.outbound.send(message.channel,
+                                     "Local file player is already online. Use !stop to stop it first and try again.")
+            return
+        url = command.args
+        # Resolved song is kept, so it is not resolved again when its turn comes
+        try:
+            track = await self.resolver.resolve(url)
+        except TrackError as e:
+            logging.warning("Could not load " + url + ": " + str(e))
+            await self.outbound.send(message.channel, "Could not load `" + url + "`.")
+            return
+        busy = session.is_busy()
+        session.enqueue([url])
+        if busy:
+            await self.outbound.send(message.channel, "Added " + track.title + " to queue (Current queue size: " +
+                                     str(session.queue.qsize()) + ")")
 
-    async def music(self, client, message):
+    async def play_local(self, command):
         """
-        Turns on the music player and connects client to voice channel.
-        :param client: discord.Client instance.
-        :param message: discord.Message instance.
+        Streams audio to voice channel from local music files in library. If local player is already playing, do
+        nothing. Playlist is every file in library ordered by path, or files matching search words if they are given,
+        and repeats until player is stopped.
+        Command: !play_local [search words]
+        :param command: Command instance.
         :return: No return value.
         """
-        logging.info("music requested by " + message.author.name + " on " + message.channel.name)
-        if self.player_switch:
-            await client.send_message(message.channel, "Music player is already on.")
+        message = command.message
+        logging.info("play_local requested by " + message.author.name + " on " + message.channel.name)
+        session = await self.get_session(command)
+        if session is None:
             return
-        self.voice_client = await client.join_voice_channel(client.get_channel(self.voice_channel))
-        self.player_switch = True
-        await client.send_message(message.channel, ":musical_note: Turning on music player!")
+        if session.is_local:
+            await self.outbound.send(message.channel, ":x: I'm already playing local music.")
+            return
+        if session.is_busy():
+            await self.outbound.send(message.channel,
+                                     "Youtube player is already online. Use !stop to stop it first and try again.")
+            return
+        await self.library.load()
+        if len(command.args) > 0:
+            playlist = self.library.search(command.args)
+        else:
+            playlist = list(self.library.tracks)
+        logging.info("Added " + str(len(playlist)) + " songs to playlist")
+        if len(playlist) == 0:
+            await self.outbound.send(message.channel, "No matching music in library." if len(command.args) > 0
+                                     else "Music library is empty.")
+            return
+        session.is_local = True
+        session.enqueue(playlist)
 
-    async def musicoff(self, client, message):
+    async def queue_local(self, command):
         """
-        Turns off music player and disconnects from voice channel. All data holding attributes are cleared.
-        :param client: discord.Client instance.
-        :param message: discord.Message instance.
+        Adds local files matching search words to playlist, right after current song. Starts local player if nothing
+        is playing.
+        Command: !queue_local {search words}
+        :param command: Command instance.
         :return: No return value.
         """
-        logging.info("musicoff requested by " + message.author.name + " on " + message.channel.name)
-        if not self.player_switch:
-            await client.send_message(message.channel, "Music player is already off.")
+        message = command.message
+        logging.info("queue_local requested by " + message.author.name + " on " + message.channel.name)
+        if len(command.args) == 0:
+            await self.outbound.send(message.channel, "`Usage: !queue_local {title or artist}`")
             return
-        self.clear_attributes()
-        try:
-            self.current_player.stop()
-        except AttributeError:
-            logging.info("Player already stopped; continuing")
-        await self.voice_client.disconnect()
-        self.voice_client = None
-        await client.send_message(message.channel, "Turning off music player!")
+        session = await self.get_session(command)
+        if session is None:
+            return
+        if not session.is_local:
+            await self.play_local(command)
+            return
+        await self.library.load()
+        matches = self.library.search(command.args)
+        if len(matches) == 0:
+            await self.outbound.send(message.channel, "No matching music in library.")
+            return
+        session.enqueue(matches, front=True)
+        await self.outbound.send(message.channel, "Added " + str(len(matches)) + " songs after current song" +
+                                 (": " + display_name(matches[0]) if len(matches) == 1 else "."))
 
-    async def stop(self, client, message):
+    async def search_local(self, command):
         """
-        Stops current player instance. Player must be stopped first to switch between youtube player or local
-        file player.
-        :param client: discord.Client instance.
-        :param message: discord.Message instance.
+        Shows local files whose title, artist, album or path contain every search word.
+        Command: !search_local {search words}
+        :param command: Command instance.
         :return: No return value.
         """
-        logging.info("stop requested by " + message.author.name + " on " + message.channel.name)
-        if not self.player_switch:
-            await client.send_message(message.channel, "Player is offline. Turn on player first by !music command.")
+        message = command.message
+        logging.info("search_local requested by " + message.author.name + " on " + message.channel.name)
+        if len(command.args) == 0:
+            await self.outbound.send(message.channel, "`Usage: !search_local {title or artist}`")
             return
-        self.clear_attributes()
-        self.current_player.stop()
-        await client.send_message(message.channel, "Player stopped.")
-        await client.change_presence(game=None)
-        self.player_switch = True
+        await self.library.load()
+        matches = self.library.search(command.args, limit=MAX_SEARCH_RESULTS + 1)
+        if len(matches) == 0:
+            await self.outbound.send(message.channel, "No matching music in library.")
+            return
+        result_text = ""
+        for track in matches[:MAX_SEARCH_RESULTS]:
+            result_text += display_name(track) + " (" + format_duration(track.duration) + ")\n"
+        if len(matches) > MAX_SEARCH_RESULTS:
+            result_text += "...\n"
+        await self.outbound.send(message.channel, "```" + result_text + "```")
 
-    async def play(self, client, message):
+    async def shuffle(self, command):
         """
-        Streams audio to voice channel from youtube video of given url. If youtube player is already playing, adds
-        url to song queue. If local player is playing or self.current_player is None, plays video from url right away.
-        :param client: discord.Client instance.
-        :param message: discord.Message instance.
+        Shuffles local playlist. Current song keeps playing and the rest follow in random order.
+        :param command: Command instance.
         :return: No return value.
         """
-        logging.info("play requested by " + message.author.name + " on " + message.channel.name)
-        if not self.player_switch:
-            await client.send_message(message.channel, "Player is offline. Turn on player first by !music command.")
+        message = command.message
+        logging.info("shuffle requested by " + message.author.name + " on " + message.channel.name)
+        session = await self.get_session(command, create=False)
+        if session is None:
             return
-        if self.is_local:
-            await client.send_message(message.channel, "Local file player is already online. Use !stop to stop it first and try again.")
+        if not session.is_local:
+            await self.outbound.send(message.channel, "Shuffle works on local player only. Start it by !play_local.")
             return
-        self.is_local = False
-        url = message.content[6:]
-        self.song_queue.put(url)
-        if not self.is_playing:
-            target_song = self.song_queue.get()
-            self.current_player = await self.voice_client.create_ytdl_player(target_song,
-                                                                             after=lambda: self.end_song(client, message))
-            self.current_player.volume = self.default_volume
-            await client.change_presence(game=discord.Game(name=self.current_player.title))
-            await client.send_message(message.channel, "Now Playing " + self.current_player.title)
-            self.current_player.start()
-            self.player_switch = True  # Turn on player again
-            self.is_playing = True
-        else:
-            await client.send_message(message.channel, "Added item to queue (Current queue size: " + str(self.song_queue.qsize()) + ")")
+        session.queue.shuffle()
+        await self.outbound.send(message.channel, ":twisted_rightwards_arrows: Shuffled " +
+                                 str(session.queue.qsize() + 1) + " songs.")
 
-    async def play_local(self, client, message):
+    async def rescan_local(self, command):
         """
-        Streams audio to voice channel from local music files in /music_cache. If local player is already playing, do
-        nothing. If youtube player is playing or self.current_player is None, play local files right away.
-        self.play_local loads all mp3 files in /music_cache and adds them to playlist.
-        :param client: discord.Client instance.
-        :param message: discord.Message instance.
+        Rescans music library directory for added, changed or removed files. Playlists already playing are kept.
+        :param command: Command instance.
         :return: No return value.
         """
-        if not self.player_switch:
-            await client.send_message(message.channel, "Player is offline. Turn on player first by !music command.")
-            return
-        logging.info("play_local requested by " + message.author.name + " on " + message.channel.name)
-        if self.is_local:
-            await client.send_message(message.channel, ":x: I'm already playing local music.")
-            return
-        else:
-            if self.is_playing:
-                await client.send_message(message.channel, "Youtube player is already online. Use !stop to stop it first and try again.")
-                return
-        self.is_local = True
-        local_music_path = os.getcwd() + "/music_cache"
-        try:
-            file_list = os.listdir(local_music_path)
-        except FileNotFoundError:
-            logging.warning("music_cache folder in bot's working directory is not found.")
-            await client.send_message(message.channel, "`Error: Directory not found`")
-            return
-        for file in file_list:
-            if file.endswith(".mp3"):
-                self.local_song_list.append(file)
-        logging.info("Added " + str(len(self.local_song_list)) + " songs to playlist")
-        if len(self.local_song_list) == 0:
-            await client.send_message(message.channel, "music_cache is empty.")
-            return
-        song_name = self.local_song_list[self.local_song_index]
-        self.current_player = self.voice_client.create_ffmpeg_player(local_music_path + "/" + song_name,
-                                                                     after=lambda: self.end_song_local(client, message))
-        self.current_player.volume = self.default_volume
-        song_name = song_name[:len(song_name) - 4]
-        await client.change_presence(game=discord.Game(name=song_name))
-        await client.send_message(message.channel, "Now Playing " + song_name)
-        self.current_player.start()
-        self.player_switch = True  # Turn player back on
-        self.is_playing = True
+        message = command.message
+        logging.info("rescan_local requested by " + message.author.name + " on " + message.channel.name)
+        await self.library.load()
+        changed, removed = await self.library.rescan()
+        await self.outbound.send(message.channel, "Music library has " + str(len(self.library.tracks)) + " songs (" +
+                                 str(changed) + " added or changed, " + str(removed) + " removed).")
 
-    async def skip(self, client, message):
+    async def skip(self, command):
         """
         Skips current song.
-        :param client: discord.Client instance.
-        :param message: discord.Message instance.
+        :param command: Command instance.
         :return: No return value.
         """
+        message = command.message
         logging.info("skip requested by " + message.author.name + " on " + message.channel.name)
-        if not await self.check_player_status(client, message):
+        session = await self.check_player_status(command)
+        if session is None:
             return
-        self.current_player.stop()  # after parameter of player is called
+        session.skip()
 
-    async def pause(self, client, message):
+    async def pause(self, command):
         """
         Pauses current song.
-        :param client: discord.Client instance.
-        :param message: discord.Message instance.
+        :param command: Command instance.
         :return: No return value.
         """
+        message = command.message
         logging.info("pause requested by " + message.author.name + " on " + message.channel.name)
-        if not await self.check_player_status(client, message):
+        session = await self.check_player_status(command)
+        if session is None:
             return
-        self.current_player.pause()
-        await client.send_message(message.channel, ":pause_button:")
+        session.pause()
+        await self.outbound.send(message.channel, ":pause_button:")
 
-    async def resume(self, client, message):
+    async def resume(self, command):
         """
         Resumes current song.
-        :param client: discord.Client instance.
-        :param message: discord.Message instance.
+        :param command: Command instance.
         :return: No return value.
         """
+        message = command.message
         logging.info("resume requested by " + message.author.name + " on " + message.channel.name)
-        if not await self.check_player_status(client, message):
+        session = await self.check_player_status(command)
+        if session is None:
             return
-        self.current_player.resume()
-        await client.send_message(message.channel, ":arrow_forward:")
+        session.resume()
+        await self.outbound.send(message.channel, ":arrow_forward:")
 
-    async def volume(self, client, message):
+    async def volume(self, command):
         """
-        Sets volume of current player. If no argument is given, displays current volume of player.
-        :param client: discord.Client instance.
-        :param message: discord.Message instance.
+        Sets volume of player. If no argument is given, displays current volume of player.
+        :param command: Command instance.
         :return: No return value.
         """
+        message = command.message
         logging.info("volume requested by " + message.author.name + " on " + message.channel.name)
-        if not await self.check_player_status(client, message):
+        session = await self.check_player_status(command)
+        if session is None:
             return
-        volume_args = message.content.split(" ")
-        if len(volume_args) == 1:  # no argument is given for command
-            await client.send_message(message.channel, "Current volume: " + str(self.current_player.volume * 100) + "%")
+        volume_args = command.split_args()
+        if len(volume_args) == 0:  # no argument is given for command
+            await self.outbound.send(message.channel, "Current volume: " + str(session.volume * 100) + "%")
             return
         try:
-            volume_arg = int(volume_args[1])
+            volume_arg = int(volume_args[0])
             if volume_arg > 100 or volume_arg < 0:
-                await client.send_message(message.channel, "Invalid argument; volume must be `integer` between 0 and 100.")
+                await self.outbound.send(message.channel,
+                                         "Invalid argument; volume must be `integer` between 0 and 100.")
                 return
             else:
                 volume_arg = volume_arg / 100.0
         except ValueError:
-            await client.send_message(message.channel, "Invalid argument; volume must be `integer` between 0 and 100.")
+            await self.outbound.send(message.channel, "Invalid argument; volume must be `integer` between 0 and 100.")
             return
-        self.current_player.volume = volume_arg
-        await client.send_message(message.channel, "Set volume to " + str(self.current_player.volume * 100) + "%")
+        session.set_volume(volume_arg)
+        await self.outbound.send(message.channel, "Set volume to " + str(session.volume * 100) + "%")
 
-    async def check_player_status(self, client, message):
-        """
-        Helper function to check current status of player.
-        :param client: discord.Client instance.
-        :param message: discord.Message instance.
-        :return: False if player is offline or no song is being played. True otherwise.
-        """
-        if not self.player_switch:
-            await client.send_message(message.channel, "Player is offline. Turn on player first by !music command.")
-            return False
-        if not self.is_playing:
-            await client.send_message(message.channel, "Player is stopped. First start playing by !play or !play_local command.")
-            return False
-        return True
+    async def duck(self, command):
+        """
+        Lowers music for given seconds, so people in voice channel can talk over it. "off" brings music back right
+        away.
+        :param command: Command instance.
+        :return: No return value.
+        """
+        message = command.message
+        logging.info("duck requested by " + message.author.name + " on " + message.channel.name)
+        session = await self.check_player_status(command)
+        if session is None:
+            return
+        duck_args = command.split_args()
+        if len(duck_args) > 0 and duck_args[0].lower() == "off":
+            session.unduck()
+            await self.outbound.send(message.channel, "Music is back to " + str(session.volume * 100) + "%")
+            return
+        seconds = self.duck_seconds
+        if len(duck_args) > 0:
+            try:
+                seconds = float(duck_args[0])
+            except ValueError:
+                seconds = -1
+            if seconds <= 0 or seconds > 3600:
+                await self.outbound.send(message.channel,
+                                         "Invalid argument; duration must be seconds between 0 and 3600, or `off`.")
+                return
+        session.duck(seconds)
+        await self.outbound.send(message.channel, "Lowered music for " + "{:g}".format(seconds) + " seconds.")
+
+    async def check_player_status(self, command):
+        """
+        Helper function to check current status of player of the guild.
+        :param command: Command instance.
+        :return: MusicSession instance, or None if player is offline or no song is being played.
+        """
+        session = await self.get_session(command, create=False)
+        if session is None:
+            return None
+        if not session.is_busy():
+            await self.outbound.send(command.message.channel,
+                                     "Player is stopped. First start playing by !play or !play_local command.")
+            return None
+        return session
+
+
+def format_duration(seconds):
+    """
+    Formats duration of a song.
+    :param seconds: duration in seconds, or None if unknown.
+    :return: duration in m:ss form, or ?:?? if unknown.
+    """
+    if seconds is None:
+        return "?:??"
+    minutes, seconds = divmod(int(seconds), 60)
+    return "{}:{:02d}".format(minutes, seconds)
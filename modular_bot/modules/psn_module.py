@@ -1,8 +1,139 @@
+import io
 import logging
+from collections import namedtuple
 import discord
-import requests
-from bs4 import BeautifulSoup
+from lxml import etree
 from modular_bot.Module import BaseModule
+from modular_bot.http_client import FetchError
+
+
+PSNProfile = namedtuple("PSNProfile", ["avatar", "user_name", "level", "platinum", "gold", "silver", "bronze"])
+PSNGame = namedtuple("PSNGame", ["title", "platform", "image", "earned", "total", "last_played"])
+PSNTrophy = namedtuple("PSNTrophy", ["game", "name", "description", "image", "rarity"])
+ProfilePage = namedtuple("ProfilePage", ["profile", "games"])
+RECENT_LIMIT = 3  # number of recent games and trophies shown
+
+
+def has_class(class_name):
+    """
+    Builds XPath predicate matching elements which have given class, like class selector in CSS.
+    :param class_name: name of the class.
+    :return: predicate in string.
+    """
+    return "[contains(concat(' ', normalize-space(@class), ' '), ' " + class_name + " ')]"
+
+
+# Selectors are compiled once and evaluated only on subtrees picked while parsing
+AVATAR_SRC = etree.XPath(".//img/@src")
+USER_NAME = etree.XPath(".//span" + has_class("username"))
+LEVEL = etree.XPath(".//div" + has_class("trophy-count") + has_class("level") + "//li")
+TROPHY_COUNTS = {grade: etree.XPath(".//li" + has_class(grade)) for grade in ("platinum", "gold", "silver", "bronze")}
+GAME_TITLE = etree.XPath(".//a" + has_class("title"))
+GAME_PLATFORMS = etree.XPath(".//span" + has_class("platform"))
+GAME_IMAGE_SRC = etree.XPath(".//picture//img/@src")
+SMALL_INFO = etree.XPath(".//div" + has_class("small-info"))
+TROPHY_GAME = etree.XPath(".//img" + has_class("game") + "/@title")
+TROPHY_TITLE = etree.XPath(".//a" + has_class("title"))
+TROPHY_IMAGE_SRC = etree.XPath(".//img" + has_class("trophy") + "/@src")
+TROPHY_RARITY = etree.XPath(".//span" + has_class("separator") + has_class("left") + "/img/@title")
+
+
+def text_of(elements):
+    """
+    Returns whole text of the first element, like .text of BeautifulSoup.
+    :param elements: list of elements returned by XPath.
+    :return: text in string.
+    :raises IndexError: if list is empty.
+    """
+    return "".join(elements[0].itertext())
+
+
+def iter_elements(response, tags):
+    """
+    Incrementally parses page and yields elements of given tags when they start and when they are fully parsed.
+    Parsing stops as soon as caller stops iterating, so rest of the page is never parsed.
+    :param response: HttpResponse instance.
+    :param tags: tuple of tag names.
+    :return: iterator of (event, element).
+    """
+    return etree.iterparse(io.BytesIO(response.content), events=("start", "end"), tag=tags, html=True,
+                           encoding=response.encoding, no_network=True, recover=True)
+
+
+def parse_profile_page(response):
+    """
+    Parses profile page of user. Only avatar, profile bar and first rows of games table are read, and parsing stops
+    once they are found. Profile bar and recently played games are read in one pass, so psn_user and psn_recent can
+    share the parsed result.
+    :param response: HttpResponse of profile page.
+    :return: ProfilePage(profile and games are None if not found), or None if page is not a profile.
+    """
+    avatar = None
+    profile_fields = None
+    games = None
+    games_table = None
+    for event, element in iter_elements(response, ("div", "ul", "table", "tr")):
+        if event == "start":
+            if element.tag == "table" and element.get("id") == "gamesTable":
+                games_table = element
+                games = []
+            continue
+        classes = element.get("class", "").split()
+        if element.tag == "div" and avatar is None and "avatar" in classes:
+            avatar = next(iter(AVATAR_SRC(element)), None)
+        elif element.tag == "ul" and profile_fields is None and "profile-bar" in classes:
+            try:
+                profile_fields = [text_of(USER_NAME(element)), text_of(LEVEL(element))]
+                profile_fields += [text_of(TROPHY_COUNTS[grade](element)).strip()
+                                   for grade in ("platinum", "gold", "silver", "bronze")]
+            except IndexError:
+                profile_fields = None
+        elif element.tag == "tr" and games_table is not None and len(games) < RECENT_LIMIT and \
+                next(element.iterancestors("table"), None) is games_table:
+            # trophy progress and last played date
+            info_list = SMALL_INFO(element)
+            progress = [text_of([bold]) for bold in info_list[0].iter("b")]
+            games.append(PSNGame(text_of(GAME_TITLE(element)),
+                                 ", ".join([text_of([platform]) for platform in GAME_PLATFORMS(element)]),
+                                 GAME_IMAGE_SRC(element)[0], progress[0], progress[1],
+                                 text_of(info_list[1:]).strip()))
+        games_done = games is not None and (len(games) == RECENT_LIMIT or element is games_table)
+        if games_done and avatar is not None and profile_fields is not None:
+            break  # everything needed is found; skip rest of the page
+    profile = None
+    if avatar is not None and profile_fields is not None:
+        profile = PSNProfile(avatar, *profile_fields)
+    if profile is None and games is None:
+        return None
+    return ProfilePage(profile, games)
+
+
+def parse_trophy_log(response):
+    """
+    Parses trophy log page of user. Only first rows of first table are read.
+    :param response: HttpResponse of trophy log page.
+    :return: list of PSNTrophy of last earned trophies, or None if page is unreachable.
+    """
+    if not response.url.endswith("/log"):  # redirected; page unreachable
+        return None
+    trophies = []
+    log_table = None
+    for event, element in iter_elements(response, ("table", "tr")):
+        if event == "start":
+            if element.tag == "table" and log_table is None:
+                log_table = element
+            continue
+        if element.tag == "table":
+            break
+        if next(element.iterancestors("table"), None) is not log_table:
+            continue
+        title = TROPHY_TITLE(element)[0]
+        line_break = title.getparent().find("br")
+        trophies.append(PSNTrophy(TROPHY_GAME(element)[0], text_of([title]), (line_break.tail or "").strip(),
+                                  TROPHY_IMAGE_SRC(element)[0], TROPHY_RARITY(element)[-1]))
+        if len(trophies) == RECENT_LIMIT:
+            break
+    return trophies
 
 
 class PSNModule(BaseModule):
@@ -14,128 +145,104 @@ class PSNModule(BaseModule):
     module_description = "Fetches Playstation Network user profile, recently played games or recently earned " \
                          "trophies. All data referenced from psnprofiles.com."
     commands = ["psn_user", "psn_recent", "psn_trophies"]
+    command_handlers = {"psn_user": "get_user_info", "psn_recent": "get_recent_games",
+                        "psn_trophies": "get_recent_trophies"}
+    # Profiles are updated rarely; repeated lookups within a minute reuse cached page
+    cache_ttl = 60
+    base_url = "https://psnprofiles.com/"
 
-    async def parse_command(self, bundle):
-        """
-        Decides which command should be executed and calls it.
-        :param bundle Dictionary passed in from caller.
-        :return: no return value.
-        """
-        client = bundle.get("client")
-        message = bundle.get("message")
-        if message.content.startswith(self.command_char + "psn_user"):
-            await self.get_user_info(message)
-        elif message.content.startswith(self.command_char + "psn_recent"):
-            await self.get_recent_games(message)
-        elif message.content.startswith(self.command_char + "psn_trophies"):
-            await self.get_recent_trophies(message)
-
-    async def get_user_info(self, message):
+    async def get_user_info(self, command):
         """
         Gets PSN User info from my.playstation.com, make embed from it and
         sends back to server.
-        :param message: discord.Message instance.
+        :param command: Command instance.
         :return: no return value.
         """
+        message = command.message
         logging.info("psn_user requested by " + message.author.name + " on " + message.channel.name)
-        search_arg = message.content[10:]
+        search_arg = command.args
         if len(search_arg) == 0:
-            await message.channel.send("No user name is provided!")
+            await self.outbound.send(message.channel, "No user name is provided!")
             return
-        target_url = "https://psnprofiles.com/" + search_arg
-        async with message.channel.typing():
-            raw_page = requests.get(target_url)
-            soup = BeautifulSoup(raw_page.text, "lxml")
+        target_url = self.base_url + search_arg
+        async with self.outbound.typing(message.channel):
             try:
-                # get avatar image
-                avatar_image_src = soup.find("div", {"class": "avatar"}).find('img')["src"]
-                # find profile bar section
-                profile_bar = soup.find("ul", {"class": "profile-bar"})
-                user_name = profile_bar.find('span', {'class': 'username'}).text
-                user_level = profile_bar.find("div", {"class": "trophy-count level"}).find('li').text
-                # get numbers of each trophy
-                plat_trophies = profile_bar.find("li", {"class": "platinum"}).text.strip()
-                gold_trophies = profile_bar.find("li", {"class": "gold"}).text.strip()
-                silver_trophies = profile_bar.find("li", {"class": "silver"}).text.strip()
-                bronze_trophies = profile_bar.find("li", {"class": "bronze"}).text.strip()
-                # create embed
-                result_embed = discord.Embed(title=user_name, description="Level " + user_level)
-                result_embed.set_thumbnail(url=avatar_image_src)
-                result_embed.add_field(name="PLATINUM", value=plat_trophies)
-                result_embed.add_field(name="GOLD", value=gold_trophies, inline=True)
-                result_embed.add_field(name="SILVER", value=silver_trophies)
-                result_embed.add_field(name="BRONZE", value=bronze_trophies, inline=True)
-            except (AttributeError, TypeError):
-                await message.channel.send("User not found or profile hasn't been updated yet.")
+                page = await self.fetch_parsed(target_url, parse_profile_page)
+            except FetchError:
+                await self.outbound.send(message.channel, "Could not reach psnprofiles.com. Try again later.")
                 return
-            await message.channel.send(embed=result_embed)
+            if page is None or page.profile is None:
+                await self.outbound.send(message.channel, "User not found or profile hasn't been updated yet.")
+                return
+            profile = page.profile
+            # create embed
+            result_embed = discord.Embed(title=profile.user_name, description="Level " + profile.level)
+            result_embed.set_thumbnail(url=profile.avatar)
+            result_embed.add_field(name="PLATINUM", value=profile.platinum)
+            result_embed.add_field(name="GOLD", value=profile.gold, inline=True)
+            result_embed.add_field(name="SILVER", value=profile.silver)
+            result_embed.add_field(name="BRONZE", value=profile.bronze, inline=True)
+            await self.outbound.send(message.channel, embed=result_embed)
 
-    async def get_recent_games(self, message):
+    async def get_recent_games(self, command):
         """
         Gets recently plated games of user from web, make embed and send back to server.
-        :param message: discord.Message instance.
+        :param command: Command instance.
         :return: no return value.
         """
+        message = command.message
         logging.info("psn_recent requested by " + message.author.name + " on " + message.channel.name)
-        search_arg = message.content[12:]
+        search_arg = command.args
         if len(search_arg) == 0:
-            await message.channel.send("No user name is provided!")
+            await self.outbound.send(message.channel, "No user name is provided!")
             return
-        target_url = "https://psnprofiles.com/" + search_arg
-        async with message.channel.typing():
-            raw_page = requests.get(target_url)
-            soup = BeautifulSoup(raw_page.text, "lxml")
+        target_url = self.base_url + search_arg
+        async with self.outbound.typing(message.channel):
             try:
-                table = soup.find('table', {'id': 'gamesTable'})
-                recent_games = table.findAll("tr")[:3]  # limit 3 most recent games
-            except AttributeError:
-                await message.channel.send("User not found or profile hasn't been updated yet.")
+                page = await self.fetch_parsed(target_url, parse_profile_page)
+            except FetchError:
+                await self.outbound.send(message.channel, "Could not reach psnprofiles.com. Try again later.")
+                return
+            if page is None or page.games is None:
+                await self.outbound.send(message.channel, "User not found or profile hasn't been updated yet.")
                 return
-            for game_soup in recent_games:
-                game_title = game_soup.find('a', {'class': 'title'}).text
-                game_platform = ', '.join([x.text for x in game_soup.findAll('span', {'class': 'platform'})])
-                game_img_src = game_soup.find("picture").img["src"]
-                # trophy progress and last played date
-                info_list = game_soup.findAll('div', {'class': 'small-info'})
-                progress = [x.text for x in info_list[0].findAll('b')]
-                last_played = info_list[1].text.strip()
+            result_embeds = []
+            for game in page.games:
                 # build embed
-                result_embed = discord.Embed(title=game_title, description=game_platform)
-                result_embed.set_thumbnail(url=game_img_src)
-                result_embed.add_field(name="Trophies", value='{} of {} Trophies'.format(progress[0], progress[1]))
-                result_embed.add_field(name="Last Played", value=last_played)
-                await message.channel.send(embed=result_embed)
+                result_embed = discord.Embed(title=game.title, description=game.platform)
+                result_embed.set_thumbnail(url=game.image)
+                result_embed.add_field(name="Trophies", value='{} of {} Trophies'.format(game.earned, game.total))
+                result_embed.add_field(name="Last Played", value=game.last_played)
+                result_embeds.append(result_embed)
+            await self.outbound.send_embeds(message.channel, result_embeds)
 
-    async def get_recent_trophies(self, message):
+    async def get_recent_trophies(self, command):
         """
         Gets recently earned trophies of user from web, create embeds and sent them back to server.
-        :param message: discord.Message instance.
+        :param command: Command instance.
         :return: no return value.
         """
+        message = command.message
         logging.info("psn_trophies requested by " + message.author.name + " on " + message.channel.name)
-        search_arg = message.content[14:]
+        search_arg = command.args
         if len(search_arg) == 0:
-            await message.channel.send("No user name is provided!")
+            await self.outbound.send(message.channel, "No user name is provided!")
             return
-        target_url = "https://psnprofiles.com/" + search_arg + '/log'
-        async with message.channel.typing():
-            raw_page = requests.get(target_url)
-            if not raw_page.url == target_url:  # page unreachable
-                await message.channel.send("User not found or profile hasn't been updated yet.")
+        target_url = self.base_url + search_arg + '/log'
+        async with self.outbound.typing(message.channel):
+            try:
+                trophies = await self.fetch_parsed(target_url, parse_trophy_log)
+            except FetchError:
+                await self.outbound.send(message.channel, "Could not reach psnprofiles.com. Try again later.")
+                return
+            if trophies is None:
+                await self.outbound.send(message.channel, "User not found or profile hasn't been updated yet.")
                 return
-            # page reached
-            soup = BeautifulSoup(raw_page.text, "lxml")
-            recent_trophies = soup.find("table").findAll("tr")[:3]  # limit last 3 trophies
-            for trophy_soup in recent_trophies:
-                game_title = trophy_soup.find('img', {'class': 'game'})['title']
-                trophy_name = trophy_soup.find('a', {'class': 'title'}).text
-                trophy_desc = trophy_soup.find('a', {'class': 'title'}).parent.br.next.strip()
-                trophy_img_src = trophy_soup.find("img", {'class': 'trophy'})["src"]
-                # list of spans (might be used for other info in future)
-                spans = trophy_soup.findAll('span', {'class': 'separator left'})
-                trophy_rarity = spans[-1].img['title']
-                result_embed = discord.Embed(title=trophy_name, description=trophy_desc)
-                result_embed.set_thumbnail(url=trophy_img_src)
-                result_embed.set_author(name=game_title)
-                result_embed.add_field(name="Rarity", value=trophy_rarity)
-                await message.channel.send(embed=result_embed)
+            result_embeds = []
+            for trophy in trophies:
+                result_embed = discord.Embed(title=trophy.name, description=trophy.description)
+                result_embed.set_thumbnail(url=trophy.image)
+                result_embed.set_author(name=trophy.game)
+                result_embed.add_field(name="Rarity", value=trophy.rarity)
+                result_embeds.append(result_embed)
+            await self.outbound.send_embeds(message.channel, result_embeds)
@@ -1,70 +1,129 @@
+import io
 import logging
-import requests
+import os
 import discord
-import io
 from modular_bot.Module import BaseModule
+from modular_bot.answer_store import AnswerStore, StoredAnswer
+from modular_bot.http_client import FetchError
 
 
 class WolframModule(BaseModule):
     """
     Class for Wolfram Module. Queries WolframAlpha and returns simple text answer or detailed image answer.
+    Answers are kept in a persistent answer store, so repeated questions don't use API quota.
     """
     module_name = "Wolfram Module"
     module_description = "Queries user's question to WolframAlpha. User can select to receive answer in simple" \
                          " text-only form or detailed image-based form."
     commands = ["wolfram", "wolfram_detail"]
+    command_handlers = {"wolfram": "wolfram_result", "wolfram_detail": "wolfram_simple"}
     # Module specific variables
     app_id = "75GQ8R-VJ8AX4VT75"
+    api_url = "http://api.wolframalpha.com/v1/"
+    # Seconds to keep answers, and answers to questions WolframAlpha did not understand. 0 disables answer store
+    answer_ttl = 7 * 24 * 3600.0
+    unknown_ttl = 24 * 3600.0
+
+    def __init__(self, user_cmd_char, settings=None):
+        super().__init__(user_cmd_char, settings)
+        self.answer_ttl = float(self.settings.get("answer_ttl", self.answer_ttl))
+        self.unknown_ttl = float(self.settings.get("unknown_ttl", self.unknown_ttl))
+        self.answers = AnswerStore(self.settings.get("answer_database", "wolfram_answers.db"),
+                                   os.path.join(os.getcwd(), self.settings.get("answer_blob_path", "wolfram_answers")),
+                                   max_bytes=int(self.settings.get("answer_max_bytes", 268435456)))
+
+    async def on_unload(self):
+        await self.answers.close()
 
-    async def parse_command(self, bundle):
+    async def ask(self, kind, query):
         """
-        Decides which command should be executed and calls it.
-        :param bundle Dictionary passed in from caller.
-        :return: no return value.
+        Returns stored answer of query, or queries WolframAlpha and stores its answer. Concurrent calls for the same
+        query share one lookup.
+        :param kind: name of API endpoint, "result" for text or "simple" for image answers.
+        :param query: question as given by user; it is sent to WolframAlpha unchanged.
+        :return: StoredAnswer instance.
+        """
+        key = normalize_query(query)
+        return await self.in_flight.do(("wolfram", kind, key), lambda: self.lookup_or_query(kind, query, key))
+
+    async def lookup_or_query(self, kind, query, key):
         """
-        client = bundle.get("client")
-        message = bundle.get("message")
-        if message.content.split(" ", maxsplit=1)[0] == self.command_char + "wolfram":
-            await self.wolfram_result(message)
-        elif message.content.split(" ", maxsplit=1)[0] == self.command_char + "wolfram_detail":
-            await self.wolfram_simple(message)
+        Called through ask.
+        :param kind: name of API endpoint.
+        :param query: question as given by user.
+        :param key: normalized question the answer is stored under.
+        :return: StoredAnswer instance.
+        """
+        if self.answer_ttl > 0:
+            answer = await self.answers.get(kind, key)
+            if answer is not None:
+                return answer
+        response = await self.fetch(self.api_url + kind, params={"appid": self.app_id, "i": query}, ttl=0)
+        text = response.text if kind == "result" else None
+        content = response.content if kind == "simple" else None
+        if response.status == 501:  # question was not understood; text is an explanation, not an answer
+            ttl, text, content = (self.unknown_ttl if self.answer_ttl > 0 else 0), None, None
+        elif response.status == 200:
+            ttl = self.answer_ttl
+        else:
+            ttl = 0
+        if ttl > 0:
+            return await self.answers.put(kind, key, response.status, ttl, text=text, content=content)
+        return StoredAnswer(response.status, text, None, content)
 
-    async def wolfram_result(self, message):
+    async def wolfram_result(self, command):
         """
         Queries WolframAlpha and returns short text-only answer to server.
-        :param message: discord.Message instance.
+        :param command: Command instance.
         :return: no return value.
         """
+        message = command.message
         logging.info("wolfram requested by " + message.author.name + " on " + message.channel.name)
-        query = message.content[9:]
+        query = command.args.strip()
         if len(query) == 0:
-            await message.channel.send("Ask me something!")
+            await self.outbound.send(message.channel, "Ask me something!")
             return
-        url = "http://api.wolframalpha.com/v1/result?appid=" + self.app_id + "&i=" + query
-        async with message.channel.typing():
-            response = requests.get(url)
-            if response.status_code == 501:
-                await message.channel.send("I can't understand your question.")
+        async with self.outbound.typing(message.channel):
+            try:
+                answer = await self.ask("result", query)
+            except FetchError:
+                await self.outbound.send(message.channel, "Could not reach WolframAlpha. Try again later.")
+                return
+            if answer.status == 501:
+                await self.outbound.send(message.channel, "I can't understand your question.")
                 return
-            answer = response.text  # Response from api is a simple text; no other conversion required
-            await message.channel.send(answer)
+            await self.outbound.send(message.channel, answer.text)  # Response from api is a simple text
 
-    async def wolfram_simple(self, message):
+    async def wolfram_simple(self, command):
         """
         Queries WolframAlpha and returns simple image result to server.
-        :param message: discord.Message instance.
+        :param command: Command instance.
         :return: no return value.
         """
+        message = command.message
         logging.info("wolfram_detail requested by " + message.author.name + " on " + message.channel.name)
-        query = message.content[16:]
+        query = command.args.strip()
         if len(query) == 0:
-            await message.channel.send("Ask me something!")
+            await self.outbound.send(message.channel, "Ask me something!")
             return
-        url = "http://api.wolframalpha.com/v1/simple?appid=" + self.app_id + "&i=" + query
-        async with message.channel.typing():
-            response = requests.get(url)  # Now contains binary for image
-            if response.status_code == 501:
-                await message.channel.send("I can't understand your question.")
+        async with self.outbound.typing(message.channel):
+            try:
+                answer = await self.ask("simple", query)
+            except FetchError:
+                await self.outbound.send(message.channel, "Could not reach WolframAlpha. Try again later.")
                 return
-            answer = io.BytesIO(response.content)  # Convert bytes object to file-like object
-            await message.channel.send(file=discord.File(answer, filename="answer.png"))
+            if answer.status == 501:
+                await self.outbound.send(message.channel, "I can't understand your question.")
+                return
+            await self.outbound.send(message.channel,
+                                     file=discord.File(io.BytesIO(answer.content), filename="answer.png"))
+
+
+def normalize_query(query):
+    """
+    Normalizes question into key of its stored answer, so questions differing only in spacing share one answer.
+    Case and punctuation are kept, since WolframAlpha reads them ("Mg" is magnesium, "mg" is milligram).
+    :param query: question given by user.
+    :return: question with single spaces.
+    """
+    return " ".join(query.split())
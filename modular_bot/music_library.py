@@ -0,0 +1,255 @@
+import asyncio
+import logging
+import os
+import sqlite3
+import time
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+
+# path is relative to library root; duration is in seconds, or None if unknown; digest is address of the file in
+# Opus cache, or None if it is not cached
+LibraryTrack = namedtuple("LibraryTrack", ["path", "size", "mtime", "duration", "title", "artist", "album",
+                                           "digest"])
+
+AUDIO_EXTENSIONS = (".mp3", ".flac", ".ogg", ".opus", ".m4a", ".wav")
+
+
+def read_tags(full_path, relative_path):
+    """
+    Reads duration and tags of an audio file with mutagen. Without mutagen, or for files it can't read, title and
+    artist are taken from file name in "artist - title" form.
+    :param full_path: path of the file.
+    :param relative_path: path of the file relative to library root.
+    :return: tuple of duration, title, artist and album.
+    """
+    name = os.path.splitext(os.path.basename(relative_path))[0]
+    artist, _, title = name.rpartition(" - ")
+    duration, album = None, ""
+    try:
+        import mutagen  # optional; only used while scanning
+        audio = mutagen.File(full_path, easy=True)
+    except ImportError:
+        audio = None
+    except Exception as e:
+        logging.debug("Could not read tags of " + relative_path + ": " + str(e))
+        audio = None
+    if audio is not None:
+        if audio.info is not None:
+            duration = audio.info.length
+        if audio.tags is not None:
+            title = (audio.tags.get("title") or [title])[0]
+            artist = (audio.tags.get("artist") or [artist])[0]
+            album = (audio.tags.get("album") or [album])[0]
+    return duration, title, artist, album
+
+
+def display_name(track):
+    """
+    Returns name of track shown to users.
+    :param track: LibraryTrack instance.
+    :return: "artist - title", or title if artist is unknown.
+    """
+    return track.artist + " - " + track.title if track.artist else track.title
+
+
+class MusicLibrary:
+    """
+    Persistent index of local music files. Path, size, mtime, duration and tags of every file are kept in SQLite and
+    in memory, so playing and searching never touch the file system. Rescans stat every file but read tags only of
+    files which are new or whose size or mtime changed.
+    """
+    def __init__(self, root, database):
+        """
+        :param root: directory holding music files; scanned recursively.
+        :param database: path of index database file.
+        """
+        self.root = root
+        self.database = database
+        self.connection = None
+        self.executor = ThreadPoolExecutor(max_workers=1)  # database is only used from this thread
+        self.tracks = []  # LibraryTrack sorted by path
+        self.search_text = []  # lower-cased text searched for each entry of tracks
+        self.digests = {}  # path -> (size, mtime, digest) of files in Opus cache
+        self.load_task = None
+        self.scan_task = None
+        self.last_scan = None
+
+    def open_and_load(self):
+        """
+        Opens database, creating table if needed, and reads index in one query. Runs on library thread.
+        :return: list of LibraryTrack sorted by path.
+        """
+        self.connection = sqlite3.connect(self.database, check_same_thread=False)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("CREATE TABLE IF NOT EXISTS tracks (path TEXT PRIMARY KEY, size INTEGER NOT NULL, "
+                                "mtime REAL NOT NULL, duration REAL, title TEXT, artist TEXT, album TEXT, digest TEXT)")
+        columns = [row[1] for row in self.connection.execute("PRAGMA table_info(tracks)")]
+        if "digest" not in columns:
+            self.connection.execute("ALTER TABLE tracks ADD COLUMN digest TEXT")
+        self.connection.commit()
+        rows = self.connection.execute("SELECT path, size, mtime, duration, title, artist, album, digest FROM tracks "
+                                       "ORDER BY path").fetchall()
+        return [LibraryTrack(*row) for row in rows]
+
+    async def load(self):
+        """
+        Loads index from database on first call; concurrent calls share one load. Library which was never scanned is
+        scanned before returning, otherwise files are rescanned in background and index is updated when it finishes.
+        :return: no return value.
+        """
+        if self.load_task is None:
+            self.load_task = asyncio.ensure_future(self.open())
+        await asyncio.shield(self.load_task)
+
+    async def open(self):
+        started = time.perf_counter()
+        tracks = await asyncio.get_event_loop().run_in_executor(self.executor, self.open_and_load)
+        self.set_tracks(tracks)
+        logging.info("Loaded " + str(len(tracks)) + " tracks of music library in " +
+                     "{:.1f}".format((time.perf_counter() - started) * 1000) + " ms")
+        if self.tracks:
+            self.start_rescan()
+        else:
+            await self.rescan()
+
+    def set_tracks(self, tracks):
+        self.tracks = tracks
+        self.search_text = [" ".join((track.title, track.artist, track.album, track.path)).lower()
+                            for track in tracks]
+        digests = {track.path: (track.size, track.mtime, track.digest) for track in tracks
+                   if track.digest is not None}
+        # digests recorded after tracks were read are not in them yet
+        paths = {track.path for track in tracks}
+        for path, entry in self.digests.items():
+            if path in paths:
+                digests.setdefault(path, entry)
+        self.digests = digests
+
+    def digest_of(self, track):
+        """
+        Returns address of file in Opus cache, if file has not changed since it was cached.
+        :param track: LibraryTrack instance.
+        :return: digest in string, or None.
+        """
+        entry = self.digests.get(track.path)
+        if entry is None or entry[0] != track.size or entry[1] != track.mtime:
+            return None
+        return entry[2]
+
+    def set_digest(self, track, digest):
+        """
+        Records address of file in Opus cache.
+        :param track: LibraryTrack instance.
+        :param digest: digest in string.
+        :return: no return value.
+        """
+        self.digests[track.path] = (track.size, track.mtime, digest)
+        if self.connection is not None:
+            self.executor.submit(self.store_digest, track, digest)
+
+    def store_digest(self, track, digest):
+        with self.connection:
+            self.connection.execute("UPDATE tracks SET digest = ? WHERE path = ? AND size = ? AND mtime = ?",
+                                    (digest, track.path, track.size, track.mtime))
+
+    def start_rescan(self):
+        if self.scan_task is None or self.scan_task.done():
+            self.scan_task = asyncio.ensure_future(self.update())
+
+    async def rescan(self):
+        """
+        Rescans library directory and updates index, or waits for rescan already running.
+        :return: tuple of number of added or changed files and number of removed files.
+        """
+        self.start_rescan()
+        return await asyncio.shield(self.scan_task)
+
+    async def update(self):
+        started = time.perf_counter()
+        tracks, changed, removed = await asyncio.get_event_loop().run_in_executor(self.executor, self.scan,
+                                                                                  list(self.tracks))
+        self.set_tracks(tracks)
+        self.last_scan = time.time()
+        logging.info("Scanned music library in " + "{:.0f}".format((time.perf_counter() - started) * 1000) + " ms: " +
+                     str(len(tracks)) + " tracks, " + str(changed) + " added or changed, " + str(removed) +
+                     " removed")
+        return changed, removed
+
+    def scan(self, known_tracks):
+        """
+        Walks library directory and writes changes to database in one transaction. Runs on library thread.
+        :param known_tracks: list of LibraryTrack currently indexed.
+        :return: tuple of new list of LibraryTrack sorted by path, number of added or changed files and number of
+                 removed files.
+        """
+        known = {track.path: track for track in known_tracks}
+        tracks = []
+        updated = []
+        for full_path, relative_path, stat in self.walk():
+            track = known.pop(relative_path, None)
+            if track is None or track.size != stat.st_size or track.mtime != stat.st_mtime:
+                duration, title, artist, album = read_tags(full_path, relative_path)
+                track = LibraryTrack(relative_path, stat.st_size, stat.st_mtime, duration, title, artist, album,
+                                     None)
+                updated.append(track)
+            tracks.append(track)
+        if updated or known:
+            with self.connection:
+                self.connection.executemany("INSERT OR REPLACE INTO tracks (path, size, mtime, duration, title, "
+                                            "artist, album, digest) VALUES (?, ?, ?, ?, ?, ?, ?, ?)", updated)
+                self.connection.executemany("DELETE FROM tracks WHERE path = ?", [(path,) for path in known])
+        tracks.sort(key=lambda track: track.path)
+        return tracks, len(updated), len(known)
+
+    def walk(self):
+        """
+        Finds audio files under library root.
+        :return: generator of tuples of full path, path relative to root and os.stat_result.
+        """
+        directories = [self.root]
+        while directories:
+            directory = directories.pop()
+            try:
+                entries = list(os.scandir(directory))
+            except OSError as e:
+                logging.warning("Could not scan " + directory + ": " + str(e))
+                continue
+            for entry in entries:
+                if entry.is_dir():
+                    directories.append(entry.path)
+                elif entry.name.lower().endswith(AUDIO_EXTENSIONS):
+                    yield entry.path, os.path.relpath(entry.path, self.root).replace(os.sep, "/"), entry.stat()
+
+    def search(self, query, limit=None):
+        """
+        Finds tracks whose title, artist, album or path contain every word of query, ignoring case.
+        :param query: search words separated by spaces.
+        :param limit: optional maximum number of results.
+        :return: list of LibraryTrack in path order.
+        """
+        words = query.lower().split()
+        results = []
+        for track, text in zip(self.tracks, self.search_text):
+            if all(word in text for word in words):
+                results.append(track)
+                if limit is not None and len(results) >= limit:
+                    break
+        return results
+
+    def full_path(self, track):
+        return os.path.join(self.root, track.path)
+
+    async def close(self):
+        """
+        Waits for running load and scan and closes database.
+        :return: no return value.
+        """
+        for task in (self.load_task, self.scan_task):
+            if task is not None:
+                try:
+                    await task
+                except Exception:
+                    pass
+        if self.connection is not None:
+            await asyncio.get_event_loop().run_in_executor(self.executor, self.connection.close)
+            self.connection = None
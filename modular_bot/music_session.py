@@ -0,0 +1,341 @@
+import asyncio
+import itertools
+import logging
+import random
+import time
+import discord
+from modular_bot.audio_effects import EffectsSource
+from modular_bot.music_library import LibraryTrack, display_name
+from modular_bot.opus_cache import CachedOpusAudio
+from modular_bot.track_resolver import TrackError
+
+# Lets ffmpeg reconnect if youtube drops the stream connection
+RECONNECT_OPTIONS = "-reconnect 1 -reconnect_streamed 1 -reconnect_delay_max 5"
+
+# States of a session
+IDLE = "idle"  # connected, waiting for a song
+LOADING = "loading"  # preparing next song
+PLAYING = "playing"
+PAUSED = "paused"
+CLOSED = "closed"  # disconnected; session is dropped
+
+
+class SongQueue(asyncio.Queue):
+    """
+    asyncio.Queue of songs which can also be looked into, cleared, shuffled and added to at the front.
+    Songs are youtube urls in string, or LibraryTrack of local files.
+    """
+    def peek(self, count):
+        """
+        Returns first songs of queue without removing them.
+        :param count: maximum number of songs.
+        :return: list of songs.
+        """
+        return list(itertools.islice(self._queue, count))
+
+    def clear(self):
+        self._queue.clear()
+
+    def shuffle(self):
+        songs = list(self._queue)
+        random.shuffle(songs)
+        self._queue.clear()
+        self._queue.extend(songs)
+
+    def put_front(self, songs):
+        """
+        Adds songs to the front of queue, keeping their order.
+        :param songs: list of songs.
+        :return: no return value.
+        """
+        if self.empty():
+            # wakes up player waiting for a song
+            for song in songs:
+                self.put_nowait(song)
+        else:
+            self._queue.extendleft(reversed(songs))
+
+
+class MusicSession:
+    """
+    Music player of a single guild. Owns voice connection, song queue and playback state of the guild, so guilds
+    never share state. A player task takes songs from the queue one by one and waits for each to finish; session
+    disconnects and closes itself once nothing has been queued for idle_timeout seconds.
+    All methods run on event loop thread; only the after callback of discord.py comes from its player thread.
+    """
+    def __init__(self, module, guild_id, voice_client, channel):
+        """
+        :param module: MusicModule instance providing track resolver, music library and settings.
+        :param guild_id: id of the guild.
+        :param voice_client: connected discord.VoiceClient of the guild.
+        :param channel: text channel where songs are announced.
+        """
+        self.module = module
+        self.guild_id = guild_id
+        self.voice_client = voice_client
+        self.channel = channel
+        self.queue = SongQueue()
+        self.state = IDLE
+        self.is_local = False  # playing local playlist, which repeats
+        self.volume = module.default_volume
+        self.source = None  # EffectsSource, or CachedOpusAudio sent without decoding, of current song
+        self.title = None
+        self.started_at = 0.0
+        self.generation = 0  # bumped by stop, so songs being loaded at the time are dropped
+        self.player_done = None  # future resolved when current discord.py player stops
+        self.duck_level = 1.0
+        self.unduck_handle = None
+        self.task = None
+
+    def start(self):
+        self.task = asyncio.ensure_future(self.run())
+
+    def is_busy(self):
+        """
+        Checks if session is playing or has songs waiting.
+        :return: True if a song is loading, playing or paused, or queue is not empty.
+        """
+        return self.state in (LOADING, PLAYING, PAUSED) or not self.queue.empty()
+
+    async def run(self):
+        """
+        Body of player task. Plays songs in queue until session is idle for too long or is closed.
+        :return: no return value.
+        """
+        try:
+            while self.state != CLOSED:
+                self.state = IDLE
+                try:
+                    song = await asyncio.wait_for(self.queue.get(), self.module.idle_timeout)
+                except asyncio.TimeoutError:
+                    logging.info("Music player of guild " + str(self.guild_id) + " is idle; disconnecting")
+                    break
+                await self.play_song(song)
+        except asyncio.CancelledError:
+            pass
+        except Exception:
+            logging.exception("Music player of guild " + str(self.guild_id) + " failed")
+        finally:
+            await self.close()
+
+    async def play_song(self, song):
+        """
+        Loads song and plays it. With crossfade, song fades in over the end of previous song, and this returns as
+        soon as the end of the song is read, so next song can fade in. Otherwise this returns once song finished,
+        was skipped or session was stopped.
+        :param song: youtube url in string, or LibraryTrack.
+        :return: no return value.
+        """
+        generation = self.generation
+        self.state = LOADING
+        try:
+            source, title = await self.create_source(song)
+        except TrackError as e:
+            logging.warning("Could not load " + str(song) + ": " + str(e))
+            await self.module.outbound.send(self.channel, "Skipping `" + str(song) + "`; could not load it.")
+            return
+        loop = asyncio.get_event_loop()
+        ending = loop.create_future()
+        if isinstance(source, EffectsSource):
+            # called from player thread when the last frames of the song are read ahead
+            source.on_ending = lambda: loop.call_soon_threadsafe(lambda: ending.done() or ending.set_result(None))
+        previous = self.source
+        if not (isinstance(previous, EffectsSource) and isinstance(source, EffectsSource) and
+                generation == self.generation and previous.hand_over(
+                    source, lambda: loop.call_soon_threadsafe(self.switch_source, previous, source))):
+            await self.wait_player()
+            if generation != self.generation or self.state == CLOSED:
+                source.cleanup()
+                return
+            self.start_player(source)
+        self.source = source
+        self.title = title
+        self.state = PLAYING
+        self.started_at = time.monotonic()
+        await self.module.update_presence()
+        await self.module.outbound.send(self.channel, "Now Playing " + self.title)
+        await asyncio.wait([ending, self.player_done], return_when=asyncio.FIRST_COMPLETED)
+        self.state = IDLE
+        if self.is_local and generation == self.generation and isinstance(song, LibraryTrack):
+            self.queue.put_nowait(song)  # local playlist repeats
+        await self.module.update_presence()
+
+    def start_player(self, source):
+        """
+        Starts discord.py player on source.
+        :param source: audio source.
+        :return: no return value.
+        """
+        loop = asyncio.get_event_loop()
+        done = loop.create_future()
+
+        def after(error):
+            # called from player thread of discord.py
+            loop.call_soon_threadsafe(self.player_stopped, done, error)
+        self.player_done = done
+        self.voice_client.play(source, after=after)
+
+    def player_stopped(self, done, error):
+        if error is not None:
+            logging.warning("Player of guild " + str(self.guild_id) + " stopped with error: " + repr(error))
+        if self.player_done is done and self.source is not None:
+            # player cleans up the source it played; song it was fading into may not have been switched to yet
+            self.source.cleanup()
+            self.source = None
+            self.title = None
+        if not done.done():
+            done.set_result(error)
+
+    async def wait_player(self):
+        if self.player_done is not None and not self.player_done.done():
+            await self.player_done
+
+    def switch_source(self, previous, source):
+        """
+        Switches player to next song once previous song has faded out.
+        :param previous: EffectsSource of previous song.
+        :param source: EffectsSource of next song.
+        :return: no return value.
+        """
+        try:
+            if self.voice_client.source is previous:
+                self.voice_client.source = source
+        except ValueError:  # player stopped meanwhile
+            pass
+        previous.cleanup()
+
+    async def create_source(self, song):
+        """
+        Creates audio source of song. Youtube songs were usually resolved in background while previous song played.
+        Cached local songs are sent without decoding when there is no crossfade.
+        :param song: youtube url in string, or LibraryTrack.
+        :return: tuple of audio source with volume attribute and title of song.
+        """
+        if isinstance(song, LibraryTrack):
+            title = display_name(song)
+            if self.module.opus_cache is not None:
+                passthrough = self.module.crossfade_frames == 0
+                cached = self.module.opus_cache.open(self.module.library.digest_of(song),
+                                                     self.volume * self.duck_level if passthrough else 1.0,
+                                                     passthrough)
+                if cached is not None:
+                    return (cached if passthrough else self.add_effects(cached)), title
+                self.module.cache_local([song])
+            source = discord.FFmpegPCMAudio(self.module.library.full_path(song))
+        else:
+            self.prefetch()
+            track = await self.module.resolver.resolve(song)
+            source = discord.FFmpegPCMAudio(track.stream_url, before_options=RECONNECT_OPTIONS)
+            title = track.title
+        return self.add_effects(source), title
+
+    def add_effects(self, source):
+        return EffectsSource(source, self.volume, self.duck_level, self.module.ramp_frames,
+                             self.module.crossfade_frames)
+
+    def prefetch(self):
+        """
+        Starts resolving youtube songs and caching local songs at the front of queue in background.
+        :return: no return value.
+        """
+        if self.module.prefetch_count > 0:
+            upcoming = self.queue.peek(self.module.prefetch_count)
+            self.module.resolver.prefetch([song for song in upcoming if not isinstance(song, LibraryTrack)])
+            self.module.cache_local([song for song in upcoming if isinstance(song, LibraryTrack)])
+
+    def enqueue(self, songs, front=False):
+        """
+        Adds songs to queue.
+        :param songs: list of youtube urls in string or LibraryTrack.
+        :param front: True to play them right after current song.
+        :return: no return value.
+        """
+        if front:
+            self.queue.put_front(songs)
+        else:
+            for song in songs:
+                self.queue.put_nowait(song)
+        self.prefetch()
+
+    def skip(self):
+        self.voice_client.stop()  # after callback of current song finishes it
+
+    def pause(self):
+        if self.state == PLAYING:
+            self.voice_client.pause()
+            self.state = PAUSED
+
+    def resume(self):
+        if self.state == PAUSED:
+            self.voice_client.resume()
+            self.state = PLAYING
+
+    def set_volume(self, volume):
+        self.volume = volume
+        self.apply_gain()
+
+    def duck(self, seconds):
+        """
+        Lowers music to duck level of module for a while, like so people can talk over it.
+        :param seconds: how long music stays lowered.
+        :return: no return value.
+        """
+        self.unduck()
+        self.duck_level = self.module.duck_level
+        self.apply_gain()
+        self.unduck_handle = asyncio.get_event_loop().call_later(seconds, self.unduck)
+
+    def unduck(self):
+        if self.unduck_handle is not None:
+            self.unduck_handle.cancel()
+            self.unduck_handle = None
+        self.duck_level = 1.0
+        self.apply_gain()
+
+    def apply_gain(self):
+        """
+        Applies volume and ducking to current song. Songs with effects ramp to the new gain.
+        :return: no return value.
+        """
+        if isinstance(self.source, EffectsSource):
+            self.source.volume = self.volume
+            self.source.duck(self.duck_level)
+        elif isinstance(self.source, CachedOpusAudio):
+            if self.voice_client.encoder is None:
+                # cached packets are decoded and encoded again once volume differs from their gain
+                self.voice_client.encoder = discord.opus.Encoder()
+            self.source.volume = self.volume * self.duck_level
+
+    def stop(self):
+        """
+        Stops current song and empties queue. Session stays connected.
+        :return: no return value.
+        """
+        self.generation += 1
+        self.is_local = False
+        self.queue.clear()
+        self.voice_client.stop()
+        if self.state in (LOADING, PLAYING, PAUSED):
+            # player task notices the stop a bit later; session can take new songs right away
+            self.state = IDLE
+
+    async def close(self):
+        """
+        Stops playing, disconnects from voice channel and removes session from module.
+        :return: no return value.
+        """
+        if self.state == CLOSED:
+            return
+        self.state = CLOSED
+        self.generation += 1
+        self.queue.clear()
+        if self.unduck_handle is not None:
+            self.unduck_handle.cancel()
+        if self.task is not None and self.task is not asyncio.current_task():
+            self.task.cancel()
+        try:
+            await self.voice_client.disconnect()
+        except Exception:
+            logging.exception("Could not disconnect music player of guild " + str(self.guild_id))
+        self.module.session_closed(self)
+        await self.module.update_presence()
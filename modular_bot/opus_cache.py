@@ -0,0 +1,247 @@
+import asyncio
+import hashlib
+import logging
+import mmap
+import os
+import struct
+import subprocess
+import time
+from concurrent.futures import ThreadPoolExecutor
+import discord
+from discord.oggparse import OggStream
+
+# Cache entry: magic, then every 20 ms Opus packet prefixed by its length
+ENTRY_MAGIC = b"MBOPUS1\n"
+PACKET_LENGTH = struct.Struct(">H")
+# 20 ms of 48 kHz 16-bit stereo silence
+SILENT_FRAME = b"\x00" * 3840
+
+
+class OpusCacheError(Exception):
+    """
+    Raised when a file can't be encoded into cache.
+    """
+    pass
+
+
+def file_digest(path, params):
+    """
+    Computes content address of a cache entry from file content and encoding parameters.
+    :param path: path of source file.
+    :param params: string describing encoding parameters.
+    :return: hex digest in string.
+    """
+    digest = hashlib.sha256(params.encode())
+    with open(path, "rb") as source_file:
+        for chunk in iter(lambda: source_file.read(1024 * 1024), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def encode_frames(source_path, target_path, bitrate, gain, executable="ffmpeg"):
+    """
+    Encodes audio file into Opus packets with ffmpeg and writes them as cache entry. Entry appears atomically, so
+    a half-written entry is never read.
+    :param source_path: path of audio file.
+    :param target_path: path of cache entry.
+    :param bitrate: Opus bitrate in kbit/s.
+    :param gain: volume baked into the packets.
+    :param executable: ffmpeg executable.
+    :return: number of packets written.
+    """
+    args = [executable, "-i", source_path, "-map_metadata", "-1", "-vn", "-af", "volume=" + repr(gain),
+            "-f", "opus", "-c:a", "libopus", "-ar", "48000", "-ac", "2", "-b:a", str(bitrate) + "k",
+            "-frame_duration", "20", "-loglevel", "warning", "pipe:1"]
+    temporary_path = target_path + ".tmp"
+    process = subprocess.Popen(args, stdin=subprocess.DEVNULL, stdout=subprocess.PIPE)
+    packets = 0
+    try:
+        with open(temporary_path, "wb") as entry_file:
+            entry_file.write(ENTRY_MAGIC)
+            for packet in OggStream(process.stdout).iter_packets():
+                if packet.startswith((b"OpusHead", b"OpusTags")):
+                    continue
+                entry_file.write(PACKET_LENGTH.pack(len(packet)))
+                entry_file.write(packet)
+                packets += 1
+        if process.wait() != 0 or packets == 0:
+            raise OpusCacheError("ffmpeg could not encode " + source_path)
+        os.replace(temporary_path, target_path)
+    except BaseException:
+        process.kill()
+        process.wait()
+        if os.path.exists(temporary_path):
+            os.remove(temporary_path)
+        raise
+    return packets
+
+
+class CachedOpusAudio(discord.AudioSource):
+    """
+    Audio source reading pre-encoded Opus packets of a cache entry through a memory map. While volume equals the
+    gain baked into the entry, packets are sent as they are and nothing is decoded or encoded. Otherwise packets are
+    decoded with volume applied, and discord.py encodes them again.
+    """
+    def __init__(self, path, gain, volume, passthrough=True):
+        """
+        :param path: path of cache entry.
+        :param gain: volume baked into the entry.
+        :param volume: initial volume.
+        :param passthrough: False to always decode, like when frames go through EffectsSource.
+        """
+        with open(path, "rb") as entry_file:
+            self.map = mmap.mmap(entry_file.fileno(), 0, access=mmap.ACCESS_READ)
+        if self.map[:len(ENTRY_MAGIC)] != ENTRY_MAGIC:
+            self.map.close()
+            raise OpusCacheError("Invalid cache entry " + path)
+        self.offset = len(ENTRY_MAGIC)
+        self.gain = gain
+        self.volume = volume
+        self.decoder = None
+        self.decoder_volume = None
+        self.passthrough = passthrough
+        self.opus = passthrough and volume == gain  # whether last frame returned by read is Opus
+
+    def is_opus(self):
+        # Called by player right after read; tells if that frame is Opus
+        return self.opus
+
+    def read(self):
+        if self.offset + PACKET_LENGTH.size > len(self.map):
+            return b""
+        (length,) = PACKET_LENGTH.unpack_from(self.map, self.offset)
+        start = self.offset + PACKET_LENGTH.size
+        self.offset = start + length
+        packet = self.map[start:self.offset]
+        volume = self.volume
+        self.opus = self.passthrough and volume == self.gain
+        if self.opus:
+            return packet
+        if volume <= 0:
+            return SILENT_FRAME
+        if self.decoder is None:
+            self.decoder = discord.opus.Decoder()
+        if self.decoder_volume != volume:
+            self.decoder.set_volume(volume / self.gain)
+            self.decoder_volume = volume
+        return self.decoder.decode(packet)
+
+    def cleanup(self):
+        if not self.map.closed:
+            self.map.close()
+
+
+class OpusCache:
+    """
+    Content-addressed on-disk cache of Opus packets of local music files. Entries are named after digest of file
+    content and encoding parameters, so renamed or copied files share an entry and changed files get a new one.
+    Files are encoded one at a time on a background thread; least recently played entries are removed when cache
+    grows over its size limit.
+    """
+    def __init__(self, directory, bitrate=128, gain=1.0, max_bytes=2 * 1024 * 1024 * 1024, executable="ffmpeg"):
+        """
+        :param directory: directory of cache entries.
+        :param bitrate: Opus bitrate in kbit/s.
+        :param gain: volume baked into entries; matching volume plays without any transcoding.
+        :param max_bytes: maximum total size of entries.
+        :param executable: ffmpeg executable.
+        """
+        self.directory = directory
+        self.bitrate = bitrate
+        self.gain = gain
+        self.max_bytes = max_bytes
+        self.executable = executable
+        self.params = "opus-{}k-gain{!r}".format(bitrate, gain)
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self.pending = {}  # source path -> future of digest
+        self.failed = set()  # source paths ffmpeg could not encode; not tried again
+        self.hits = 0
+        self.misses = 0
+
+    def entry_path(self, digest):
+        return os.path.join(self.directory, digest[:2], digest + ".opus")
+
+    def open(self, digest, volume, passthrough=True):
+        """
+        Opens cache entry for playback.
+        :param digest: digest of the file, or None if it is not known.
+        :param volume: initial volume.
+        :param passthrough: False to always decode packets.
+        :return: CachedOpusAudio instance, or None if file is not cached.
+        """
+        if digest is None:
+            self.misses += 1
+            return None
+        path = self.entry_path(digest)
+        try:
+            os.utime(path)  # mark as recently played for pruning
+            source = CachedOpusAudio(path, self.gain, volume, passthrough)
+        except (OSError, ValueError, OpusCacheError):
+            self.misses += 1
+            return None
+        self.hits += 1
+        return source
+
+    def has(self, digest):
+        return digest is not None and os.path.exists(self.entry_path(digest))
+
+    async def add(self, source_path):
+        """
+        Encodes file into cache in background, unless it is cached already. Concurrent calls for the same file share
+        one encoding.
+        :param source_path: path of audio file.
+        :return: digest of the file.
+        """
+        if source_path in self.failed:
+            raise OpusCacheError("Could not encode " + source_path + " before")
+        future = self.pending.get(source_path)
+        if future is None:
+            future = asyncio.get_event_loop().run_in_executor(self.executor, self.build, source_path)
+            self.pending[source_path] = future
+            future.add_done_callback(lambda done: self.pending.pop(source_path, None))
+        try:
+            return await asyncio.shield(future)
+        except (OpusCacheError, OSError):
+            self.failed.add(source_path)
+            raise
+
+    def build(self, source_path):
+        """
+        Hashes file and encodes it if its entry does not exist. Runs on cache thread.
+        :param source_path: path of audio file.
+        :return: digest of the file.
+        """
+        digest = file_digest(source_path, self.params)
+        target_path = self.entry_path(digest)
+        if os.path.exists(target_path):
+            return digest
+        os.makedirs(os.path.dirname(target_path), exist_ok=True)
+        started = time.perf_counter()
+        packets = encode_frames(source_path, target_path, self.bitrate, self.gain, self.executable)
+        logging.info("Cached " + str(packets) + " Opus frames of " + os.path.basename(source_path) + " in " +
+                     "{:.1f}".format(time.perf_counter() - started) + "s")
+        self.prune()
+        return digest
+
+    def prune(self):
+        """
+        Removes least recently played entries until cache fits in max_bytes. Runs on cache thread.
+        :return: no return value.
+        """
+        entries = []
+        total = 0
+        for root, _, files in os.walk(self.directory):
+            for name in files:
+                if name.endswith(".opus"):
+                    stat = os.stat(os.path.join(root, name))
+                    entries.append((stat.st_mtime, stat.st_size, os.path.join(root, name)))
+                    total += stat.st_size
+        entries.sort()
+        for _, size, path in entries:
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except OSError:  # entry being played on Windows
+                continue
+            total -= size
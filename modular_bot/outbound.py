@@ -0,0 +1,183 @@
+import asyncio
+import logging
+import time
+from collections import deque
+
+
+class ChannelQueue:
+    """
+    Sends waiting to go out to one channel, and times of recent sends for pacing them.
+    """
+    def __init__(self):
+        self.pending = deque()  # (send coroutine function, future)
+        self.sent_at = deque()  # monotonic times of recent sends, oldest first
+        self.task = None
+        self.typing_users = 0
+        self.typing_stop = None
+        self.typing_task = None
+
+
+class Outbox:
+    """
+    Outbound layer shared by all modules. Sends to a channel are queued and go out one at a time, paced to the message
+    rate limit Discord applies to each channel, so a burst of commands waits in the queue instead of running into
+    429 responses. Embeds of one command go out back to back, and commands typing in the same channel share one typing
+    indicator.
+    """
+    def __init__(self, rate=5, per=5.0):
+        """
+        :param rate: number of messages allowed to one channel within per seconds.
+        :param per: length of rate limit window in seconds.
+        """
+        self.rate = rate
+        self.per = per
+        self.channels = {}  # channel id -> ChannelQueue
+        self.sent = 0
+        self.delayed = 0
+
+    def configure(self, section):
+        """
+        Updates limits from [OUTBOUND] section of config file.
+        :param section: dictionary-like config section.
+        :return: no return value.
+        """
+        self.rate = int(section.get("rate", self.rate))
+        self.per = float(section.get("per", self.per))
+
+    def get_queue(self, channel):
+        queue = self.channels.get(channel.id)
+        if queue is None:
+            queue = ChannelQueue()
+            self.channels[channel.id] = queue
+        return queue
+
+    async def send(self, channel, content=None, **kwargs):
+        """
+        Queues message to channel and waits until it is sent.
+        :param channel: discord.abc.Messageable instance.
+        :param content: optional text of the message.
+        :param kwargs: other arguments of discord.abc.Messageable.send, like embed or file.
+        :return: discord.Message instance.
+        """
+        return await self.enqueue(channel, lambda: channel.send(content, **kwargs))
+
+    async def send_embeds(self, channel, embeds):
+        """
+        Sends embeds one message each, through public send of discord.py, which takes one embed per message.
+        :param channel: discord.abc.Messageable instance.
+        :param embeds: list of discord.Embed.
+        :return: list of discord.Message instances.
+        """
+        # every embed is queued at once, so sends of other commands don't come in between
+        futures = [self.enqueue(channel, lambda embed=embed: channel.send(embed=embed)) for embed in embeds]
+        return list(await asyncio.gather(*futures))
+
+    def enqueue(self, channel, send):
+        """
+        Adds send to queue of channel, starting its sender task if it is not running.
+        :param channel: discord.abc.Messageable instance.
+        :param send: coroutine function without arguments making the API call.
+        :return: future resolved with result of send.
+        """
+        future = asyncio.get_event_loop().create_future()
+        queue = self.get_queue(channel)
+        queue.pending.append((send, future))
+        if queue.task is None:
+            queue.task = asyncio.ensure_future(self.run(channel.id, queue))
+        return future
+
+    async def run(self, channel_id, queue):
+        """
+        Sends queued messages of a channel in order, waiting whenever rate limit of the channel is used up.
+        :param channel_id: id of the channel.
+        :param queue: ChannelQueue of the channel.
+        :return: no return value.
+        """
+        try:
+            while queue.pending:
+                send, future = queue.pending.popleft()
+                if future.cancelled():
+                    continue
+                if len(queue.sent_at) >= self.rate:
+                    wait = queue.sent_at[0] + self.per - time.monotonic()
+                    if wait > 0:
+                        self.delayed += 1
+                        await asyncio.sleep(wait)
+                    queue.sent_at.popleft()
+                queue.sent_at.append(time.monotonic())
+                try:
+                    result = await send()
+                except Exception as e:
+                    if not future.done():
+                        future.set_exception(e)
+                    continue
+                self.sent += 1
+                if not future.done():
+                    future.set_result(result)
+        finally:
+            queue.task = None
+            if queue.pending:  # sender was cancelled; fail what is left
+                for _, future in queue.pending:
+                    if not future.done():
+                        future.cancel()
+                queue.pending.clear()
+            self.forget(channel_id, queue)
+
+    def forget(self, channel_id, queue):
+        # queues are kept while rate limit window of their last sends is open
+        if queue.task is None and queue.typing_users == 0 and \
+                (not queue.sent_at or queue.sent_at[-1] + self.per <= time.monotonic()):
+            if self.channels.get(channel_id) is queue:
+                del self.channels[channel_id]
+        elif queue.task is None and queue.typing_users == 0:
+            asyncio.get_event_loop().call_later(self.per, self.forget, channel_id, queue)
+
+    def stats(self):
+        """
+        Returns counters of the outbox.
+        :return: Dictionary of sent messages, sends delayed by rate limit and messages waiting in queues.
+        """
+        return {"sent": self.sent, "delayed": self.delayed,
+                "pending": sum(len(queue.pending) for queue in self.channels.values())}
+
+    def typing(self, channel):
+        """
+        Returns context manager showing typing indicator in channel while it is entered. Commands typing in the same
+        channel at the same time share one indicator.
+        :param channel: discord.abc.Messageable instance.
+        :return: asynchronous context manager.
+        """
+        return SharedTyping(self, channel)
+
+    async def keep_typing(self, channel, stop):
+        try:
+            async with channel.typing():
+                await stop.wait()
+        except Exception as e:
+            logging.warning("Could not show typing in " + str(channel) + ": " + repr(e))
+
+
+class SharedTyping:
+    """
+    Typing indicator of a channel counted by its users; shown from first enter until last exit.
+    """
+    def __init__(self, outbox, channel):
+        self.outbox = outbox
+        self.channel = channel
+
+    async def __aenter__(self):
+        queue = self.outbox.get_queue(self.channel)
+        queue.typing_users += 1
+        if queue.typing_task is None:
+            queue.typing_stop = asyncio.Event()
+            queue.typing_task = asyncio.ensure_future(self.outbox.keep_typing(self.channel, queue.typing_stop))
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        queue = self.outbox.get_queue(self.channel)
+        queue.typing_users -= 1
+        if queue.typing_users == 0:
+            queue.typing_stop.set()
+            queue.typing_task = None
+            self.outbox.forget(self.channel.id, queue)
+        return False
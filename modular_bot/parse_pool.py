@@ -0,0 +1,109 @@
+import asyncio
+import logging
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+
+def warm_up():
+    # Runs once in every worker process, so processes are started before the first page arrives
+    return os.getpid()
+
+
+class ParsePool:
+    """
+    Pool running page parsers shared by all modules. With processes, parsers run in worker processes outside the
+    GIL, so parsing scales with cores and bursts of pages never hold the event loop; parsers receive HttpResponse
+    with raw page bytes and must return small picklable records, so modules only build embeds on the loop.
+    Without processes, parsers run on default executor threads of the event loop.
+    """
+    def __init__(self, processes=0):
+        """
+        :param processes: number of worker processes, or 0 to parse on threads.
+        """
+        self.processes = processes
+        self.executor = None
+        self.pending = 0
+        self.completed = 0
+        self.restarts = 0
+
+    def configure(self, section):
+        """
+        Updates pool from [PARSING] section of config file. Must be called before first parse.
+        :param section: dictionary-like config section.
+        :return: no return value.
+        """
+        self.processes = int(section.get("processes", self.processes))
+        if self.processes < 0:  # one process for every core but the one running event loop
+            self.processes = max((os.cpu_count() or 2) - 1, 1)
+
+    def get_executor(self):
+        """
+        Returns process pool, creating it on first use. Processes are spawned, not forked, so they don't inherit
+        threads and connections of the bot, and work the same on every platform.
+        :return: ProcessPoolExecutor instance, or None if pool has no processes.
+        """
+        if self.processes > 0 and self.executor is None:
+            self.executor = ProcessPoolExecutor(max_workers=self.processes,
+                                                mp_context=multiprocessing.get_context("spawn"))
+        return self.executor
+
+    def start(self):
+        """
+        Starts worker processes in background.
+        :return: no return value.
+        """
+        executor = self.get_executor()
+        if executor is not None:
+            for _ in range(self.processes):
+                executor.submit(warm_up)
+
+    def restart(self):
+        """
+        Replaces worker processes with new ones. Pages already being parsed finish in old processes. Used when module
+        code is reloaded, because worker processes keep parsers they imported before.
+        :return: no return value.
+        """
+        if self.executor is not None:
+            self.executor.shutdown(wait=False)
+            self.executor = None
+            self.start()
+
+    async def run(self, parser, response):
+        """
+        Runs parser on response off the event loop. If a worker process dies, pool is replaced and page is parsed on
+        a thread instead.
+        :param parser: module-level function taking HttpResponse and returning picklable result.
+        :param response: HttpResponse instance.
+        :return: result of parser.
+        """
+        loop = asyncio.get_event_loop()
+        executor = self.get_executor()
+        self.pending += 1
+        try:
+            if executor is not None:
+                try:
+                    return await loop.run_in_executor(executor, parser, response)
+                except BrokenProcessPool:
+                    logging.exception("Parser process died while parsing " + response.url + "; restarting pool")
+                    if self.executor is executor:
+                        self.executor = None
+                        self.restarts += 1
+                        executor.shutdown(wait=False)
+            return await loop.run_in_executor(None, parser, response)
+        finally:
+            self.pending -= 1
+            self.completed += 1
+
+    def stats(self):
+        """
+        Returns counters of the pool.
+        :return: Dictionary of pages being parsed or waiting, pages parsed and restarts of crashed process pool.
+        """
+        return {"pending": self.pending, "completed": self.completed, "restarts": self.restarts}
+
+    def close(self):
+        if self.executor is not None:
+            self.executor.shutdown(wait=False, cancel_futures=True)
+            self.executor = None
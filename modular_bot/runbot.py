@@ -1,3 +1,12 @@
-from modular_bot import main_bot
+import time
 
-main_bot.main()
+
+def run():
+    started_at = time.perf_counter()
+    from modular_bot import main_bot  # imported after taking start time, so startup report includes imports
+    main_bot.main(started_at)
+
+
+# Guarded, since parser processes spawned by the bot import this module again
+if __name__ == "__main__":
+    run()
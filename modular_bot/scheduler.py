@@ -0,0 +1,165 @@
+import asyncio
+import heapq
+import itertools
+from datetime import datetime
+
+
+class TimerEntry:
+    """
+    Pending timer in TimerScheduler. Entries are ordered by deadline, then by order of scheduling.
+    """
+    __slots__ = ("when", "seq", "key", "payload", "cancelled")
+
+    def __init__(self, when, seq, key, payload):
+        self.when = when
+        self.seq = seq
+        self.key = key
+        self.payload = payload
+        self.cancelled = False
+
+    def __lt__(self, other):
+        return (self.when, self.seq) < (other.when, other.seq)
+
+
+class TimerScheduler:
+    """
+    Fires callback at wall-clock deadlines on the running event loop. Pending timers are kept in a binary heap, so
+    scheduling is O(log n) and cancelling is O(1); only one loop timer is armed, for the earliest deadline.
+    """
+    # Upper bound of a single sleep, so changes of wall clock are picked up
+    max_sleep = 300.0
+
+    def __init__(self, callback):
+        """
+        :param callback: function called with key and payload of each timer exactly once when it is due.
+        """
+        self.callback = callback
+        self.heap = []
+        self.entries = {}  # key -> live TimerEntry
+        self.counter = itertools.count()
+        self.cancelled_count = 0
+        self.handle = None
+        self.handle_when = None
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, key):
+        return key in self.entries
+
+    def schedule(self, key, when, payload):
+        """
+        Schedules timer. Timer with the same key is replaced.
+        :param key: hashable key identifying the timer.
+        :param when: datetime of the deadline.
+        :param payload: value passed to callback.
+        :return: no return value.
+        """
+        self.cancel(key)
+        entry = TimerEntry(when, next(self.counter), key, payload)
+        heapq.heappush(self.heap, entry)
+        self.entries[key] = entry
+        self.arm()
+
+    def schedule_many(self, items):
+        """
+        Schedules many timers at once by rebuilding heap in linear time. Used for bulk loading.
+        :param items: iterable of tuples of key, deadline and payload.
+        :return: no return value.
+        """
+        for key, when, payload in items:
+            self.cancel(key)
+            entry = TimerEntry(when, next(self.counter), key, payload)
+            self.heap.append(entry)
+            self.entries[key] = entry
+        heapq.heapify(self.heap)
+        self.arm()
+
+    def cancel(self, key):
+        """
+        Cancels timer. Entry is left in heap and skipped when it reaches the top.
+        :param key: key of the timer.
+        :return: payload of cancelled timer, or None if timer does not exist.
+        """
+        entry = self.entries.pop(key, None)
+        if entry is None:
+            return None
+        entry.cancelled = True
+        self.cancelled_count += 1
+        if self.cancelled_count > 64 and self.cancelled_count * 2 > len(self.heap):
+            self.compact()
+        return entry.payload
+
+    def get(self, key):
+        """
+        Returns deadline and payload of pending timer.
+        :param key: key of the timer.
+        :return: tuple of deadline and payload, or None if timer does not exist.
+        """
+        entry = self.entries.get(key)
+        if entry is None:
+            return None
+        return entry.when, entry.payload
+
+    def pending(self):
+        """
+        Returns all pending timers ordered by deadline.
+        :return: list of tuples of key, deadline and payload.
+        """
+        return [(entry.key, entry.when, entry.payload) for entry in sorted(self.entries.values())]
+
+    def compact(self):
+        """
+        Removes cancelled entries from heap.
+        :return: no return value.
+        """
+        self.heap = [entry for entry in self.heap if not entry.cancelled]
+        heapq.heapify(self.heap)
+        self.cancelled_count = 0
+
+    def arm(self):
+        """
+        Arms loop timer for the earliest deadline if it is not armed already.
+        :return: no return value.
+        """
+        while self.heap and self.heap[0].cancelled:
+            heapq.heappop(self.heap)
+            self.cancelled_count -= 1
+        if not self.heap:
+            if self.handle is not None:
+                self.handle.cancel()
+                self.handle = None
+            return
+        when = self.heap[0].when
+        if self.handle is not None:
+            if self.handle_when <= when:
+                return
+            self.handle.cancel()
+        delay = min(max((when - datetime.now()).total_seconds(), 0), self.max_sleep)
+        self.handle = asyncio.get_event_loop().call_later(delay, self.fire)
+        self.handle_when = when
+
+    def stop(self):
+        """
+        Disarms loop timer. Pending timers are kept and fire again once another timer is scheduled.
+        :return: no return value.
+        """
+        if self.handle is not None:
+            self.handle.cancel()
+            self.handle = None
+
+    def fire(self):
+        """
+        Runs callbacks of all due timers and arms loop timer for the next deadline.
+        :return: no return value.
+        """
+        self.handle = None
+        now = datetime.now()
+        while self.heap and (self.heap[0].cancelled or self.heap[0].when <= now):
+            entry = heapq.heappop(self.heap)
+            if entry.cancelled:
+                self.cancelled_count -= 1
+                continue
+            del self.entries[entry.key]
+            self.callback(entry.key, entry.payload)
+        self.arm()
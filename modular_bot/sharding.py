@@ -0,0 +1,26 @@
+def shard_of(guild_id, shard_count):
+    """
+    Returns gateway shard which receives events of a guild, as Discord assigns them.
+    :param guild_id: id of the guild, or None for direct messages, which always arrive on shard 0.
+    :param shard_count: total number of shards.
+    :return: shard id.
+    """
+    if guild_id is None:
+        return 0
+    return (guild_id >> 22) % shard_count
+
+
+def shard_ranges(shard_count, workers):
+    """
+    Splits shards into contiguous ranges of nearly equal size, one per worker.
+    :param shard_count: total number of shards.
+    :param workers: number of workers.
+    :return: list of lists of shard ids; workers beyond shard_count get none.
+    """
+    ranges = []
+    start = 0
+    for worker_id in range(workers):
+        size = shard_count // workers + (1 if worker_id < shard_count % workers else 0)
+        ranges.append(list(range(start, start + size)))
+        start += size
+    return ranges
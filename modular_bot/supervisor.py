@@ -0,0 +1,246 @@
+import asyncio
+import json
+import logging
+import signal
+import sys
+import time
+from aiohttp import web
+from discord.http import Route
+from modular_bot.http_client import FetchError, HttpClient
+from modular_bot.metrics import format_labels
+from modular_bot.sharding import shard_ranges
+
+# Longest line of worker output forwarded; long tracebacks and dumps fit in it
+OUTPUT_LINE_LIMIT = 1024 * 1024
+
+
+def merge_metrics(texts):
+    """
+    Merges metrics of several workers into one exposition. HELP and TYPE lines are written once per family, and every
+    sample gets a worker label.
+    :param texts: list of (worker id, metrics in Prometheus text format).
+    :return: merged metrics in string.
+    """
+    families = {}  # family name -> [HELP and TYPE lines, samples], in order of first appearance
+    for worker_id, text in texts:
+        family = None
+        label = "worker=\"" + str(worker_id) + "\""
+        for line in text.splitlines():
+            if line.startswith("# HELP ") or line.startswith("# TYPE "):
+                family = families.setdefault(line.split(" ", 3)[2], [[], []])
+                if line not in family[0]:
+                    family[0].append(line)
+            elif line and not line.startswith("#") and family is not None:
+                name, _, rest = line.partition(" ")
+                if "{" in name:
+                    family[1].append(name.replace("{", "{" + label + ",", 1) + " " + rest)
+                else:
+                    family[1].append(name + "{" + label + "} " + rest)
+    return "".join("\n".join(header + samples) + "\n" for header, samples in families.values())
+
+
+class Worker:
+    """
+    Bot process owning a range of gateway shards.
+    """
+    def __init__(self, worker_id, shard_ids):
+        self.worker_id = worker_id
+        self.shard_ids = shard_ids
+        self.process = None
+        self.started_at = 0.0
+        self.restarts = 0
+
+
+class Supervisor:
+    """
+    Runs the bot as several worker processes, each connected to its own range of gateway shards, so guilds are
+    spread over CPU cores and a crash takes down only the shards of one worker. Output of workers is merged into
+    output of the supervisor with a worker prefix, metrics of workers are merged on one endpoint, and workers which
+    exit with an error are restarted with exponential backoff. A worker exiting normally, like when shut down from
+    control panel, stops all of them.
+    """
+    def __init__(self, command, workers, shard_count=0, token="", metrics_host="127.0.0.1", metrics_port=None,
+                 restart_delay=1.0, max_restart_delay=60.0, stable_seconds=60.0):
+        """
+        :param command: list of arguments starting a worker; worker and shard arguments are appended.
+        :param workers: number of worker processes.
+        :param shard_count: total number of shards, or 0 to use the number Discord recommends for the bot.
+        :param token: token of the bot, used to ask Discord for recommended number of shards.
+        :param metrics_host: address of metrics endpoints.
+        :param metrics_port: port of merged metrics endpoint, or None to disable it. Worker i serves its own metrics
+                             on metrics_port + 1 + i.
+        :param restart_delay: seconds to wait before first restart of a crashed worker.
+        :param max_restart_delay: maximum seconds to wait before restarting a worker which keeps crashing.
+        :param stable_seconds: seconds a worker must run for its restart delay to reset.
+        """
+        self.command = command
+        self.worker_count = workers
+        self.shard_count = shard_count
+        self.token = token
+        self.metrics_host = metrics_host
+        self.metrics_port = metrics_port
+        self.restart_delay = restart_delay
+        self.max_restart_delay = max_restart_delay
+        self.stable_seconds = stable_seconds
+        self.workers = []
+        self.stopping = None
+        self.http = HttpClient(timeout=5.0)
+        self.runner = None
+
+    async def recommended_shards(self):
+        """
+        Asks Discord how many shards the bot should use.
+        :return: recommended number of shards, or None if it could not be fetched.
+        """
+        try:
+            response = await self.http.get(Route.BASE + "/gateway/bot", headers={"Authorization": "Bot " + self.token})
+            if response.status == 200:
+                return int(json.loads(response.text)["shards"])
+            logging.warning("Discord answered " + str(response.status) + " when asked for number of shards")
+        except (FetchError, ValueError, KeyError):
+            logging.exception("Could not fetch recommended number of shards")
+        return None
+
+    async def run(self):
+        """
+        Starts workers and supervises them until one exits normally or supervisor is stopped.
+        :return: no return value.
+        """
+        self.stopping = asyncio.Event()
+        loop = asyncio.get_event_loop()
+        for signal_number in (signal.SIGINT, signal.SIGTERM):
+            try:
+                loop.add_signal_handler(signal_number, self.stop)
+            except (NotImplementedError, RuntimeError):  # Windows; KeyboardInterrupt stops the loop instead
+                pass
+        shard_count = self.shard_count
+        if shard_count <= 0:
+            shard_count = await self.recommended_shards() or self.worker_count
+        self.shard_count = max(shard_count, self.worker_count)  # every worker needs at least one shard
+        self.workers = [Worker(worker_id, shard_ids) for worker_id, shard_ids
+                        in enumerate(shard_ranges(self.shard_count, self.worker_count))]
+        logging.info("Running " + str(self.shard_count) + " shards in " + str(self.worker_count) + " workers")
+        if self.metrics_port is not None:
+            await self.start_metrics()
+        tasks = [asyncio.ensure_future(self.supervise(worker)) for worker in self.workers]
+        try:
+            await self.stopping.wait()
+        finally:
+            for worker in self.workers:
+                self.terminate(worker)
+            await asyncio.gather(*tasks, return_exceptions=True)
+            if self.runner is not None:
+                await self.runner.cleanup()
+            await self.http.close()
+        logging.info("All workers stopped")
+
+    def stop(self):
+        if self.stopping is not None:
+            self.stopping.set()
+
+    def terminate(self, worker):
+        if worker.process is not None and worker.process.returncode is None:
+            try:
+                worker.process.terminate()
+            except ProcessLookupError:
+                pass
+
+    async def supervise(self, worker):
+        """
+        Runs worker process, restarting it whenever it crashes.
+        :param worker: Worker instance.
+        :return: no return value.
+        """
+        delay = self.restart_delay
+        while not self.stopping.is_set():
+            args = self.command + ["--worker-id", str(worker.worker_id), "--shard-count", str(self.shard_count),
+                                   "--shard-ids", ",".join(str(shard_id) for shard_id in worker.shard_ids)]
+            logging.info("Starting worker " + str(worker.worker_id) + " with shards " + str(worker.shard_ids))
+            worker.process = await asyncio.create_subprocess_exec(*args, stdin=asyncio.subprocess.DEVNULL,
+                                                                  stdout=asyncio.subprocess.PIPE,
+                                                                  stderr=asyncio.subprocess.STDOUT,
+                                                                  limit=OUTPUT_LINE_LIMIT)
+            worker.started_at = time.monotonic()
+            if self.stopping.is_set():  # stopped while worker was starting
+                self.terminate(worker)
+            await self.forward_output(worker)
+            code = await worker.process.wait()
+            if self.stopping.is_set():
+                return
+            if code == 0:
+                logging.info("Worker " + str(worker.worker_id) + " exited; stopping all workers")
+                self.stop()
+                return
+            if time.monotonic() - worker.started_at >= self.stable_seconds:
+                delay = self.restart_delay
+            worker.restarts += 1
+            logging.warning("Worker " + str(worker.worker_id) + " exited with code " + str(code) +
+                            "; restarting in " + "{:.1f}".format(delay) + "s")
+            try:
+                await asyncio.wait_for(self.stopping.wait(), delay)
+            except asyncio.TimeoutError:
+                pass
+            delay = min(delay * 2, self.max_restart_delay)
+
+    async def forward_output(self, worker):
+        """
+        Copies output of worker to output of supervisor line by line, prefixed with worker id.
+        :param worker: Worker instance.
+        :return: no return value.
+        """
+        prefix = "[worker " + str(worker.worker_id) + "] "
+        while True:
+            try:
+                line = await worker.process.stdout.readline()
+            except ValueError:
+                # reader discards what it buffered of a line longer than its limit; rest of the line, if it was
+                # not fully read yet, comes as next line
+                logging.warning("Dropped start of a line of worker " + str(worker.worker_id) + " output longer than " +
+                                str(OUTPUT_LINE_LIMIT) + " bytes")
+                continue
+            if not line:
+                return
+            sys.stderr.write(prefix + line.decode("utf-8", errors="replace"))
+            sys.stderr.flush()
+
+    async def start_metrics(self):
+        """
+        Starts merged metrics endpoint. Failure to bind is logged and leaves workers running without it.
+        :return: no return value.
+        """
+        app = web.Application()
+        app.router.add_get("/metrics", self.handle_metrics)
+        self.runner = web.AppRunner(app, access_log=None)
+        await self.runner.setup()
+        try:
+            await web.TCPSite(self.runner, self.metrics_host, self.metrics_port).start()
+        except OSError:
+            logging.exception("Could not start metrics endpoint on " + self.metrics_host + ":" + str(self.metrics_port))
+            await self.runner.cleanup()
+            self.runner = None
+            return
+        logging.info("Serving metrics of all workers on http://" + self.metrics_host + ":" + str(self.metrics_port) +
+                     "/metrics")
+
+    async def fetch_metrics(self, worker):
+        url = "http://" + self.metrics_host + ":" + str(self.metrics_port + 1 + worker.worker_id) + "/metrics"
+        try:
+            response = await self.http.get(url, timeout=2.0)
+        except FetchError:
+            return None
+        return response.text if response.status == 200 else None
+
+    async def handle_metrics(self, request):
+        texts = await asyncio.gather(*[self.fetch_metrics(worker) for worker in self.workers])
+        lines = ["# HELP modular_bot_worker_up Whether metrics of the worker could be read.",
+                 "# TYPE modular_bot_worker_up gauge"]
+        lines += ["modular_bot_worker_up" + format_labels({"worker": worker.worker_id}) + " " +
+                  ("1" if text is not None else "0") for worker, text in zip(self.workers, texts)]
+        lines += ["# HELP modular_bot_worker_restarts_total Restarts of the worker after it crashed.",
+                  "# TYPE modular_bot_worker_restarts_total counter"]
+        lines += ["modular_bot_worker_restarts_total" + format_labels({"worker": worker.worker_id}) + " " +
+                  str(worker.restarts) for worker in self.workers]
+        body = "\n".join(lines) + "\n" + merge_metrics([(worker.worker_id, text) for worker, text
+                                                         in zip(self.workers, texts) if text is not None])
+        return web.Response(body=body.encode("utf-8"),
+                            headers={"Content-Type": "text/plain; version=0.0.4; charset=utf-8"})
@@ -0,0 +1,117 @@
+import asyncio
+import logging
+import time
+from collections import namedtuple
+from urllib.parse import urlsplit, parse_qs
+from modular_bot.cache import TTLCache, SingleFlight
+
+# Title and direct stream url of a youtube video; expires_at is unix time after which stream url stops working
+ResolvedTrack = namedtuple("ResolvedTrack", ["url", "title", "stream_url", "duration", "expires_at"])
+
+# Options passed to youtube_dl; same as what discord.py used for ytdl players
+YTDL_OPTIONS = {"format": "webm[abr>0]/bestaudio/best", "prefer_ffmpeg": True, "quiet": True, "noplaylist": True}
+
+
+class TrackError(Exception):
+    """
+    Raised when url can't be resolved to a playable stream.
+    """
+    pass
+
+
+def stream_expiry(stream_url, fallback_ttl):
+    """
+    Reads expiry time of a stream url. Youtube signs stream urls with unix time of expiry in expire parameter.
+    :param stream_url: direct url of audio stream.
+    :param fallback_ttl: seconds the url is assumed to stay valid if it has no expire parameter.
+    :return: unix time after which url should not be used.
+    """
+    expire = parse_qs(urlsplit(stream_url).query).get("expire")
+    if expire:
+        try:
+            return float(expire[0])
+        except ValueError:
+            pass
+    return time.time() + fallback_ttl
+
+
+def resolve_track(url, fallback_ttl):
+    """
+    Extracts title and stream url of a video with youtube_dl. Blocks on network; run in executor.
+    :param url: url of video, or of playlist to take its first video.
+    :param fallback_ttl: seconds the stream url is assumed to stay valid if it has no expiry.
+    :return: ResolvedTrack instance.
+    """
+    import youtube_dl  # only needed once music is played
+    try:
+        info = youtube_dl.YoutubeDL(YTDL_OPTIONS).extract_info(url, download=False)
+    except youtube_dl.utils.YoutubeDLError as e:
+        raise TrackError(str(e)) from e
+    if info is not None and "entries" in info:
+        entries = [entry for entry in info["entries"] if entry]
+        info = entries[0] if entries else None
+    if info is None or not info.get("url"):
+        raise TrackError("No playable stream in " + url)
+    stream_url = info["url"]
+    return ResolvedTrack(url, info.get("title", url), stream_url, info.get("duration"),
+                         stream_expiry(stream_url, fallback_ttl))
+
+
+class TrackResolver:
+    """
+    Resolves youtube urls to stream urls off the event loop and keeps them until shortly before they expire.
+    Upcoming tracks can be prefetched in background, so they start without waiting for youtube_dl.
+    """
+    def __init__(self, fallback_ttl=1800.0, expiry_margin=60.0, max_entries=64):
+        """
+        :param fallback_ttl: seconds stream url is assumed to stay valid if it has no expiry.
+        :param expiry_margin: seconds before expiry at which stream url is resolved again.
+        :param max_entries: maximum number of resolved tracks kept.
+        """
+        self.fallback_ttl = fallback_ttl
+        self.expiry_margin = expiry_margin
+        self.tracks = TTLCache(max_entries=max_entries, max_bytes=max_entries)
+        self.in_flight = SingleFlight()
+        self.prefetching = set()  # tasks of prefetches, kept until done
+
+    async def resolve(self, url):
+        """
+        Returns resolved track of url, resolving it if it is not cached or is about to expire. Concurrent calls for
+        the same url share one resolution.
+        :param url: url of video.
+        :return: ResolvedTrack instance.
+        """
+        track = self.tracks.get(url)
+        if track is not None:
+            return track
+        return await self.in_flight.do(url, lambda: self.resolve_and_store(url))
+
+    async def resolve_and_store(self, url):
+        started = time.perf_counter()
+        track = await asyncio.get_event_loop().run_in_executor(None, resolve_track, url, self.fallback_ttl)
+        logging.info("Resolved " + track.title + " in " + "{:.0f}".format((time.perf_counter() - started) * 1000) +
+                     " ms")
+        self.tracks.put(url, track, track.expires_at - time.time() - self.expiry_margin)
+        return track
+
+    def prefetch(self, urls):
+        """
+        Starts resolving urls in background. Urls which are already resolved or being resolved are skipped.
+        :param urls: iterable of urls, in the order they will be played.
+        :return: no return value.
+        """
+        for url in urls:
+            if url in self.in_flight.calls or self.tracks.get(url) is not None:
+                continue
+            task = asyncio.ensure_future(self.prefetch_one(url))
+            self.prefetching.add(task)
+            task.add_done_callback(self.prefetching.discard)
+
+    async def prefetch_one(self, url):
+        try:
+            await self.resolve(url)
+        except TrackError as e:
+            # Reported again when the track is played
+            logging.warning("Could not prefetch " + url + ": " + str(e))
+        except Exception:
+            logging.exception("Could not prefetch " + url)
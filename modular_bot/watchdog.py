@@ -0,0 +1,107 @@
+import asyncio
+import logging
+import sys
+import threading
+import time
+import traceback
+
+
+class LoopWatchdog:
+    """
+    Detects callbacks holding the event loop for longer than a threshold. The loop beats a heartbeat on every
+    iteration of a short timer, and a separate thread checks it. When the heartbeat stops, the thread captures the
+    stack of the loop thread while it is still blocked, together with the command whose task is running.
+    """
+    def __init__(self, threshold=0.25, metrics=None, dispatcher=None):
+        """
+        :param threshold: seconds the loop may be held before it is reported.
+        :param metrics: optional MetricsRegistry counting blocking calls.
+        :param dispatcher: optional CommandDispatcher used to find command of the blocking task.
+        """
+        self.threshold = threshold
+        self.metrics = metrics
+        self.dispatcher = dispatcher
+        self.loop = None
+        self.loop_thread_id = None
+        self.last_beat = 0.0
+        self.thread = None
+        self.stopping = threading.Event()
+
+    def start(self):
+        """
+        Starts heartbeat and watchdog thread. Must be called from the thread running the event loop.
+        :return: no return value.
+        """
+        if self.thread is not None:
+            return
+        self.loop = asyncio.get_event_loop()
+        self.loop_thread_id = threading.get_ident()
+        self.last_beat = time.monotonic()
+        self.stopping.clear()
+        self.beat()
+        self.thread = threading.Thread(target=self.watch, name="loop-watchdog", daemon=True)
+        self.thread.start()
+        logging.info("Loop watchdog started; threshold " + str(self.threshold) + "s")
+
+    def stop(self):
+        self.stopping.set()
+        self.thread = None
+
+    def beat(self):
+        self.last_beat = time.monotonic()
+        if not self.stopping.is_set():
+            self.loop.call_later(self.threshold / 4, self.beat)
+
+    def describe_blocker(self):
+        """
+        Finds command of the task currently running on the loop. Called from watchdog thread.
+        :return: tuple of module name and command name, or None if loop is not running a command.
+        """
+        task = asyncio.current_task(self.loop)
+        if task is None or self.dispatcher is None:
+            return None
+        return self.dispatcher.describe(task)
+
+    def watch(self):
+        """
+        Body of watchdog thread.
+        :return: no return value.
+        """
+        stalled_beat = None  # heartbeat value of the stall being reported
+        blocker = None
+        while not self.stopping.wait(self.threshold / 4):
+            beat = self.last_beat
+            blocked_for = time.monotonic() - beat
+            if stalled_beat is not None and beat != stalled_beat:
+                # loop is running again; stall lasted until the heartbeat was renewed
+                self.report_end(blocker, beat - stalled_beat)
+                stalled_beat = None
+            if stalled_beat is None and blocked_for > self.threshold:
+                frame = sys._current_frames().get(self.loop_thread_id)
+                stack = "".join(traceback.format_stack(frame)) if frame is not None else ""
+                blocker = self.describe_blocker()
+                stalled_beat = beat
+                if blocker is None:
+                    logging.warning("Event loop blocked for over " + "{:.2f}".format(blocked_for) + "s\n" + stack)
+                else:
+                    logging.warning("Event loop blocked for over " + "{:.2f}".format(blocked_for) + "s by command " +
+                                    blocker[1] + " of " + blocker[0] + "\n" + stack)
+
+    def report_end(self, blocker, seconds):
+        """
+        Logs end of a stall and records it in metrics on the loop thread.
+        :param blocker: tuple of module name and command name, or None.
+        :param seconds: approximate duration of the stall.
+        :return: no return value.
+        """
+        module_name, command_name = blocker if blocker is not None else ("", "")
+        if blocker is None:
+            logging.warning("Event loop was blocked for about " + "{:.2f}".format(seconds) + "s")
+        else:
+            logging.warning("Event loop was blocked for about " + "{:.2f}".format(seconds) + "s by command " +
+                            command_name + " of " + module_name)
+        if self.metrics is not None:
+            try:
+                self.loop.call_soon_threadsafe(self.metrics.observe_blocked, module_name, command_name, seconds)
+            except RuntimeError:  # loop is closed
+                pass